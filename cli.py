@@ -0,0 +1,20 @@
+import sys
+
+# Helpers shared by the command line entry points (python -m ...)
+
+def get_option(name, default):
+    # Value following name in sys.argv, default when name isn't given
+    if name in sys.argv:
+        return sys.argv[sys.argv.index(name) + 1]
+    return default
+
+def require_manifest(config):
+    # Split manifest for the TRAINING_SET_RATIO and NUM_FOLDS in conf.txt.
+    # Tools that need one stop here until main.py --resplit has written it.
+    from data_mgmt.splits import get_manifest
+
+    manifest = get_manifest(float(config['GENERAL']['TRAINING_SET_RATIO']), int(config['GENERAL']['NUM_FOLDS']))
+    if manifest is None:
+        print("No split manifest found, run main.py with --resplit first, aborting...")
+        exit(0)
+    return manifest
@@ -0,0 +1,164 @@
+import sys, os, json
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+from cli import get_option
+
+REPORT_FILE = 'datasets/agreement.json'
+NUM_RESAMPLES = 10000
+RESAMPLE_CHUNK = 500
+CONFIDENCE = 0.95
+
+# Values of every vote type, in value-count column order
+FAMILY_VALUES = {
+    'hate': [0, 1],
+    'offensive': [0, 1],
+    'hateTypes': ['racism', 'political', 'homophobia', 'misoginy', 'other'],
+}
+
+def value_count_matrix(family, counts):
+    # (tweets x values) matrix from per-tweet counts as kept by fetch_data
+    values = FAMILY_VALUES[family]
+    if family == 'hateTypes':
+        rows = [[c.get(v, 0) for v in values] for c in counts.values()]
+    else:
+        rows = [list(c) for c in counts.values()]
+    return np.array(rows, dtype=np.float64).reshape(-1, len(values))
+
+def unit_coincidences(value_counts):
+    # Coincidence matrix contributed by every pairable unit (two votes or
+    # more), shape (units, values, values)
+    value_counts = np.atleast_2d(np.asarray(value_counts, dtype=np.float64))
+    m = value_counts.sum(axis=1)
+    value_counts = value_counts[m >= 2]
+    scale = 1 / (m[m >= 2] - 1)
+
+    o = value_counts[:, :, None] * value_counts[:, None, :]
+    o[:, np.arange(value_counts.shape[1]), np.arange(value_counts.shape[1])] -= value_counts
+    return o * scale[:, None, None]
+
+def coincidences(value_counts):
+    return unit_coincidences(value_counts).sum(axis=0)
+
+def nominal_alpha(o):
+    # Krippendorff's alpha for nominal data, works on a stack of coincidence
+    # matrices too (..., values, values)
+    o = np.asarray(o, dtype=np.float64)
+    n_c = o.sum(axis=-1)
+    n = n_c.sum(axis=-1)
+    observed = n - np.trace(o, axis1=-2, axis2=-1)
+    expected = n ** 2 - np.sum(n_c ** 2, axis=-1)
+
+    alpha = 1 - (n - 1) * np.divide(observed, expected, out=np.full(np.shape(n), np.nan), where=expected != 0)
+    return float(alpha) if np.ndim(alpha) == 0 else alpha
+
+def one_vs_rest(value_counts, column):
+    # Binary (chosen value, any other value) counts for one value
+    value_counts = np.asarray(value_counts, dtype=np.float64)
+    chosen = value_counts[:, column]
+    return np.stack([value_counts.sum(axis=1) - chosen, chosen], axis=1)
+
+#### Bootstrap ####
+def _bootstrap_chunk(contributions, num_resamples, seed):
+    rng = np.random.default_rng(seed)
+    u = len(contributions)
+    # Every row holds how many times each unit was drawn in one resample,
+    # coincidences are additive over units. Bincounting the draws is a few
+    # times faster than rng.multinomial for thousands of units.
+    draws = rng.integers(0, u, size=(num_resamples, u)) + u * np.arange(num_resamples)[:, None]
+    weights = np.bincount(draws.ravel(), minlength=num_resamples * u).reshape(num_resamples, u).astype(np.float64)
+    o = (weights @ contributions.reshape(u, -1)).reshape(num_resamples, *contributions.shape[1:])
+    return nominal_alpha(o)
+
+def bootstrap_alpha(value_counts, num_resamples=NUM_RESAMPLES, confidence=CONFIDENCE, pool=None, seed=0):
+    contributions = unit_coincidences(value_counts)
+    if len(contributions) < 2:
+        return {'low': float('nan'), 'high': float('nan'), 'std': float('nan')}
+
+    chunks = [RESAMPLE_CHUNK] * (num_resamples // RESAMPLE_CHUNK)
+    if num_resamples % RESAMPLE_CHUNK:
+        chunks.append(num_resamples % RESAMPLE_CHUNK)
+    seeds = np.random.SeedSequence(seed).spawn(len(chunks))
+
+    if pool is None:
+        with ProcessPoolExecutor() as pool:
+            return bootstrap_alpha(value_counts, num_resamples, confidence, pool, seed)
+
+    futures = [pool.submit(_bootstrap_chunk, contributions, size, s) for size, s in zip(chunks, seeds)]
+    alphas = np.concatenate([f.result() for f in futures])
+
+    alphas = alphas[~np.isnan(alphas)]
+    alpha = (1 - confidence) / 2
+    return {
+        'low': float(np.quantile(alphas, alpha)),
+        'high': float(np.quantile(alphas, 1 - alpha)),
+        'std': float(np.std(alphas)),
+    }
+
+#### Report ####
+def summarize(value_counts, values, num_resamples, confidence, pool, seed):
+    votes = value_counts.sum(axis=1)
+    return {
+        'alpha': nominal_alpha(coincidences(value_counts)),
+        'interval': bootstrap_alpha(value_counts, num_resamples, confidence, pool, seed),
+        'tweets': int(len(value_counts)),
+        'pairable_tweets': int(np.sum(votes >= 2)),
+        'votes': int(votes.sum()),
+        'distribution': {str(v): int(c) for v, c in zip(values, value_counts.sum(axis=0))},
+    }
+
+def agreement_report(valueCounts, num_resamples=NUM_RESAMPLES, confidence=CONFIDENCE, workers=None, seed=0):
+    report = {'confidence': confidence, 'resamples': num_resamples, 'families': {}, 'hate_types': {}}
+
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        for family, values in FAMILY_VALUES.items():
+            matrix = value_count_matrix(family, valueCounts[family])
+            report['families'][family] = summarize(matrix, values, num_resamples, confidence, pool, seed)
+
+        # Agreement on each hate type against the rest, over the tweets that
+        # got hate type votes
+        matrix = value_count_matrix('hateTypes', valueCounts['hateTypes'])
+        for column, hate_type in enumerate(FAMILY_VALUES['hateTypes']):
+            report['hate_types'][hate_type] = summarize(one_vs_rest(matrix, column), ['rest', hate_type],
+                                                        num_resamples, confidence, pool, seed)
+
+    return report
+
+def format_report(report):
+    lines = ['\n###### Krippendorff alpha ({:.0f}% bootstrap intervals) ######\n'.format(100 * report['confidence'])]
+    for section in ['families', 'hate_types']:
+        for name, summary in report[section].items():
+            ci = summary['interval']
+            lines.append('{}: {:.4f} [{:.4f}, {:.4f}] ({} tweets, {} votes)'.format(name, summary['alpha'], ci['low'], ci['high'],
+                                                                                  summary['pairable_tweets'], summary['votes']))
+    return '\n'.join(lines) + '\n'
+
+if __name__ == "__main__":
+    # Usage: python -m data_mgmt.agreement [<ssh_user> <db_password>] [--resamples N] [--workers N] [--output file]
+    # Without credentials the counts come from the data_mgmt.sync_votes store
+    from data_mgmt import fetch_data, sync_votes
+
+    positional = [a for i, a in enumerate(sys.argv[1:], 1)
+                  if not a.startswith('--') and not sys.argv[i - 1].startswith('--')]
+
+    if len(positional) >= 2:
+        client = fetch_data.connect(positional[0])
+        _, valueCounts, _ = fetch_data.fetchCounts(client, positional[1])
+        client.close()
+    else:
+        store = sync_votes.load_store()
+        if store is None:
+            print("No vote count store found, run data_mgmt.sync_votes or pass the database credentials, aborting...")
+            exit(0)
+        valueCounts = store['counts']
+
+    report = agreement_report(valueCounts,
+                              int(get_option('--resamples', NUM_RESAMPLES)),
+                              workers=int(get_option('--workers', os.cpu_count())))
+
+    output_file = get_option('--output', REPORT_FILE)
+    with open(output_file, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    print(format_report(report))
+    print('Report written to', output_file)
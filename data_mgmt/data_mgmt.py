@@ -1,70 +1,41 @@
-import csv, re, unidecode, nltk, os, bert, configparser, sys, re
+import re, unidecode, nltk, os, configparser, sys, re
 import preprocessor as p, numpy as np
 
-from random import shuffle
-from math import floor
 from nltk.corpus import stopwords
 from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.decomposition import TruncatedSVD
+from sklearn.random_projection import SparseRandomProjection
+from joblib import dump, load
 
-nltk.download('punkt')
-nltk.download('stopwords')
+from data_mgmt import splits
+from data_mgmt.hashed_tfidf import HashedTfidfVectorizer, ColumnSubsetSVD
+
+# nltk.download checks the online index every time, it only runs when the
+# data is missing. Spawned pool workers import this module too.
+for resource, package in [('tokenizers/punkt', 'punkt'), ('corpora/stopwords', 'stopwords')]:
+    try:
+        nltk.data.find(resource)
+    except LookupError:
+        nltk.download(package)
 
 #TODO: Separate dataset and vector creation
 
 MAX_WORDS = 33
 
-def new_dataset(dataset_tsv_file, training_set_ratio):
-    pairs = None
-
-    with open('datasets/' + dataset_tsv_file) as tsvfile:
-        reader = csv.DictReader(tsvfile, dialect='excel-tab')
-        pairs = [(r['id'], r['HS'], r['OF'], r['HT'], r['text']) for r in reader]
-
-    shuffle(pairs)
+SENT_DIMENSION = 100
+SENT_VECTORIZERS = ['tfidf', 'hashing']
+SENT_REDUCTIONS = ['svd', 'random']
 
-    split_index = floor(training_set_ratio * len(pairs))
-
-    training_set_file = open("training_set.txt", "w")
-    test_set_file = open("test_set.txt", "w")
-
-    bert_training_file = open("bert_training_set.txt", "w")
-    bert_test_file = open("bert_test_set.txt", "w")
-    
-    training_words = set()
-    test_words = set()
-
-    with open('datasets/idorsPP.tsv', 'w') as tsvFile:
-        fieldNames = ['id',	'HS', 'OF', 'HT', 'text', 'pretext']
-        writer = csv.DictWriter(tsvFile, fieldnames=fieldNames, delimiter="\t")
-        writer.writeheader()
-
-        for i, pair in enumerate(pairs):
-            preprocessed = preprocess(pair[4])
-            writer.writerow({'id': pair[0], 'HS': pair[1], 'OF': pair[2], 'HT': pair[3], 'text': pair[4], 'pretext': preprocessed})
-            matches = re.match(r'\s*', preprocessed)
-            groups = matches.groups()
-            if preprocessed == "" or len(re.match(r'', preprocessed).groups()) > 0:
-                continue
-            result = "__label__"+ pair[1] + " " + preprocessed + "\n"
-            bp_tweet = bert_preprocess(pair[4]) + "\n"
-            if i < split_index:
-                training_words = training_words.union(preprocessed.split())
-                training_set_file.writelines(result)
-                bert_training_file.writelines(bp_tweet)
-            else:
-                test_words = test_words.union(preprocessed.split())
-                test_set_file.writelines(result)
-                bert_test_file.writelines(bp_tweet)
-
-    training_set_file.close()
-    test_set_file.close()
-    
-    bert_training_file.close()
-    bert_test_file.close()
+# Multi-task labels, 'A' (ambiguous) and 'N/A' (no votes) are masked out
+TASKS = ['HS', 'OF', 'HT']
+HATE_TYPES = ['racism', 'misoginy', 'political', 'homophobia', 'other']
+MASKED_LABEL = -1
 
-    wordsNewInTest = test_words - training_words
-    wordRatio = len(wordsNewInTest) / len(test_words)
+def new_dataset(dataset_tsv_file, training_set_ratio, num_folds, dedup_mode='none'):
+    # Split membership comes from a seeded manifest, only new or edited tweets
+    # are preprocessed again
+    return splits.prepare_splits(dataset_tsv_file, training_set_ratio, num_folds, os.getenv('LANGUAGE'),
+                                 dedup_mode=dedup_mode)
 
 def create_bert_tokenizer():
     config = configparser.ConfigParser()
@@ -75,6 +46,8 @@ def create_bert_tokenizer():
     models_folder = os.path.join(current_dir, "models/bert_model", bert_model_dir)
     vocab_file = os.path.join(models_folder, "vocab.txt")
 
+    # bert loads TensorFlow, only the callers that tokenize pay for it
+    import bert
     tokenizer = bert.bert_tokenization.FullTokenizer(vocab_file, do_lower_case=True)
     return tokenizer
 
@@ -129,67 +102,53 @@ def preprocess(tweet):
     #tweet = re.sub(r'(\$[^$\s]+?\$)(\S)', r'\1 \2', tweet)
     #return unidecode.unidecode(rightFix)
 
-def get_dataset():
-    parsing_regex = re.compile(r'^__label__(\d)\s{1}(.*)$')
-
-    train_file = open('training_set.txt')
-    test_file = open('test_set.txt')
-
-    training_dataset = []
-    test_dataset = []
-    all_tweets = []
+def get_dataset_text(manifest=None):
+    # (pretext, HS) pairs of the training and test splits
+    return ([(r['pretext'], r['HS']) for r in splits.load_split('training', manifest)],
+            [(r['pretext'], r['HS']) for r in splits.load_split('test', manifest)])
 
-    for line in train_file:
-        match = re.match(parsing_regex, line)
-        all_tweets.append(match[2])
-        training_dataset.append((match[2], match[1]))
+def get_dataset(sent_emb_file=None, manifest=None):
+    training_dataset, test_dataset = get_dataset_text(manifest)
+    all_tweets = [ex[0] for ex in training_dataset + test_dataset]
 
-    for line in test_file:
-        match = re.match(parsing_regex, line)
-        all_tweets.append(match[2])
-        test_dataset.append((match[2], match[1]))
-    
-    extra_embeddings = get_additional_embeddings(all_tweets)
+    extra_embeddings = get_additional_embeddings(all_tweets, sent_emb_file)
 
     training_ex_emb = extra_embeddings[0:len(training_dataset)]
     test_ex_emb = extra_embeddings[-len(test_dataset):]
 
     return training_dataset, test_dataset, training_ex_emb, test_ex_emb
 
-def get_bert_token_ids():
-    bert_tokenizer = create_bert_tokenizer()
-    train_ids = []
-    test_ids = []
-
-    if not (os.path.exists('bert_training_ids.txt') and os.path.exists('bert_test_ids.txt')):
-        with open("bert_training_set.txt") as tweets_file:
-            tweets = tweets_file.readlines()
-            for tweet in tweets:
-                train_tokens = ["[CLS]"] + bert_tokenizer.tokenize(tweet) + ["[SEP]"]
-                train_token_ids = bert_tokenizer.convert_tokens_to_ids(train_tokens)
-                train_ids.append(train_token_ids)
-
-        with open("bert_test_set.txt") as tweets_file:
-            tweets = tweets_file.readlines()
-            for tweet in tweets:
-                test_tokens = ["[CLS]"] + bert_tokenizer.tokenize(tweet) + ["[SEP]"]
-                test_token_ids = bert_tokenizer.convert_tokens_to_ids(test_tokens)
-                test_ids.append(test_token_ids)
-        max_train_length = max(map(len, train_ids))
-        max_test_length = max(map(len, test_ids))
-
-        max_length = max(max_train_length, max_test_length)
-
-        train_ids = np.array([ id_list + [0] * (max_length - len(id_list)) for id_list in train_ids])
-        test_ids = np.array([ id_list + [0] * (max_length - len(id_list)) for id_list in test_ids])
-
-        np.savetxt('bert_training_ids.txt', train_ids)
-        np.savetxt('bert_test_ids.txt', test_ids)
-    else:
-        train_ids = np.loadtxt('bert_training_ids.txt')
-        test_ids = np.loadtxt('bert_test_ids.txt')
-
-    return train_ids, test_ids
+def get_bert_texts(manifest=None):
+    return ([r['btext'] for r in splits.load_split('training', manifest)],
+            [r['btext'] for r in splits.load_split('test', manifest)])
+
+def encode_task_label(task, label):
+    if label in ('A', 'N/A'):
+        return MASKED_LABEL
+    if task == 'HT':
+        return HATE_TYPES.index(label)
+    return int(label)
+
+def get_multitask_labels(manifest=None):
+    result = []
+    for split in ['training', 'test']:
+        rows = splits.load_split(split, manifest)
+        result.append({task: np.asarray([encode_task_label(task, row[task]) for row in rows])
+                       for task in TASKS})
+
+    return result[0], result[1]
+
+def tokenize_for_bert(tweets, bert_tokenizer):
+    token_ids = []
+    for tweet in tweets:
+        tokens = ["[CLS]"] + bert_tokenizer.tokenize(tweet) + ["[SEP]"]
+        token_ids.append(bert_tokenizer.convert_tokens_to_ids(tokens))
+    return token_ids
+
+def pad_token_ids(token_ids, max_length=None):
+    if max_length is None:
+        max_length = max(map(len, token_ids))
+    return np.array([id_list[:max_length] + [0] * (max_length - len(id_list)) for id_list in token_ids])
 
 def dataset_to_embeddings(dataset, ft_model):
     result = np.empty((len(dataset), MAX_WORDS, ft_model.get_dimension()))
@@ -210,23 +169,75 @@ def get_tweet_embeddings(tweet, ft_model):
             vecs[i] = get_word_embedding(words[i], ft_model)
     return vecs
 
-def get_additional_embeddings(all_tweets):
-    tf_idf_vectorizer = TfidfVectorizer()
+def sent_embedder_options():
+    config = configparser.ConfigParser()
+    config.read('conf.txt')
+    section = config['EMBEDDINGS'] if config.has_section('EMBEDDINGS') else {}
+    return section.get('SENT_VECTORIZER', 'tfidf'), section.get('SENT_REDUCTION', 'svd')
+
+def fit_sent_embedder(all_tweets, vectorizer=None, reduction=None, workers=None):
+    # vectorizer and reduction default to SENT_VECTORIZER and SENT_REDUCTION in conf.txt
+    if vectorizer is None or reduction is None:
+        config_vectorizer, config_reduction = sent_embedder_options()
+        vectorizer = vectorizer or config_vectorizer
+        reduction = reduction or config_reduction
+
+    if vectorizer == 'tfidf':
+        tf_idf_vectorizer = TfidfVectorizer()
+    elif vectorizer == 'hashing':
+        tf_idf_vectorizer = HashedTfidfVectorizer(workers=workers or os.cpu_count())
+    else:
+        raise ValueError('Unknown SENT_VECTORIZER {}, use one of {}'.format(vectorizer, ', '.join(SENT_VECTORIZERS)))
     tf_idf_embeddings = tf_idf_vectorizer.fit_transform(all_tweets)
 
-    svd = TruncatedSVD(n_components=100)
-    reduced_dimension_embeddings = svd.fit_transform(tf_idf_embeddings)
+    if reduction == 'svd':
+        reducer = ColumnSubsetSVD(SENT_DIMENSION) if vectorizer == 'hashing' else TruncatedSVD(n_components=SENT_DIMENSION)
+    elif reduction == 'random':
+        # Needs nothing from the data but its width
+        reducer = SparseRandomProjection(n_components=SENT_DIMENSION, dense_output=True, random_state=0)
+    else:
+        raise ValueError('Unknown SENT_REDUCTION {}, use one of {}'.format(reduction, ', '.join(SENT_REDUCTIONS)))
+    reducer.fit(tf_idf_embeddings)
+
+    return tf_idf_vectorizer, reducer
+
+def get_additional_embeddings(all_tweets, save_file=None):
+    extra_embeddings, sent_embedder = fit_additional_embeddings(all_tweets)
+
+    if save_file:
+        os.makedirs(os.path.dirname(save_file), exist_ok=True)
+        dump(sent_embedder, save_file)
+
+    return extra_embeddings
+
+def fit_additional_embeddings(all_tweets):
+    # Sentence vectors of all_tweets and the embedder fitted on them
+    sent_embedder = fit_sent_embedder(all_tweets)
+    return transform_additional_embeddings(all_tweets, sent_embedder), sent_embedder
+
+def sent_emb_file(model_file):
+    # The sentence embedder a model was trained with is saved next to it
+    return model_file + '.sent_emb.joblib'
+
+def save_sent_embedder(sent_embedder, model_file):
+    dump(sent_embedder, sent_emb_file(model_file))
+
+def load_sent_embedder(filename):
+    return load(filename)
 
-    return reduced_dimension_embeddings
+def transform_additional_embeddings(tweets, sent_embedder):
+    tf_idf_vectorizer, svd = sent_embedder
+    return svd.transform(tf_idf_vectorizer.transform(tweets))
 
 if __name__ == "__main__":
     config = configparser.ConfigParser()
     config.read('conf.txt')
 
     training_set_ratio = float(config['GENERAL']['TRAINING_SET_RATIO'])
+    num_folds = int(config['GENERAL']['NUM_FOLDS'])
     dataset_name = config['GENERAL']['DATASET_NAME']
 
     os.environ['LANGUAGE'] = config['GENERAL']['LANGUAGE']
 
-    new_dataset(dataset_name, training_set_ratio)
+    new_dataset(dataset_name, training_set_ratio, num_folds, config['GENERAL'].get('DEDUP_MODE', 'none'))
     
\ No newline at end of file
@@ -0,0 +1,210 @@
+import os, json, time, zlib, configparser
+import numpy as np
+
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+from data_mgmt import fetch_data, splits
+from data_mgmt.normalize import get_normalizer
+from data_mgmt.sync_votes import STORE_FILE, FAMILIES, LineCollector, load_store
+from cli import get_option
+
+SHINGLE_SIZE = 5
+NUM_PERM = 128
+# 16 bands of 8 rows: pairs above ~0.7 Jaccard become candidates, candidates
+# are kept when their estimated Jaccard reaches THRESHOLD
+BANDS = 16
+THRESHOLD = 0.8
+# About 25MB of intermediate hashes per chunk
+SIGNATURE_CHUNK = 250
+SEED = 1234
+# Mersenne prime 2^31 - 1, a * h + b stays below 2^64
+PRIME = (1 << 31) - 1
+ABLATION_FILE = 'features/ablation.json'
+TASKS = ['HS', 'OF', 'HT']
+
+#### MinHash ####
+def shingle_hashes(text, size=SHINGLE_SIZE):
+    # Character shingles of the whitespace-normalized text, so a changed
+    # word or emoji only touches a few of them
+    text = ' '.join(text.split())
+    shingles = {text[i:i + size] for i in range(max(1, len(text) - size + 1))}
+    return np.array([zlib.crc32(s.encode('utf-8')) for s in shingles], dtype=np.uint64) % PRIME
+
+def permutations(num_perm=NUM_PERM, seed=SEED):
+    rng = np.random.RandomState(seed)
+    return (rng.randint(1, PRIME, num_perm).astype(np.uint64),
+            rng.randint(0, PRIME, num_perm).astype(np.uint64))
+
+def _signature_chunk(args):
+    texts, num_perm, seed = args
+    a, b = permutations(num_perm, seed)
+    hashes = [shingle_hashes(text) for text in texts]
+    offsets = np.cumsum([0] + [len(h) for h in hashes[:-1]])
+
+    # (num_perm, shingles of the whole chunk), minimum over the shingles of each tweet
+    values = (a[:, None] * np.concatenate(hashes)[None, :] + b[:, None]) % PRIME
+    return np.minimum.reduceat(values, offsets, axis=1).T.astype(np.uint32)
+
+def signatures(texts, num_perm=NUM_PERM, seed=SEED, workers=1):
+    chunks = [(texts[i:i + SIGNATURE_CHUNK], num_perm, seed) for i in range(0, len(texts), SIGNATURE_CHUNK)]
+    if workers == 1 or len(chunks) == 1:
+        return np.concatenate([_signature_chunk(c) for c in chunks], 0)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return np.concatenate(list(pool.map(_signature_chunk, chunks)), 0)
+
+#### LSH ####
+def _find(parent, i):
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+def lsh_clusters(sigs, bands=BANDS, threshold=THRESHOLD):
+    # Tweets sharing a band bucket are compared with the first tweet of the
+    # bucket only, which keeps huge copypasta buckets linear
+    n, num_perm = sigs.shape
+    rows = num_perm // bands
+    parent = list(range(n))
+
+    for band in range(bands):
+        keys = np.ascontiguousarray(sigs[:, band * rows:(band + 1) * rows]).view(np.dtype((np.void, rows * 4))).ravel()
+        _, inverse, sizes = np.unique(keys, return_inverse=True, return_counts=True)
+        if sizes.max() < 2:
+            continue
+
+        order = np.argsort(inverse, kind='stable')
+        starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+        for start, size in zip(starts[sizes > 1], sizes[sizes > 1]):
+            first = order[start]
+            members = order[start + 1:start + size]
+            similar = members[np.mean(sigs[members] == sigs[first], axis=1) >= threshold]
+            root = _find(parent, first)
+            for m in similar:
+                parent[_find(parent, m)] = root
+
+    clusters = {}
+    for i in range(n):
+        clusters.setdefault(_find(parent, i), []).append(i)
+    # Representative first: the earliest tweet of the cluster
+    return [sorted(c) for c in clusters.values() if len(c) > 1]
+
+#### Vote merging ####
+def merged_labels(clusters, rows, store, desambigEntries):
+    # Labels of every cluster as if all its votes had been cast on its
+    # representative, None when they are tied. Without vote counts, the
+    # majority of the members' labels.
+    rows = {r['id']: r for r in rows}
+    merged = {}
+    for cluster in clusters:
+        rep = cluster[0]
+        if store is not None and all(i in store['counts']['hate'] for i in cluster):
+            counts = {family: {} for family in FAMILIES}
+            for family in FAMILIES:
+                member_counts = [store['counts'][family][i] for i in cluster if i in store['counts'][family]]
+                if not member_counts:
+                    continue
+                if family == 'hateTypes':
+                    counts[family][rep] = {k: sum(c[k] for c in member_counts) for k in fetch_data.HATE_TYPE_KEYS}
+                else:
+                    counts[family][rep] = [sum(c[0] for c in member_counts), sum(c[1] for c in member_counts)]
+            row = fetch_data.labelTweet(rep, rows[rep]['text'], counts, desambigEntries, LineCollector())
+            merged[rep] = None if row is None else {task: row[task] for task in TASKS}
+        else:
+            merged[rep] = {}
+            for task in TASKS:
+                votes = Counter(rows[i][task] for i in cluster if rows[i][task] not in ('A', 'N/A')).most_common(2)
+                tied = not votes or (len(votes) > 1 and votes[0][1] == votes[1][1])
+                merged[rep][task] = rows[rep][task] if tied else votes[0][0]
+    return merged
+
+#### Report ####
+def leaked_clusters(clusters, manifest):
+    # Clusters split between training and test, or between k-fold folds
+    training = set(manifest['training'])
+    fold_of = dict(zip(manifest['training'] + manifest['test'], manifest['folds']))
+    leaks = {'train_test': 0, 'folds': 0}
+    for cluster in clusters:
+        members = [i for i in cluster if i in fold_of]
+        if len(set(i in training for i in members)) > 1:
+            leaks['train_test'] += 1
+        if len(set(fold_of[i] for i in members)) > 1:
+            leaks['folds'] += 1
+    return leaks
+
+def savings_report(rows, clusters, preprocessing_seconds, ablation_file=ABLATION_FILE):
+    # What keeping one tweet per cluster saves in every stage
+    removed = set(i for c in clusters for i in c[1:])
+    kept = [r for r in rows if r['id'] not in removed]
+    report = {
+        'tweets': len(rows),
+        'clusters': len(clusters),
+        'largest_cluster': max((len(c) for c in clusters), default=0),
+        'removable': len(removed),
+        'removable_share': len(removed) / max(len(rows), 1),
+        'preprocessing_seconds_saved': len(removed) * preprocessing_seconds,
+        # The BERT store already embeds exact repeats once, only near duplicates count
+        'bert_texts_saved': len(set(r['btext'] for r in rows)) - len(set(r['btext'] for r in kept)),
+    }
+
+    # Per-tweet featurization costs measured by models.ablation, when available
+    if os.path.exists(ablation_file):
+        with open(ablation_file) as f:
+            featurization_ms = json.load(f)['featurization_ms']
+        report['featurization_seconds_saved'] = {block: len(removed) * ms / 1000 for block, ms in featurization_ms.items()}
+
+    return report
+
+def preprocessing_seconds(rows, language, sample=200):
+    # Per-tweet cost of TweetNormalizer on a sample of the raw texts
+    normalizer = get_normalizer(language)
+    texts = [r['text'] for r in rows[:sample]]
+    start = time.perf_counter()
+    for text in texts:
+        normalizer.normalize(text)
+    return (time.perf_counter() - start) / max(len(texts), 1)
+
+def find_duplicates(rows, threshold=THRESHOLD, workers=1):
+    # Clusters of tweet ids, representative (first in the store) first
+    sigs = signatures([r['pretext'] for r in rows], workers=workers)
+    return [[rows[i]['id'] for i in cluster] for cluster in lsh_clusters(sigs, BANDS, threshold)]
+
+if __name__ == "__main__":
+    # Usage: python -m data_mgmt.dedup [--threshold 0.8] [--workers N]
+    # Clusters the preprocessed store, DEDUP_MODE in conf.txt decides what
+    # main.py --resplit does with them
+    config = configparser.ConfigParser()
+    config.read('conf.txt')
+    language = config['GENERAL']['LANGUAGE']
+    os.environ['LANGUAGE'] = language
+
+    threshold = float(get_option('--threshold', THRESHOLD))
+    workers = int(get_option('--workers', os.cpu_count()))
+
+    rows, _ = splits.preprocess_dataset(config['GENERAL']['DATASET_NAME'], language)
+    rows = [r for r in rows if r['pretext'] != ""]
+
+    start = time.perf_counter()
+    clusters = find_duplicates(rows, threshold, workers)
+    elapsed = time.perf_counter() - start
+
+    store = load_store(STORE_FILE)
+    desambigEntries = fetch_data.readDesambiguation() if os.path.exists(fetch_data.DESAMBIG_FILE) else {}
+
+    report = savings_report(rows, clusters, preprocessing_seconds(rows, language))
+    report['seconds'] = elapsed
+    manifest = splits.load_manifest()
+    if manifest is not None:
+        report['leaked_clusters'] = leaked_clusters(clusters, manifest)
+
+    duplicates = {
+        'content_hash': splits.content_hash(rows),
+        'threshold': threshold,
+        'num_perm': NUM_PERM,
+        'bands': BANDS,
+        'clusters': clusters,
+        'merged': merged_labels(clusters, rows, store, desambigEntries),
+        'report': report,
+    }
+    splits.write_atomic(splits.DUPLICATES_FILE, lambda f: json.dump(duplicates, f))
+    print(json.dumps(report, indent=2))
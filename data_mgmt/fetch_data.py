@@ -5,6 +5,13 @@ import paramiko
 import base64
 import json
 
+DESAMBIG_FILE = 'db_data/desambiguados.csv'
+AMBIGUOUS_FILE = 'db_data/ambiguous.json'
+IDORS_FILE = 'datasets/idors.tsv'
+FIELD_NAMES = ['id', 'text', 'HS', 'OF', 'HT']
+# Key order matters, ties between hate types are broken by it
+HATE_TYPE_KEYS = ['racism', 'political', 'homophobia', 'misoginy', 'other']
+
 def determineHateLabel(tweet_id, tweet_text, counts, desambigEntries, ambiguousJson):                
     label = None
     if abs(counts[0] - counts[1]) <= 1:
@@ -22,7 +29,7 @@ def determineHateLabel(tweet_id, tweet_text, counts, desambigEntries, ambiguousJ
     
     if not label:
         if counts[0] == counts[1]:
-            print(line['text'])
+            print(tweet_text)
             return -1
         
         label = counts.index(max(counts))
@@ -81,89 +88,111 @@ def determineHateTypeLabel(tweet_id, tweet_text, counts, desambigEntries):
     return label
 
 
-dataFileName = sys.argv[1]
-
-client = paramiko.SSHClient()
-client.load_system_host_keys()
-client.connect('odioelodio.com', username=f'{sys.argv[2]}')
-stdin, stdout, stderr = client.exec_command(f'mysql -u test -p{sys.argv[3]} -e "use pgodio;select v.tweet_id, t.text, count(v.is_hateful) as count, v.is_hateful from tweets t right join votesIsHateful v on t.id = v.tweet_id group by v.tweet_id, v.is_hateful;"')
-with open(dataFileName, "w") as tsvFile:
-    tsvFile.writelines(stdout)
-
-stdin, stdout, stderr = client.exec_command(f'mysql -u test -p{sys.argv[3]} -e "use pgodio;select v.tweet_id, t.text, count(v.is_offensive) as count, v.is_offensive from tweets t right join votesIsHateful v on t.id = v.tweet_id group by v.tweet_id, v.is_offensive;"')
-offensiveReader = csv.DictReader(list(stdout), delimiter="\t")
+def emptyCounts(family):
+    if family == 'hateTypes':
+        return {k: 0 for k in HATE_TYPE_KEYS}
+    return [0,0]
 
-stdin, stdout, stderr = client.exec_command(f'mysql -u test -p{sys.argv[3]} -e "use pgodio;select v.tweet_id, t.text, count(v.hate_type) as count, v.hate_type from tweets t right join votesHateType v on t.id = v.tweet_id group by v.tweet_id, v.hate_type;"')
-hateTypesReader = csv.DictReader(list(stdout), delimiter="\t")
-client.close()
+def labelTweet(tweet_id, tweet_text, valueCounts, desambigEntries, ambiguousJson):
+    # Row for idors.tsv, None when the hate votes are tied
+    labelHate = determineHateLabel(tweet_id, tweet_text, valueCounts['hate'][tweet_id], desambigEntries, ambiguousJson)
+    if labelHate == -1:
+        return None
 
-desambigEntries = {}
-with open('db_data/desambiguados.csv') as desambiguados:
-    csvReader = csv.DictReader(desambiguados)
-    for line in csvReader:
-        if line['text'] not in desambigEntries:
-            desambigEntries[line['text']] = {"written": False, "labels": list()}
-        desambigEntries[line['text']]['labels'].append(line['label'])
+    labelOffensive = None
+    if tweet_id in valueCounts['offensive']:
+        labelOffensive = determineOffensiveLabel(tweet_id, tweet_text, valueCounts['offensive'][tweet_id], desambigEntries)
+    else:
+        labelOffensive = "N/A"
 
-valueCounts = {'hate': {}, 'offensive': {}, 'hateTypes': {}}
-ids = set()
-
-countAmbiguous = 0
-with open(dataFileName) as tsvFile:
-    tsvReader = csv.DictReader(tsvFile, delimiter="\t")
-    for line in tsvReader:
-        #if line['tweet_id'] == "1034785678893232128":
-        #    b = 0
+    if labelHate == 1:
+        labelHateType = None
+        if tweet_id in valueCounts['hateTypes']:
+            labelHateType = determineHateTypeLabel(tweet_id, tweet_text, valueCounts['hateTypes'][tweet_id], desambigEntries)
+        else:
+            labelHateType = "N/A"
+    else:
+        labelHateType = "N/A"
+
+    return {'id': tweet_id, 'text': tweet_text, 'HS': str(labelHate), 'OF': str(labelOffensive), 'HT': labelHateType}
+
+def readDesambiguation(fileName=DESAMBIG_FILE):
+    desambigEntries = {}
+    with open(fileName) as desambiguados:
+        csvReader = csv.DictReader(desambiguados)
+        for line in csvReader:
+            if line['text'] not in desambigEntries:
+                desambigEntries[line['text']] = {"written": False, "labels": list()}
+            desambigEntries[line['text']]['labels'].append(line['label'])
+    return desambigEntries
+
+def runQuery(client, password, query):
+    stdin, stdout, stderr = client.exec_command(f'mysql -u test -p{password} -e "use pgodio;{query}"')
+    return list(stdout)
+
+def connect(username):
+    client = paramiko.SSHClient()
+    client.load_system_host_keys()
+    client.connect('odioelodio.com', username=username)
+    return client
+
+def fetchCounts(client, password):
+    # Raw lines of the hate query (kept as countedVotes.tsv) and grouped
+    # per-tweet counts for the three vote types
+    hateLines = runQuery(client, password, "select v.tweet_id, t.text, count(v.is_hateful) as count, v.is_hateful from tweets t right join votesIsHateful v on t.id = v.tweet_id group by v.tweet_id, v.is_hateful;")
+    offensiveReader = csv.DictReader(runQuery(client, password, "select v.tweet_id, t.text, count(v.is_offensive) as count, v.is_offensive from tweets t right join votesIsHateful v on t.id = v.tweet_id group by v.tweet_id, v.is_offensive;"), delimiter="\t")
+    hateTypesReader = csv.DictReader(runQuery(client, password, "select v.tweet_id, t.text, count(v.hate_type) as count, v.hate_type from tweets t right join votesHateType v on t.id = v.tweet_id group by v.tweet_id, v.hate_type;"), delimiter="\t")
+
+    valueCounts = {'hate': {}, 'offensive': {}, 'hateTypes': {}}
+    texts = {}
+
+    for line in csv.DictReader(hateLines, delimiter="\t"):
         if line['tweet_id'] not in valueCounts['hate']:
-            valueCounts['hate'][line['tweet_id']] = [0,0]
+            valueCounts['hate'][line['tweet_id']] = emptyCounts('hate')
+            texts[line['tweet_id']] = line['text']
         valueCounts['hate'][line['tweet_id']][int(line['is_hateful'])] = int(line['count'])
 
     for line in offensiveReader:
         if line['tweet_id'] not in valueCounts['offensive']:
-            valueCounts['offensive'][line['tweet_id']] = [0,0]
+            valueCounts['offensive'][line['tweet_id']] = emptyCounts('offensive')
         valueCounts['offensive'][line['tweet_id']][int(line['is_offensive'])] = int(line['count'])
 
     for line in hateTypesReader:
         if line['tweet_id'] not in valueCounts['hateTypes']:
-            valueCounts['hateTypes'][line['tweet_id']] = {'racism': 0, 'political': 0, 'homophobia': 0, 'misoginy': 0, 'other': 0}
+            valueCounts['hateTypes'][line['tweet_id']] = emptyCounts('hateTypes')
         valueCounts['hateTypes'][line['tweet_id']][line['hate_type']] = int(line['count'])
-    
-    tsvFile.seek(0)
-    next(tsvFile)
-    
-    with open("db_data/ambiguous.json", "w") as ambiguousJson:
-        with open('datasets/idors.tsv', 'w') as idorsFile:
-            fieldNames = ['id',	'text', 'HS', 'OF', 'HT']
-            writer = csv.DictWriter(idorsFile, fieldnames=fieldNames, delimiter="\t")
+
+    return hateLines, valueCounts, texts
+
+def main():
+    dataFileName = sys.argv[1]
+
+    client = connect(sys.argv[2])
+    hateLines, valueCounts, texts = fetchCounts(client, sys.argv[3])
+    client.close()
+
+    with open(dataFileName, "w") as tsvFile:
+        tsvFile.writelines(hateLines)
+
+    desambigEntries = readDesambiguation()
+
+    countAmbiguous = 0
+    with open(AMBIGUOUS_FILE, "w") as ambiguousJson:
+        with open(IDORS_FILE, 'w') as idorsFile:
+            writer = csv.DictWriter(idorsFile, fieldnames=FIELD_NAMES, delimiter="\t")
             writer.writeheader()
-            
-            for line in tsvReader:
-                if line['tweet_id'] in ids:
-                    continue
-                
-                ids.add(line['tweet_id'])
-                labelHate = determineHateLabel(line['tweet_id'], line['text'], valueCounts['hate'][line['tweet_id']], desambigEntries, ambiguousJson)
-                if labelHate == -1:
+
+            # texts keeps the order in which tweets first show up in the hate query
+            for tweet_id, tweet_text in texts.items():
+                row = labelTweet(tweet_id, tweet_text, valueCounts, desambigEntries, ambiguousJson)
+                if row is None:
                     countAmbiguous += 1
                     continue
 
-                labelOffensive = None
-                if line['tweet_id'] in valueCounts['offensive']:
-                    labelOffensive = determineOffensiveLabel(line['tweet_id'], line['text'], valueCounts['offensive'][line['tweet_id']], desambigEntries)
-                else:
-                    labelOffensive = "N/A"
-
-                if labelHate == 1:
-                    labelHateType = None
-                    if line['tweet_id'] in valueCounts['hateTypes']:
-                        labelHateType = determineHateTypeLabel(line['tweet_id'], line['text'], valueCounts['hateTypes'][line['tweet_id']], desambigEntries)
-                    else:
-                        labelHateType = "N/A"
-                else:
-                    labelHateType = "N/A"
-
-                writer.writerow({'id': line['tweet_id'], 'text': line['text'], 'HS': str(labelHate), 'OF': str(labelOffensive), 'HT': labelHateType})
-            
-
-print("\nAmbiguous:", countAmbiguous)
-print("\nKrippendorff:", krippendorff.alpha(value_counts=np.array(list(valueCounts['hate'].values())), level_of_measurement='nominal'))
\ No newline at end of file
+                writer.writerow(row)
+
+    print("\nAmbiguous:", countAmbiguous)
+    print("\nKrippendorff:", krippendorff.alpha(value_counts=np.array(list(valueCounts['hate'].values())), level_of_measurement='nominal'))
+
+if __name__ == "__main__":
+    main()
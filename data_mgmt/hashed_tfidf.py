@@ -0,0 +1,153 @@
+import numpy as np
+import scipy.sparse as sp
+
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from sklearn.decomposition import TruncatedSVD
+from sklearn.feature_extraction.text import HashingVectorizer
+from sklearn.preprocessing import normalize
+from cli import get_option, require_manifest
+
+N_FEATURES = 2 ** 18
+CHUNK_SIZE = 5000
+
+def _hash_chunk(args):
+    hasher, tweets = args
+    return hasher.transform(tweets).tocsr()
+
+def _chunk_document_frequencies(args):
+    X = _hash_chunk(args)
+    return np.bincount(X.indices, minlength=X.shape[1])
+
+class HashedTfidfVectorizer:
+    # Stand-in for TfidfVectorizer without a vocabulary: n-grams are hashed
+    # into n_features columns and the document frequencies are accumulated
+    # chunk by chunk, so memory doesn't grow with the vocabulary and new
+    # words never require a refit
+    def __init__(self, n_features=N_FEATURES, ngram_range=(1, 1), workers=1, chunk_size=CHUNK_SIZE):
+        self.hasher = HashingVectorizer(n_features=n_features, ngram_range=ngram_range,
+                                        alternate_sign=False, norm=None)
+        self.n_features = n_features
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.document_frequencies = np.zeros(n_features, dtype=np.int64)
+        self.num_documents = 0
+
+    def __getstate__(self):
+        # Saved embedders are loaded in processes with their own worker count
+        state = dict(self.__dict__)
+        state['workers'] = 1
+        return state
+
+    def _map(self, function, tweets):
+        chunks = [(self.hasher, tweets[i:i + self.chunk_size]) for i in range(0, len(tweets), self.chunk_size)]
+        if self.workers == 1 or len(chunks) == 1:
+            return [function(c) for c in chunks]
+        # Callers have TensorFlow loaded, which doesn't survive a fork
+        with ProcessPoolExecutor(max_workers=self.workers, mp_context=get_context('spawn')) as pool:
+            return list(pool.map(function, chunks))
+
+    def partial_fit(self, tweets):
+        # Streaming IDF: only document counts are kept
+        for frequencies in self._map(_chunk_document_frequencies, list(tweets)):
+            self.document_frequencies += frequencies
+        self.num_documents += len(tweets)
+        return self
+
+    def fit(self, tweets):
+        self.document_frequencies[:] = 0
+        self.num_documents = 0
+        return self.partial_fit(tweets)
+
+    def idf(self):
+        # Same smoothing as TfidfVectorizer(smooth_idf=True)
+        return np.log((1 + self.num_documents) / (1 + self.document_frequencies)) + 1
+
+    def transform(self, tweets):
+        chunks = self._map(_hash_chunk, list(tweets))
+        X = sp.vstack(chunks).tocsr() if chunks else sp.csr_matrix((0, self.n_features))
+        return normalize(X @ sp.diags(self.idf()), norm='l2', copy=False)
+
+    def fit_transform(self, tweets):
+        return self.fit(tweets).transform(tweets)
+
+class ColumnSubsetSVD:
+    # TruncatedSVD over the hashed columns that show up in the fit data. Over
+    # all n_features columns its components alone would take n_components * 2^18 floats.
+    def __init__(self, n_components):
+        self.n_components = n_components
+        self.svd = TruncatedSVD(n_components=n_components)
+
+    def fit(self, X):
+        self.columns = np.flatnonzero(X.getnnz(axis=0))
+        self.svd.fit(X[:, self.columns])
+        return self
+
+    def transform(self, X):
+        return self.svd.transform(X[:, self.columns])
+
+#### TF-IDF comparison ####
+COMPARISON_FILE = 'datasets/sent_vectorizers.json'
+MODES = [('tfidf', 'svd'), ('hashing', 'svd'), ('hashing', 'random')]
+
+def compare(tweets, labels, folds, workers=1, modes=MODES):
+    # Fit and transform time, size of the vectorizer state and k-fold F-score
+    # of a linear SVM over the sentence vectors alone
+    import pickle, time
+    from sklearn.metrics import f1_score
+    from sklearn.pipeline import make_pipeline
+    from sklearn.preprocessing import StandardScaler
+    from sklearn.svm import LinearSVC
+    from data_mgmt.data_mgmt import fit_sent_embedder, transform_additional_embeddings
+
+    results = []
+    for vectorizer, reduction in modes:
+        start = time.perf_counter()
+        sent_embedder = fit_sent_embedder(tweets, vectorizer, reduction, workers)
+        fit_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        vectors = transform_additional_embeddings(tweets, sent_embedder)
+        transform_seconds = time.perf_counter() - start
+
+        fscores = []
+        for train_index, val_index in folds:
+            clf = make_pipeline(StandardScaler(), LinearSVC(random_state=0, tol=1e-5, max_iter=50000))
+            clf.fit(vectors[train_index], labels[train_index])
+            fscores.append(f1_score(labels[val_index], clf.predict(vectors[val_index])))
+
+        results.append({
+            'vectorizer': vectorizer,
+            'reduction': reduction,
+            'fit_seconds': fit_seconds,
+            'tweets_per_second': len(tweets) / max(transform_seconds, 1e-12),
+            'vectorizer_bytes': len(pickle.dumps(sent_embedder[0])),
+            'fscore': float(np.mean(fscores)),
+            'fscore_std': float(np.std(fscores)),
+        })
+    return results
+
+if __name__ == "__main__":
+    # Usage: python -m data_mgmt.hashed_tfidf [--workers N]
+    import os, json, configparser
+    from data_mgmt.splits import load_split, fold_splits
+
+    config = configparser.ConfigParser()
+    config.read('conf.txt')
+    os.environ['LANGUAGE'] = config['GENERAL']['LANGUAGE']
+
+    manifest = require_manifest(config)
+
+    workers = int(get_option('--workers', os.cpu_count()))
+    rows = load_split('all', manifest)
+    results = compare([r['pretext'] for r in rows], np.asarray([int(r['HS']) for r in rows]),
+                      list(fold_splits(manifest)), workers)
+
+    with open(COMPARISON_FILE, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    print('{:<16} {:>8} {:>12} {:>12} {:>16}'.format('mode', 'fit s', 'tweets/s', 'state KB', 'F1'))
+    for r in results:
+        print('{:<16} {:>8.2f} {:>12.0f} {:>12.0f} {:>8.4f} ±{:.4f}'.format(
+            r['vectorizer'] + '+' + r['reduction'], r['fit_seconds'], r['tweets_per_second'],
+            r['vectorizer_bytes'] / 1024, r['fscore'], r['fscore_std']))
@@ -0,0 +1,151 @@
+import os, re, sys, csv, time, configparser
+import unidecode, nltk
+
+from functools import lru_cache
+from nltk.corpus import stopwords
+from preprocessor.preprocess import Preprocess
+
+# preprocessor option names, see preprocessor.OPT
+TWEET_OPTIONS = ('mentions', 'urls', 'emojis', 'hashtags')
+NUMBER_OPTIONS = ('numbers',)
+
+NEWLINE_PATTERN = re.compile(r'\\n')
+GLUED_URL_PATTERN = re.compile(r'(\S)(https?):')
+TOKEN_SPACES_PATTERN = re.compile(r'\$ ([A-Z]+?) \$')
+EXCLAMATION_PATTERN = re.compile(r'([!¡]\s?){3,}')
+QUESTION_PATTERN = re.compile(r'([¿?]\s?){3,}')
+ELLIPSIS_PATTERN = re.compile(r'(\.\s?){3,}')
+LOL_PATTERN = re.compile(r'\b(?:a*(?:(h+|j+)a+|s+)+(h+|j+)?|(?:l+o+)+l+)\b', re.I)
+WORD_SYMBOL_PATTERN = re.compile(r'([\w\d]+)([^\w\d ]+)')
+SYMBOL_WORD_PATTERN = re.compile(r'([^\w\d ]+)([\w\d]+)')
+
+class TweetCleaner:
+    # Same as preprocessor.clean/preprocessor.tokenize, but the options belong
+    # to the instance instead of the module-wide p.set_options state
+    def __init__(self, options):
+        self.preprocess = Preprocess()
+        # preprocessor walks its methods in dir() order, i.e. alphabetically
+        self.methods = [(getattr(self.preprocess, 'preprocess_' + option), '$' + option.upper()[:-1] + '$')
+                        for option in sorted(options)]
+
+    def clean(self, tweet):
+        for method, _ in self.methods:
+            tweet = method(tweet, '')
+        return ' '.join(tweet.split())
+
+    def tokenize(self, tweet):
+        for method, token in self.methods:
+            tweet = method(tweet, token)
+        return ' '.join(tweet.split())
+
+class TweetNormalizer:
+    def __init__(self, language=None):
+        if language is None:
+            language = os.getenv('LANGUAGE')
+
+        self.stop_words = frozenset(stopwords.words(language))
+        self.tokenizer = nltk.tokenize.TweetTokenizer()
+        self.tweet_cleaner = TweetCleaner(TWEET_OPTIONS)
+        self.number_cleaner = TweetCleaner(NUMBER_OPTIONS)
+
+    def normalize(self, tweet):
+        prefix = self._prefix(tweet)
+        return self._pretext(prefix), self._bert_text(prefix)
+
+    def preprocess(self, tweet):
+        return self._pretext(self._prefix(tweet))
+
+    def bert_preprocess(self, tweet):
+        return self._bert_text(self._prefix(tweet))
+
+    def _prefix(self, tweet):
+        tweet = tweet.lower()
+        tweet = NEWLINE_PATTERN.sub(' ', tweet)
+        return GLUED_URL_PATTERN.sub(r'\1 \2:', tweet)
+
+    def _pretext(self, tweet):
+        tweet = self.tweet_cleaner.tokenize(tweet)
+
+        tweet = ' '.join(self.tokenizer.tokenize(tweet))
+        tweet = TOKEN_SPACES_PATTERN.sub(r'$\1$', tweet)
+
+        ### Stopwords removal ###
+        tweet = ' '.join(w for w in tweet.split(' ') if w not in self.stop_words)
+
+        tweet = unidecode.unidecode(tweet)
+
+        tweet = self.number_cleaner.tokenize(tweet)
+        tweet = EXCLAMATION_PATTERN.sub(r' $EXCLAMATION$ ', tweet)
+        tweet = QUESTION_PATTERN.sub(r' $QUESTION$ ', tweet)
+        tweet = ELLIPSIS_PATTERN.sub(r' $ELLIPSIS$ ', tweet)
+        return LOL_PATTERN.sub(r' $LOL$ ', tweet)
+
+    def _bert_text(self, tweet):
+        tweet = self.tweet_cleaner.clean(tweet)
+
+        tweet = unidecode.unidecode(tweet)
+        tweet = WORD_SYMBOL_PATTERN.sub(r'\1 \2', tweet)
+        return SYMBOL_WORD_PATTERN.sub(r'\1 \2', tweet)
+
+@lru_cache(maxsize=None)
+def get_normalizer(language=None):
+    return TweetNormalizer(language)
+
+#### Golden output check and latency benchmark ####
+def read_tweets(dataset_file):
+    with open(dataset_file) as tsvfile:
+        reader = csv.DictReader(tsvfile, dialect='excel-tab')
+        return [r['text'] for r in reader]
+
+def check(tweets, normalizer):
+    from data_mgmt.data_mgmt import preprocess, bert_preprocess
+
+    mismatches = 0
+    for tweet in tweets:
+        pretext, bert_text = normalizer.normalize(tweet)
+        expected_pretext, expected_bert_text = preprocess(tweet), bert_preprocess(tweet)
+        if pretext != expected_pretext or bert_text != expected_bert_text:
+            mismatches += 1
+            print('Mismatch for:', tweet)
+            print('  preprocess:      ', repr(expected_pretext), '!=', repr(pretext))
+            print('  bert_preprocess: ', repr(expected_bert_text), '!=', repr(bert_text))
+
+    return mismatches
+
+def benchmark(tweets, normalizer):
+    from data_mgmt.data_mgmt import preprocess, bert_preprocess
+
+    start = time.perf_counter()
+    for tweet in tweets:
+        preprocess(tweet)
+        bert_preprocess(tweet)
+    old_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for tweet in tweets:
+        normalizer.normalize(tweet)
+    new_time = time.perf_counter() - start
+
+    return 1e6 * old_time / len(tweets), 1e6 * new_time / len(tweets)
+
+if __name__ == "__main__":
+    # Usage: python -m data_mgmt.normalize [--check] [--benchmark] [dataset.tsv]
+    config = configparser.ConfigParser()
+    config.read('conf.txt')
+    os.environ['LANGUAGE'] = config['GENERAL']['LANGUAGE']
+
+    files = [a for a in sys.argv[1:] if not a.startswith('--')]
+    dataset_file = files[0] if files else 'datasets/' + config['GENERAL']['DATASET_NAME']
+    tweets = read_tweets(dataset_file)
+    normalizer = get_normalizer()
+
+    if '--check' in sys.argv:
+        mismatches = check(tweets, normalizer)
+        print(f'{mismatches} of {len(tweets)} tweets differ from preprocess/bert_preprocess')
+        if mismatches:
+            exit(1)
+
+    if '--benchmark' in sys.argv:
+        old_us, new_us = benchmark(tweets, normalizer)
+        print(f'preprocess + bert_preprocess: {old_us:.1f} us/tweet')
+        print(f'TweetNormalizer.normalize:    {new_us:.1f} us/tweet ({old_us / new_us:.1f}x)')
@@ -0,0 +1,137 @@
+import time
+import numpy as np
+
+from tensorflow import keras
+
+# conv_tass uses kernels up to 4 words wide with 'valid' padding
+MIN_LENGTH = 4
+
+def corpus_max_words(texts, percentile=99):
+    lengths = [len(text.split()) for text in texts]
+    return max(1, int(np.ceil(np.percentile(lengths, percentile))))
+
+class RaggedDataset:
+    def __init__(self, texts, ft_model, max_words):
+        self.max_words = max_words
+
+        # Every distinct word is embedded once, examples only keep word ids
+        self.vocabulary = sorted(set(w for text in texts for w in text.split()))
+        word_ids = {w: i for i, w in enumerate(self.vocabulary)}
+        self.table = np.asarray([ft_model.get_word_vector(w) for w in self.vocabulary], dtype=np.float32)
+        if len(self.vocabulary) == 0:
+            self.table = np.zeros((0, ft_model.get_dimension()), dtype=np.float32)
+
+        lengths = np.asarray([min(len(text.split()), max_words) for text in texts], dtype=np.int64)
+        self.offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+        self.offsets[1:] = np.cumsum(lengths)
+        self._lengths = lengths
+
+        self.tokens = np.empty(self.offsets[-1], dtype=np.int32)
+        for i, text in enumerate(texts):
+            words = text.split()[:max_words]
+            self.tokens[self.offsets[i]:self.offsets[i + 1]] = [word_ids[w] for w in words]
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def dimension(self):
+        return self.table.shape[1]
+
+    def lengths(self):
+        return self._lengths
+
+    def word_vectors(self, index):
+        return self.table[self.tokens[self.offsets[index]:self.offsets[index + 1]]]
+
+    def padded(self, indices, length=None):
+        if length is None:
+            length = max(MIN_LENGTH, int(self.lengths()[indices].max()))
+        result = np.zeros((len(indices), length, self.dimension()), dtype=np.float32)
+        for row, index in enumerate(indices):
+            vecs = self.word_vectors(index)[:length]
+            result[row, :len(vecs)] = vecs
+        return result
+
+def default_boundaries(max_words, width=4):
+    return list(range(width, max_words + 1, width))
+
+class LengthBucketSequence(keras.utils.Sequence):
+    def __init__(self, ragged, indices, extra_inputs=None, labels=None, batch_size=32,
+                 shuffle=True, boundaries=None, seed=0, length=None):
+        self.ragged = ragged
+        # Padded length of every batch, None pads each batch to its longest tweet
+        self.length = length
+        self.indices = np.asarray(indices)
+        self.extra_inputs = extra_inputs if extra_inputs is not None else []
+        self.labels = labels
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.rng = np.random.default_rng(seed)
+
+        if boundaries is None:
+            boundaries = default_boundaries(ragged.max_words)
+        self.lengths = ragged.lengths()[self.indices]
+        self.buckets = np.digitize(self.lengths, boundaries)
+
+        self._make_batches()
+
+    def _make_batches(self):
+        # Positions are sorted by length so every batch is padded only up to
+        # its longest tweet. When shuffling, tweets are mixed inside each
+        # length bucket and batches are visited in random order.
+        if self.shuffle:
+            positions = []
+            for bucket in np.unique(self.buckets):
+                members = np.flatnonzero(self.buckets == bucket)
+                positions.append(self.rng.permutation(members))
+            batches = [p[i:i + self.batch_size] for p in positions for i in range(0, len(p), self.batch_size)]
+            self.rng.shuffle(batches)
+        else:
+            order = np.argsort(self.lengths, kind='stable')
+            batches = [order[i:i + self.batch_size] for i in range(0, len(order), self.batch_size)]
+
+        self.batches = batches
+        self.order = np.concatenate(batches) if batches else np.zeros(0, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __getitem__(self, index):
+        rows = self.indices[self.batches[index]]
+        inputs = [self.ragged.padded(rows, self.length)] + [extra[rows] for extra in self.extra_inputs]
+
+        if self.labels is None:
+            return (inputs,)
+        return inputs, self.labels[rows]
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            self._make_batches()
+
+    def restore_order(self, predictions):
+        result = np.empty_like(predictions)
+        result[self.order] = predictions
+        return result
+
+    def cost_ratio(self, fixed_length):
+        padded_steps = sum(len(b) * max(MIN_LENGTH, int(self.lengths[b].max())) for b in self.batches)
+        return padded_steps / (len(self.indices) * fixed_length)
+
+def epoch_seconds(model, sequence):
+    # Wall time of one epoch of train steps over sequence. A first, untimed
+    # epoch traces the step for every batch shape.
+    for _ in range(2):
+        start = time.perf_counter()
+        for index in range(len(sequence)):
+            model.train_on_batch(*sequence[index])
+        sequence.on_epoch_end()
+    return time.perf_counter() - start
+
+def compare_epoch_times(make_model, ragged, indices, extra_inputs, labels, batch_size, fixed_length):
+    # Seconds per training epoch with every batch padded to fixed_length and
+    # with batches padded to their longest tweet, each on a scratch model
+    times = {}
+    for name, length in [('padded', fixed_length), ('ragged', None)]:
+        sequence = LengthBucketSequence(ragged, indices, extra_inputs, labels, batch_size, length=length)
+        times[name] = epoch_seconds(make_model(), sequence)
+    return times
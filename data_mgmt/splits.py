@@ -0,0 +1,244 @@
+import os, csv, json, hashlib
+import numpy as np
+
+from math import floor
+from sklearn.model_selection import StratifiedKFold, StratifiedGroupKFold
+
+from data_mgmt.normalize import get_normalizer
+
+PP_FILE = 'datasets/idorsPP.tsv'
+MANIFEST_FILE = 'datasets/split_manifest.json'
+DUPLICATES_FILE = 'datasets/duplicates.json'
+PP_FIELDS = ['id', 'HS', 'OF', 'HT', 'text', 'pretext', 'btext']
+SPLIT_SEED = 1234
+
+FASTTEXT_FILES = {'training': 'training_set.txt', 'test': 'test_set.txt'}
+
+# What to do with the near-duplicate clusters found by data_mgmt.dedup:
+# nothing, keep one tweet per cluster, keep one with the votes of the whole
+# cluster, or keep every tweet of a cluster on the same side of every split
+DEDUP_MODES = ['none', 'drop', 'collapse', 'group']
+
+#### Preprocessed store ####
+def read_rows(filename):
+    if not os.path.exists(filename):
+        return []
+    with open(filename) as tsvfile:
+        return list(csv.DictReader(tsvfile, dialect='excel-tab'))
+
+def write_atomic(filename, write):
+    tmp_file = filename + '.tmp'
+    with open(tmp_file, 'w') as f:
+        write(f)
+    os.replace(tmp_file, filename)
+
+def write_if_changed(filename, content):
+    # Leaves the file (and its mtime) alone when nothing changed
+    if os.path.exists(filename):
+        with open(filename) as f:
+            if f.read() == content:
+                return False
+    write_atomic(filename, lambda f: f.write(content))
+    return True
+
+def preprocess_dataset(dataset_tsv_file, language, pp_file=PP_FILE, rebuild=False):
+    # Normalizes only the tweets whose id or text is not in the store yet
+    stored = read_rows(pp_file)
+    previous = {} if rebuild else {(r['id'], r['text']): r for r in stored if 'btext' in r}
+    normalizer = get_normalizer(language)
+
+    rows = []
+    normalized = 0
+    for r in read_rows('datasets/' + dataset_tsv_file):
+        cached = previous.get((r['id'], r['text']))
+        if cached:
+            pretext, btext = cached['pretext'], cached['btext']
+        else:
+            pretext, btext = normalizer.normalize(r['text'])
+            normalized += 1
+        rows.append({'id': r['id'], 'HS': r['HS'], 'OF': r['OF'], 'HT': r['HT'], 'text': r['text'],
+                     'pretext': pretext, 'btext': btext})
+
+    if rows != stored:
+        def write(f):
+            writer = csv.DictWriter(f, fieldnames=PP_FIELDS, delimiter="\t")
+            writer.writeheader()
+            writer.writerows(rows)
+        write_atomic(pp_file, write)
+
+    return rows, normalized
+
+def content_hash(rows):
+    h = hashlib.sha1()
+    for r in sorted(rows, key=lambda r: r['id']):
+        for field in PP_FIELDS:
+            h.update(r[field].encode('utf-8'))
+            h.update(b'\0')
+    return h.hexdigest()
+
+#### Manifest ####
+def seeded_order(ids, seed, groups=None):
+    # Every id gets a fixed pseudo-random key, so adding or removing tweets
+    # doesn't move the others around. Ids of the same group share the key.
+    groups = groups or {}
+    key = lambda i: (hashlib.sha1(f'{seed}:{groups.get(i, i)}'.encode('utf-8')).hexdigest(), i)
+    return sorted(ids, key=key)
+
+def assign_splits(manifest, labels, training_set_ratio, num_folds):
+    order = manifest['order']
+    groups = manifest.get('groups') or {}
+    group = lambda i: groups.get(i, i)
+
+    split_index = floor(training_set_ratio * len(order))
+    # Groups are contiguous in the order, the cut is moved past the one it falls in
+    while 0 < split_index < len(order) and group(order[split_index]) == group(order[split_index - 1]):
+        split_index += 1
+    manifest['training_set_ratio'] = training_set_ratio
+    manifest['num_folds'] = num_folds
+    manifest['training'] = order[:split_index]
+    manifest['test'] = order[split_index:]
+
+    # k-fold runs go over training + test, in that order
+    dataset_ids = manifest['training'] + manifest['test']
+    folds = np.zeros(len(dataset_ids), dtype=int)
+    y = [labels[i] for i in dataset_ids]
+    if groups:
+        kfold = StratifiedGroupKFold(num_folds, shuffle=True, random_state=manifest['seed'])
+        fold_indices = kfold.split(np.zeros(len(y)), y, [group(i) for i in dataset_ids])
+    else:
+        kfold = StratifiedKFold(num_folds, shuffle=True, random_state=manifest['seed'])
+        fold_indices = kfold.split(np.zeros(len(y)), y)
+    for fold, (_, val_index) in enumerate(fold_indices):
+        folds[val_index] = fold
+    manifest['folds'] = folds.tolist()
+
+    return manifest
+
+#### Near duplicates ####
+def load_duplicates(filename=DUPLICATES_FILE):
+    if not os.path.exists(filename):
+        return None
+    with open(filename) as f:
+        return json.load(f)
+
+def apply_dedup(ids, duplicates, dedup_mode):
+    # Ids to keep, group of every clustered id and label overrides. Clusters
+    # list their representative first.
+    if dedup_mode == 'none':
+        return ids, {}, {}
+    if dedup_mode not in DEDUP_MODES:
+        raise ValueError('Unknown DEDUP_MODE {}, use one of {}'.format(dedup_mode, ', '.join(DEDUP_MODES)))
+    if duplicates is None:
+        raise ValueError('DEDUP_MODE is {} but {} is missing, run python -m data_mgmt.dedup first'.format(
+            dedup_mode, DUPLICATES_FILE))
+
+    present = set(ids)
+    groups = {}
+    for cluster in duplicates['clusters']:
+        members = [i for i in cluster if i in present]
+        for i in members:
+            groups[i] = members[0]
+
+    if dedup_mode == 'group':
+        return ids, groups, {}
+
+    overrides = {}
+    if dedup_mode == 'collapse':
+        # Merged labels are None for clusters whose merged votes are tied
+        merged = duplicates['merged']
+        overrides = {rep: merged[rep] for rep in set(groups.values()) if rep in merged}
+    kept = [i for i in ids if groups.get(i, i) == i and overrides.get(i, True) is not None]
+    return kept, {}, {i: o for i, o in overrides.items() if o is not None}
+
+def build_manifest(rows, training_set_ratio, num_folds, language, seed=SPLIT_SEED, dedup_mode='none'):
+    # Tweets left empty by preprocessing are not part of any split
+    usable = [r for r in rows if r['pretext'] != ""]
+    duplicates = load_duplicates() if dedup_mode != 'none' else None
+    ids, groups, overrides = apply_dedup([r['id'] for r in usable], duplicates, dedup_mode)
+
+    if duplicates is not None and duplicates['content_hash'] != content_hash(usable):
+        print("Warning: {} was built for a different dataset, new tweets are not deduplicated".format(DUPLICATES_FILE))
+
+    labels = {r['id']: r['HS'] for r in usable}
+    labels.update({i: o['HS'] for i, o in overrides.items()})
+    manifest = {
+        'seed': seed,
+        'language': language,
+        'content_hash': content_hash(usable),
+        'dedup_mode': dedup_mode,
+        'groups': groups,
+        'labels': overrides,
+        'order': seeded_order(ids, seed, groups),
+    }
+    return assign_splits(manifest, labels, training_set_ratio, num_folds)
+
+def load_manifest(filename=MANIFEST_FILE):
+    if not os.path.exists(filename):
+        return None
+    with open(filename) as f:
+        return json.load(f)
+
+def save_manifest(manifest, filename=MANIFEST_FILE):
+    return write_if_changed(filename, json.dumps(manifest))
+
+def prepare_splits(dataset_tsv_file, training_set_ratio, num_folds, language, seed=SPLIT_SEED, dedup_mode='none'):
+    previous = load_manifest()
+    rebuild = previous is not None and previous['language'] != language
+    rows, normalized = preprocess_dataset(dataset_tsv_file, language, rebuild=rebuild)
+
+    manifest = build_manifest(rows, training_set_ratio, num_folds, language, seed, dedup_mode)
+    changed = save_manifest(manifest)
+    export_fasttext_files(manifest, rows)
+
+    print(f"{normalized} tweets preprocessed, split manifest {'updated' if changed else 'unchanged'}")
+    return manifest
+
+def get_manifest(training_set_ratio, num_folds, dedup_mode=None):
+    # A new ratio or fold count only reassigns ids, the store is untouched.
+    # dedup_mode None keeps the one the manifest was built with.
+    manifest = load_manifest()
+    if manifest is None:
+        return None
+
+    if dedup_mode is not None and manifest.get('dedup_mode', 'none') != dedup_mode:
+        manifest = build_manifest(read_rows(PP_FILE), training_set_ratio, num_folds, manifest['language'],
+                                  manifest['seed'], dedup_mode)
+        save_manifest(manifest)
+        export_fasttext_files(manifest, read_rows(PP_FILE))
+    elif manifest['training_set_ratio'] != training_set_ratio or manifest['num_folds'] != num_folds:
+        rows = select_rows(manifest['order'], labels=manifest.get('labels'))
+        manifest = assign_splits(manifest, {r['id']: r['HS'] for r in rows}, training_set_ratio, num_folds)
+        save_manifest(manifest)
+        export_fasttext_files(manifest, rows)
+
+    return manifest
+
+#### Row selection ####
+def select_rows(ids, pp_file=PP_FILE, labels=None):
+    # labels overrides the labels of some ids (merged votes of collapsed clusters)
+    rows = {r['id']: r for r in read_rows(pp_file)}
+    labels = labels or {}
+    return [dict(rows[i], **labels[i]) if i in labels else rows[i] for i in ids]
+
+def load_split(split, manifest=None, pp_file=PP_FILE):
+    # 'training', 'test' or 'all' (training followed by test, the k-fold order)
+    manifest = manifest or load_manifest()
+    if split == 'all':
+        return select_rows(manifest['training'] + manifest['test'], pp_file, manifest.get('labels'))
+    return select_rows(manifest[split], pp_file, manifest.get('labels'))
+
+def fold_splits(manifest=None):
+    # (train_index, val_index) pairs over the 'all' rows, like KFold.split
+    manifest = manifest or load_manifest()
+    folds = np.asarray(manifest['folds'])
+    for fold in range(manifest['num_folds']):
+        yield np.flatnonzero(folds != fold), np.flatnonzero(folds == fold)
+
+def export_fasttext_files(manifest, rows):
+    # fasttext reads its training data from files, they are written from the
+    # store and only touched when their content changes
+    labels = manifest.get('labels') or {}
+    rows = {r['id']: dict(r, **labels.get(r['id'], {})) for r in rows}
+    for split, filename in FASTTEXT_FILES.items():
+        content = ''.join('__label__{} {}\n'.format(rows[i]['HS'], rows[i]['pretext']) for i in manifest[split])
+        write_if_changed(filename, content)
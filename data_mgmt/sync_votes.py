@@ -0,0 +1,247 @@
+import sys, os, csv, json, hashlib
+import numpy as np
+
+from data_mgmt import fetch_data
+from data_mgmt.agreement import coincidences, nominal_alpha
+from cli import get_option
+
+STORE_FILE = 'db_data/vote_counts.json'
+# Must be strictly increasing in both vote tables (auto-increment id)
+WATERMARK_COLUMN = 'id'
+ALPHA_TOLERANCE = 1e-9
+
+FAMILIES = ['hate', 'offensive', 'hateTypes']
+VOTE_TABLES = {
+    'votesIsHateful': [('hate', 'is_hateful'), ('offensive', 'is_offensive')],
+    'votesHateType': [('hateTypes', 'hate_type')],
+}
+
+def count_vector(family, counts):
+    if family == 'hateTypes':
+        return np.array([counts[k] for k in fetch_data.HATE_TYPE_KEYS], dtype=np.float64)
+    return np.array(counts, dtype=np.float64)
+
+#### Count store ####
+def file_hash(filename):
+    with open(filename, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def empty_store():
+    return {
+        'watermarks': {table: None for table in VOTE_TABLES},
+        'desambiguation': None,
+        'texts': {},
+        'counts': {family: {} for family in FAMILIES},
+        'coincidences': {family: None for family in FAMILIES},
+    }
+
+def load_store(store_file=STORE_FILE):
+    if not os.path.exists(store_file):
+        return None
+    with open(store_file) as f:
+        return json.load(f)
+
+def write_atomic(filename, write):
+    tmp_file = filename + '.tmp'
+    with open(tmp_file, 'w') as f:
+        write(f)
+    os.replace(tmp_file, filename)
+
+def save_store(store, store_file=STORE_FILE):
+    write_atomic(store_file, lambda f: json.dump(store, f))
+
+def unit_coincidences(family, counts, tweet_ids):
+    rows = [count_vector(family, counts[t]) for t in tweet_ids if t in counts]
+    size = len(fetch_data.HATE_TYPE_KEYS) if family == 'hateTypes' else 2
+    if not rows:
+        return np.zeros((size, size))
+    return coincidences(np.array(rows))
+
+#### Sync ####
+def fetch_new_votes(client, password, store, watermark_column=WATERMARK_COLUMN):
+    # One row per vote, only votes past the table's watermark
+    votes = {}
+    for table, columns in VOTE_TABLES.items():
+        watermark = store['watermarks'][table]
+        where = f"where v.{watermark_column} > '{watermark}'" if watermark is not None else ""
+        value_columns = ", ".join(f"v.{column}" for _, column in columns)
+        query = (f"select v.{watermark_column} as watermark, v.tweet_id, t.text, {value_columns} "
+                 f"from tweets t right join {table} v on t.id = v.tweet_id {where} order by v.{watermark_column};")
+        votes[table] = list(csv.DictReader(fetch_data.runQuery(client, password, query), delimiter="\t"))
+    return votes
+
+def apply_votes(store, votes):
+    for table, rows in votes.items():
+        for row in rows:
+            tweet_id = row['tweet_id']
+            if row['text'] != 'NULL':
+                store['texts'].setdefault(tweet_id, row['text'])
+
+            for family, column in VOTE_TABLES[table]:
+                # count() in the full query skips NULL votes too
+                if row[column] == 'NULL':
+                    continue
+                counts = store['counts'][family].setdefault(tweet_id, fetch_data.emptyCounts(family))
+                if family == 'hateTypes':
+                    counts[row[column]] = counts.get(row[column], 0) + 1
+                else:
+                    counts[int(row[column])] += 1
+
+        if rows:
+            store['watermarks'][table] = rows[-1]['watermark']
+
+class LineCollector:
+    # Stands in for ambiguous.json while relabeling a few tweets
+    def __init__(self):
+        self.lines = []
+
+    def write(self, text):
+        self.lines.append(text)
+
+def relabel(store, tweet_ids, desambigEntries):
+    # Rows for idors.tsv (None for tied tweets) and new ambiguous.json lines
+    collector = LineCollector()
+    rows = {}
+    for tweet_id in tweet_ids:
+        # Only tweets with hate votes are part of the dataset
+        if tweet_id not in store['counts']['hate']:
+            continue
+        rows[tweet_id] = fetch_data.labelTweet(tweet_id, store['texts'].get(tweet_id, 'NULL'), store['counts'],
+                                               desambigEntries, collector)
+    return rows, collector.lines
+
+def read_dataset(idors_file=fetch_data.IDORS_FILE):
+    if not os.path.exists(idors_file):
+        return {}
+    with open(idors_file) as tsvFile:
+        return {row['id']: row for row in csv.DictReader(tsvFile, delimiter="\t")}
+
+def patch_dataset(rows, idors_file=fetch_data.IDORS_FILE):
+    dataset = read_dataset(idors_file)
+    for tweet_id, row in rows.items():
+        if row is None:
+            dataset.pop(tweet_id, None)
+        else:
+            # Existing tweets keep their position, new ones are appended
+            dataset[tweet_id] = row
+
+    def write(f):
+        writer = csv.DictWriter(f, fieldnames=fetch_data.FIELD_NAMES, delimiter="\t")
+        writer.writeheader()
+        writer.writerows(dataset.values())
+
+    write_atomic(idors_file, write)
+    return dataset
+
+def read_ambiguous(ambiguous_file=fetch_data.AMBIGUOUS_FILE):
+    if not os.path.exists(ambiguous_file):
+        return []
+    with open(ambiguous_file) as f:
+        return [line for line in f if line.strip()]
+
+def patch_ambiguous(tweet_ids, new_lines, ambiguous_file=fetch_data.AMBIGUOUS_FILE):
+    lines = [line for line in read_ambiguous(ambiguous_file) if json.loads(line)['tweet_id'] not in tweet_ids]
+    lines.extend(new_lines)
+    write_atomic(ambiguous_file, lambda f: f.writelines(lines))
+
+def update_coincidences(store, family, before, after):
+    o = store['coincidences'][family]
+    o = np.zeros_like(after) if o is None else np.array(o)
+    store['coincidences'][family] = (o - before + after).tolist()
+
+def sync(client, password, store_file=STORE_FILE, watermark_column=WATERMARK_COLUMN):
+    store = load_store(store_file)
+    first_run = store is None
+    if first_run:
+        store = empty_store()
+
+    desambig_hash = file_hash(fetch_data.DESAMBIG_FILE)
+    votes = fetch_new_votes(client, password, store, watermark_column)
+
+    affected = set()
+    for rows in votes.values():
+        affected.update(row['tweet_id'] for row in rows)
+
+    before = {f: unit_coincidences(f, store['counts'][f], affected) for f in FAMILIES}
+    apply_votes(store, votes)
+    after = {f: unit_coincidences(f, store['counts'][f], affected) for f in FAMILIES}
+    for family in FAMILIES:
+        update_coincidences(store, family, before[family], after[family])
+
+    # A new desambiguation file can change any near-tied tweet
+    if store['desambiguation'] != desambig_hash:
+        affected = set(store['counts']['hate'])
+        store['desambiguation'] = desambig_hash
+
+    rows, ambiguous_lines = relabel(store, affected, fetch_data.readDesambiguation())
+
+    if first_run:
+        for filename in [fetch_data.IDORS_FILE, fetch_data.AMBIGUOUS_FILE]:
+            if os.path.exists(filename):
+                os.remove(filename)
+    patch_dataset(rows)
+    patch_ambiguous(affected, ambiguous_lines)
+    save_store(store, store_file)
+
+    new_votes = sum(len(rows) for rows in votes.values())
+    print(f"{new_votes} new votes, {len(affected)} tweets relabeled")
+    print("Ambiguous:", sum(row is None for row in rows.values()), "of the relabeled tweets")
+    for family in FAMILIES:
+        print(f"Krippendorff ({family}):", nominal_alpha(store['coincidences'][family]))
+
+    return store
+
+def check(client, password, store_file=STORE_FILE):
+    # Full recompute from grouped counts in the database, compared against the
+    # count store, the patched files and the incremental alpha
+    import krippendorff
+
+    store = load_store(store_file)
+    _, valueCounts, texts = fetch_data.fetchCounts(client, password)
+    ok = True
+
+    for family in FAMILIES:
+        full = {t: c for t, c in valueCounts[family].items() if sum(count_vector(family, c)) > 0}
+        stored = {t: c for t, c in store['counts'][family].items() if sum(count_vector(family, c)) > 0}
+        if full != stored:
+            ok = False
+            differing = {t for t in set(full) | set(stored) if full.get(t) != stored.get(t)}
+            print(f"Counts ({family}): {len(differing)} tweets differ, e.g. {sorted(differing)[:5]}")
+
+        matrix = np.array([count_vector(family, c) for c in full.values()])
+        full_alpha = krippendorff.alpha(value_counts=matrix, level_of_measurement='nominal')
+        incremental_alpha = nominal_alpha(store['coincidences'][family])
+        print(f"Krippendorff ({family}): full {full_alpha}, incremental {incremental_alpha}")
+        if abs(full_alpha - incremental_alpha) > ALPHA_TOLERANCE:
+            ok = False
+
+    collector = LineCollector()
+    desambigEntries = fetch_data.readDesambiguation()
+    expected = {}
+    for tweet_id, tweet_text in texts.items():
+        row = fetch_data.labelTweet(tweet_id, tweet_text, valueCounts, desambigEntries, collector)
+        if row is not None:
+            expected[tweet_id] = row
+
+    dataset = read_dataset()
+    if expected != dataset:
+        ok = False
+        differing = {t for t in set(expected) | set(dataset) if expected.get(t) != dataset.get(t)}
+        print(f"{fetch_data.IDORS_FILE}: {len(differing)} rows differ, e.g. {sorted(differing)[:5]}")
+
+    if sorted(collector.lines) != sorted(read_ambiguous()):
+        ok = False
+        print(f"{fetch_data.AMBIGUOUS_FILE} differs from a full recompute")
+
+    print("Check passed" if ok else "Check failed, run fetch_data.py and remove the count store to rebuild")
+    return ok
+
+if __name__ == "__main__":
+    # Usage: python -m data_mgmt.sync_votes <ssh_user> <db_password> [--check] [--watermark-column id]
+    client = fetch_data.connect(sys.argv[1])
+    try:
+        sync(client, sys.argv[2], watermark_column=get_option('--watermark-column', WATERMARK_COLUMN))
+        if '--check' in sys.argv:
+            check(client, sys.argv[2])
+    finally:
+        client.close()
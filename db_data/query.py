@@ -1,84 +1,202 @@
-import sys
-import paramiko
+import sys, os, csv, json, time, queue, shlex, subprocess
 
-def main():
-    username = sys.argv[1]
-    password = sys.argv[2]
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+HOST = 'odioelodio.com'
+DATABASE = 'pgodio'
+# sshd allows 10 sessions per connection by default
+CHANNELS_PER_CONNECTION = 8
+
+QUERIES = {
+    "hateful": """select tweet_id, count(*) as cnt, sum(is_hateful) as cnt_hate, count(*) - sum(is_hateful) as cnt_not_hate, text
+                  from votesIsHateful join tweets on id = tweet_id group by tweet_id having cnt_hate - cnt_not_hate > 1;""",
+    "hatefulCount": """select count(*) from (select tweet_id, sum(is_hateful) as cnt_hate, count(*) - sum(is_hateful) as cnt_not_hate, text
+                       from votesIsHateful join tweets on id = tweet_id group by tweet_id having cnt_hate - cnt_not_hate > 1) as t1;""",
+    "nonhateful": """select tweet_id, count(*) as cnt, sum(is_hateful) as cnt_hate, count(*) - sum(is_hateful) as cnt_not_hate, text
+                     from votesIsHateful join tweets on id = tweet_id group by tweet_id having cnt_not_hate - cnt_hate > 1;""",
+    "nonhatefulCount": """select count(*) from (select tweet_id, sum(is_hateful) as cnt_hate, count(*) - sum(is_hateful) as cnt_not_hate, text
+                          from votesIsHateful join tweets on id = tweet_id group by tweet_id having cnt_not_hate - cnt_hate > 1) as t1;""",
+    "ambiguous": """select tweet_id, count(*) as cnt, sum(is_hateful) as cnt_hate, count(*) - sum(is_hateful) as cnt_not_hate, text
+                    from votesIsHateful join tweets on id = tweet_id group by tweet_id having abs(cnt_hate - cnt_not_hate) <= 1;""",
+    "ambiguousCount": """select count(*) from (select tweet_id, sum(is_hateful) as cnt_hate, count(*) - sum(is_hateful) as cnt_not_hate
+                         from votesIsHateful group by tweet_id having abs(cnt_hate - cnt_not_hate) <= 1) as t1;""",
+    "offensive": """select tweet_id, count(*) as cnt, sum(is_hateful) as cnt_hate, count(*) - sum(is_hateful) as cnt_not_hate, sum(is_offensive), text
+                    from votesIsHateful join tweets on id = tweet_id group by tweet_id having sum(is_offensive) > 0;""",
+    "hateTypes": """select tweet_id, hate_type, count(*), text
+                    from tweets join votesHateType on tweets.id = tweet_id group by tweet_id, text, hate_type order by tweet_id;""",
+    "skipped": "select id, skip_count, text from tweets where skip_count > 0 order by skip_count DESC;",
+    "skippedCount": "select count(*) from (select id, skip_count from tweets where skip_count > 0) as t1;",
+    "unlabeled": "select id, text from tweets where id not in (select distinct tweet_id from votesIsHateful);",
+    "unlabeledCount": "select count(*) from tweets where id not in (select distinct tweet_id from votesIsHateful);",
+    "tweetCount": "select count(*) from tweets;",
+    "totalVoteCount": "select count(*) from votesIsHateful;",
+    "votedTweets": "select count(distinct tweet_id) from votesIsHateful;",
+}
+
+class SSHTransport:
+    # Runs mysql over a few SSH connections, each multiplexing several
+    # channels. Every free channel is a slot in the queue.
+    def __init__(self, username, password, connections=1, channels=CHANNELS_PER_CONNECTION, host=HOST):
+        # Not needed by LocalTransport
+        import paramiko
+
+        self.password = password
+        self.clients = []
+        self.slots = queue.Queue()
+
+        for _ in range(connections):
+            client = paramiko.SSHClient()
+            client.load_system_host_keys()
+            client.connect(host, username=username)
+            self.clients.append(client)
+            for _ in range(channels):
+                self.slots.put(client)
+
+        self.size = connections * channels
+
+    def run(self, query):
+        client = self.slots.get()
+        try:
+            stdin, stdout, stderr = client.exec_command(f'mysql -u test -p{self.password} -e "use {DATABASE};{query}"')
+            lines = stdout.read().decode('utf-8').splitlines(keepends=True)
+            if stdout.channel.recv_exit_status() != 0:
+                raise RuntimeError(stderr.read().decode('utf-8').strip())
+            return lines
+        finally:
+            self.slots.put(client)
+
+    def close(self):
+        for client in self.clients:
+            client.close()
+
+class LocalTransport:
+    # Offline stand-in: the query is appended to a local command that prints
+    # tab-separated rows with a header, e.g. "sqlite3 -header -separator '<TAB>' votes.db"
+    # or "mysql -u test -pPASSWORD pgodio -e"
+    def __init__(self, command, workers=CHANNELS_PER_CONNECTION):
+        self.command = shlex.split(command)
+        self.size = workers
+
+    def run(self, query):
+        result = subprocess.run(self.command + [query], capture_output=True, text=True)
+        if result.returncode != 0:
+            raise RuntimeError(result.stderr.strip())
+        return result.stdout.splitlines(keepends=True)
+
+    def close(self):
+        pass
 
-    client = paramiko.SSHClient()
-    client.load_system_host_keys()
-    client.connect('odioelodio.com', username=username)
+def read_batch(batch_file):
+    # One command per line, either a name from QUERIES or "name = select ...".
+    # Blank lines and lines starting with # are skipped.
+    commands = []
+    with open(batch_file) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            if '=' in line:
+                name, query = line.split('=', 1)
+                commands.append((name.strip(), query.strip()))
+            else:
+                commands.append((line, QUERIES[line]))
+    return commands
 
-    query = "use pgodio;"
+def run_queries(transport, commands):
+    # Yields (name, lines, seconds) as soon as every query finishes, all of
+    # them run concurrently over the transport's channels
+    with ThreadPoolExecutor(max_workers=transport.size) as pool:
+        futures = {}
+        for name, query in commands:
+            futures[pool.submit(timed, transport.run, query)] = name
 
+        for future in as_completed(futures):
+            lines, elapsed = future.result()
+            yield futures[future], lines, elapsed
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+def write_result(output_dir, name, lines, output_format):
+    os.makedirs(output_dir, exist_ok=True)
+    if output_format == 'json':
+        output_file = os.path.join(output_dir, name + '.json')
+        with open(output_file, 'w') as f:
+            json.dump(list(csv.DictReader(lines, delimiter='\t')), f, indent=2, ensure_ascii=False)
+    else:
+        output_file = os.path.join(output_dir, name + '.tsv')
+        with open(output_file, 'w') as f:
+            f.writelines(lines)
+    return output_file
+
+def run_batch(transport, commands, output_dir, output_format):
+    start = time.perf_counter()
+    for name, lines, elapsed in run_queries(transport, commands):
+        output_file = write_result(output_dir, name, lines, output_format)
+        print(f"{name}: {max(len(lines) - 1, 0)} rows in {elapsed:.2f}s -> {output_file}")
+    print(f"{len(commands)} queries in {time.perf_counter() - start:.2f}s")
+
+def repl(transport):
+    # Several commands on one line run concurrently
     print("Command:", end=" ")
     queryCommand = input()
     print("")
     while queryCommand != "exit":
-        if queryCommand == "hateful":
-            query += """select tweet_id, count(*) as cnt, sum(is_hateful) as cnt_hate, count(*) - sum(is_hateful) as cnt_not_hate, text
-                        from votesIsHateful join tweets on id = tweet_id group by tweet_id having cnt_hate - cnt_not_hate > 1;"""
-        elif queryCommand == "hatefulCount":
-            query += """select count(*) from (select tweet_id, sum(is_hateful) as cnt_hate, count(*) - sum(is_hateful) as cnt_not_hate, text
-                        from votesIsHateful join tweets on id = tweet_id group by tweet_id having cnt_hate - cnt_not_hate > 1) as t1;"""
-        elif queryCommand == "nonhateful":
-            query += """select tweet_id, count(*) as cnt, sum(is_hateful) as cnt_hate, count(*) - sum(is_hateful) as cnt_not_hate, text
-                        from votesIsHateful join tweets on id = tweet_id group by tweet_id having cnt_not_hate - cnt_hate > 1;"""
-        elif queryCommand == "nonhatefulCount":
-            query += """select count(*) from (select tweet_id, sum(is_hateful) as cnt_hate, count(*) - sum(is_hateful) as cnt_not_hate, text
-                        from votesIsHateful join tweets on id = tweet_id group by tweet_id having cnt_not_hate - cnt_hate > 1) as t1;"""
-        elif queryCommand == "ambiguous":
-            query += """select tweet_id, count(*) as cnt, sum(is_hateful) as cnt_hate, count(*) - sum(is_hateful) as cnt_not_hate, text
-                        from votesIsHateful join tweets on id = tweet_id group by tweet_id having abs(cnt_hate - cnt_not_hate) <= 1;"""
-        elif queryCommand == "ambiguousCount": 
-            query += """select count(*) from (select tweet_id, sum(is_hateful) as cnt_hate, count(*) - sum(is_hateful) as cnt_not_hate
-                        from votesIsHateful group by tweet_id having abs(cnt_hate - cnt_not_hate) <= 1) as t1;"""
-        elif queryCommand == "offensive":
-            query += """select tweet_id, count(*) as cnt, sum(is_hateful) as cnt_hate, count(*) - sum(is_hateful) as cnt_not_hate, sum(is_offensive), text
-                        from votesIsHateful join tweets on id = tweet_id group by tweet_id having sum(is_offensive) > 0;"""
-        elif queryCommand == "hateTypes":    
-            query += """select tweet_id, hate_type, count(*), text
-                        from tweets join votesHateType on tweets.id = tweet_id group by tweet_id, text, hate_type order by tweet_id;"""
-        elif queryCommand == "skipped":
-            query += "select id, skip_count, text from tweets where skip_count > 0 order by skip_count DESC;"
-        elif queryCommand == "skippedCount":
-            query += "select count(*) from (select id, skip_count from tweets where skip_count > 0) as t1;"
-        elif queryCommand == "tweetCount":
-            query += "select count(*) from tweets;"
-        elif queryCommand == "totalVoteCount":
-            query += "select count(*) from votesIsHateful;"
-        elif queryCommand == "votedTweets":
-            query += "select count(distinct tweet_id) from votesIsHateful;"
-
-        if queryCommand == "help":
+        names = queryCommand.split()
+        if "help" in names:
             help()
         else:
-            stdin, stdout, stderr = client.exec_command(f'mysql -u test -p{password} -e "{query}"')
-            for line in stdout:
-                print(line, end="")
-            print()
-        
-        query = "use pgodio;"
+            unknown = [name for name in names if name not in QUERIES]
+            if unknown:
+                print("Unknown command:", ", ".join(unknown))
+            else:
+                for name, lines, elapsed in run_queries(transport, [(n, QUERIES[n]) for n in names]):
+                    if len(names) > 1:
+                        print(f"## {name} ({elapsed:.2f}s)")
+                    for line in lines:
+                        print(line, end="")
+                    print()
+
         print("Command:", end=" ")
         queryCommand = input()
         print("")
 
-    client.close()
-
 def help():
-    print("List of commands:")
+    print("List of commands (several can be given on one line):")
     print()
-    print("- hateful")
-    print("- hatefulCount")
-    print("- nonhateful")
-    print("- nonhatefulCount")
-    print("- ambiguous")
-    print("- ambiguousCount")
-    print("- skipped")
-    print("- skippedCount")
-    print("- tweetCount")
-    print("- totalVoteCount")
-    print("- votedTweets")
+    for name in QUERIES:
+        print(f"- {name}")
     print()
 
-main()
\ No newline at end of file
+def _get_option(name, default):
+    if name in sys.argv:
+        return sys.argv[sys.argv.index(name) + 1]
+    return default
+
+def main():
+    # Usage: python db_data/query.py <ssh_user> <db_password> [--connections N] [--channels N]
+    #        python db_data/query.py --local "<command>"
+    # plus, to run without the prompt: [--batch file | --commands a,b,c] [--format tsv|json] [--output dir]
+    local = _get_option('--local', None)
+    if local:
+        transport = LocalTransport(local)
+    else:
+        transport = SSHTransport(sys.argv[1], sys.argv[2],
+                                 int(_get_option('--connections', 1)),
+                                 int(_get_option('--channels', CHANNELS_PER_CONNECTION)))
+
+    try:
+        batch_file = _get_option('--batch', None)
+        command_list = _get_option('--commands', None)
+        if batch_file or command_list:
+            commands = read_batch(batch_file) if batch_file else [(n, QUERIES[n]) for n in command_list.split(',')]
+            run_batch(transport, commands, _get_option('--output', 'query_results'), _get_option('--format', 'tsv'))
+        else:
+            repl(transport)
+    finally:
+        transport.close()
+
+if __name__ == "__main__":
+    main()
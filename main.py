@@ -1,456 +1,623 @@
 import sys, time, math, configparser, os, csv
-import numpy as np
-import tensorflow as tf
-
-from fasttext import load_model
-from pprint import pprint
-from pathlib import Path
-from datetime import date
-from sklearn.model_selection import KFold, StratifiedKFold
-
-from models.fasttext_model import baseline as baseline_model
-from models.bert_model import bert_model
-from models.functional_model import FunctionalModel
-from models.tf_model import TfModel
-from models.svm import SVM
-from data_mgmt.data_mgmt import new_dataset, get_dataset, dataset_to_embeddings, get_bert_token_ids
 
 EPOCHS = 1
 BATCH_SIZE = 1
 
-def labelProportion(trainLabels, testLabels):
-    countYesTraining = 0
-    countYesTest = 0
-
-    countYesTraining = 0
-    for label in trainLabels:
-        if label == 1:
-            countYesTraining += 1
-
-    trainProportion = countYesTraining / len(trainLabels)
-
-    countYesTest = 0
-    for label in testLabels:
-        if label == 1:
-            countYesTest += 1
-        
-    testProportion = countYesTest / len(testLabels)
-
-    allProportion = (countYesTraining + countYesTest) / (len(trainLabels) + len(testLabels))
-
-    return (trainProportion, testProportion, allProportion)
-
-# TODO (medium priority): Implement a proper argument parser
-
-# Data manager parameters
-resplit = True if '--resplit' in sys.argv else False
-
-# Model parameters
-retrain = True if '--retrain' in sys.argv else False 
-save = True if '--save' in sys.argv else False
-functional = True if '--functional' in sys.argv else False
-use_bert = True if '--use-bert' in sys.argv else False
-retrain_bert_vectors = True if '--retrain-bert' in sys.argv else False
-
-# Logging parameters
-skipLogging = True if '--skip-logging' in sys.argv else False
-
-# Config parameters
-config = configparser.ConfigParser()
-config.read('conf.txt')
-
-EPOCHS = int(config['GENERAL']['EPOCHS'])
-BATCH_SIZE = int(config['GENERAL']['BATCH_SIZE'])
-training_set_ratio = float(config['GENERAL']['TRAINING_SET_RATIO'])
-dataset_tsv_file = config['GENERAL']['DATASET_NAME']
-use_kfold = True if config['GENERAL']['USE_KFOLD'] == 'true' else False
-model_type = config['GENERAL']['MODEL_TYPE']
-
-if resplit:
-    new_dataset(dataset_tsv_file, training_set_ratio)
-
-training_dataset_text, test_dataset_text, training_ex_emb, test_ex_emb = get_dataset()
-
-training_tk_ids, test_tk_ids = np.array(get_bert_token_ids())
-
-########## Train and Test Process ########## 
-try:
-    ft_model = load_model("models/fasttext_model/baseline.bin")
-except ValueError as err:
-    print(err)
-    print("Couldn't find a saved model, aborting...")
-    exit(0)
-
-training_dataset_embeddings = dataset_to_embeddings(training_dataset_text, ft_model)
-training_dataset_labels = np.asarray([int(ex[1]) for ex in training_dataset_text])
-
-test_dataset_embeddings = dataset_to_embeddings(test_dataset_text, ft_model)
-test_dataset_labels = np.asarray([int(ex[1]) for ex in test_dataset_text])
-
-# YES label proportions
-trainProportion, testProportion, allProportion = labelProportion(list(training_dataset_labels), list(test_dataset_labels))
-
-# Dimension of the word embeddings                                                
-example_dim = training_dataset_embeddings[0].shape
-
-# Dimension of the tweet embeddings
-tweet_emb_dim = training_ex_emb[0].shape
-
-# Dimension of bert vectors
-bert_dim = 0
-bert_training_vectors = None
-bert_test_vectors = None
-
-if (use_bert):
-    if (retrain_bert_vectors):
-        # Dimension of bert tokens
-        bert_tk_dim = training_tk_ids[0].shape
-
-        bert = bert_model.BertModel(bert_tk_dim)
-
-        bert_training_vectors = bert.predict(training_tk_ids)
-        bert_test_vectors = bert.predict(test_tk_ids)
-
-        np.savetxt('bert_training_vectors.txt', bert_training_vectors)
-        np.savetxt('bert_test_vectors.txt', bert_test_vectors)
+# Process pool workers (stage graph, DMD, hashed TF-IDF, bootstrap, sharded
+# BERT) are spawned and import this module again. The script and its imports
+# (TensorFlow, fasttext, bert) only run in the parent, so workers start with
+# what their own modules need.
+if __name__ == "__main__":
+    import numpy as np
+    import tensorflow as tf
+
+    from fasttext import load_model
+    from pprint import pprint
+    from pathlib import Path
+    from datetime import date
+
+    from models.fasttext_model import baseline as baseline_model
+    from models.fasttext_model import compact, projection
+    from models.bert_model import bert_model
+    from models.bert_model.vector_store import BertVectorStore, extract
+    from models.functional_model import FunctionalModel, MultiTaskFunctionalModel, reset_model, get_architecture
+    from models.tf_model import TfModel
+    from models.svm import SVM, MultiTaskSVM
+    from models import evaluation, features
+    from models.experiment import ExperimentRun, config_hash
+    from models import saved_model
+    from data_mgmt.data_mgmt import new_dataset, get_dataset_text, fit_additional_embeddings, save_sent_embedder, get_bert_texts, dataset_to_embeddings, get_multitask_labels, MAX_WORDS, TASKS, HATE_TYPES, MASKED_LABEL
+    from data_mgmt.splits import get_manifest, fold_splits
+    from data_mgmt.ragged import RaggedDataset, LengthBucketSequence, corpus_max_words, compare_epoch_times
+    from pipeline import StageGraph
+    from cli import get_option
+
+    # TODO (medium priority): Implement a proper argument parser
+
+    # Data manager parameters
+    resplit = True if '--resplit' in sys.argv else False
+
+    # Model parameters
+    retrain = True if '--retrain' in sys.argv else False 
+    save = True if '--save' in sys.argv else False
+    functional = True if '--functional' in sys.argv else False
+    use_bert = True if '--use-bert' in sys.argv else False
+    retrain_bert_vectors = True if '--retrain-bert' in sys.argv else False
+    bert_tflite = True if '--bert-tflite' in sys.argv else False
+    bert_workers = int(get_option('--bert-workers', 0))
+    bert_threads = int(get_option('--bert-threads', 1))
+    compact_emb = True if '--compact-emb' in sys.argv else False
+    ragged = True if '--ragged' in sys.argv else False
+    compare_padding = True if '--compare-padding' in sys.argv else False
+    reuse_graph = True if '--reuse-graph' in sys.argv else False
+    multitask = True if '--multitask' in sys.argv else False
+    fresh_run = True if '--fresh' in sys.argv else False
+
+    # Logging parameters
+    skipLogging = True if '--skip-logging' in sys.argv else False
+
+    # Config parameters
+    config = configparser.ConfigParser()
+    config.read('conf.txt')
+
+    EPOCHS = int(config['GENERAL']['EPOCHS'])
+    BATCH_SIZE = int(config['GENERAL']['BATCH_SIZE'])
+    training_set_ratio = float(config['GENERAL']['TRAINING_SET_RATIO'])
+    dataset_tsv_file = config['GENERAL']['DATASET_NAME']
+    use_kfold = True if config['GENERAL']['USE_KFOLD'] == 'true' else False
+    model_type = config['GENERAL']['MODEL_TYPE']
+    num_folds = int(config['GENERAL']['NUM_FOLDS'])
+    dedup_mode = config['GENERAL'].get('DEDUP_MODE', 'none')
+    use_bert = use_bert or config['EMBEDDINGS']['USE_BERT_EMB'] == 'true'
+    word_dimension = projection.word_dimension(config)
+    # Feature blocks for the SVM, from the USE_*_EMB flags
+    svm_blocks = [b for b in features.enabled_blocks(config) if b != 'bert' or use_bert]
+
+    if resplit:
+        manifest = new_dataset(dataset_tsv_file, training_set_ratio, num_folds, dedup_mode)
     else:
-        bert_training_vectors = np.loadtxt('bert_training_vectors.txt')
-        bert_test_vectors = np.loadtxt('bert_test_vectors.txt')
-
-    bert_dim = bert_training_vectors[0].shape
-
-training_dataset = None
-test_dataset = None
-
-if (model_type == 'classed'):
-    tf.keras.backend.set_floatx('float64')
-
-    training_dataset = tf.data.Dataset.from_tensor_slices((training_dataset_embeddings, training_dataset_labels))
-    training_dataset = training_dataset.shuffle(400).batch(BATCH_SIZE, drop_remainder=True)
-
-    test_dataset = tf.data.Dataset.from_tensor_slices((test_dataset_embeddings, test_dataset_labels))
-    test_dataset = test_dataset.batch(BATCH_SIZE, drop_remainder=True)
-
-    # Optimizer algorithm for training
-    optimizer = tf.keras.optimizers.RMSprop()
-
-    # Loss function
-    loss_object = tf.keras.losses.BinaryCrossentropy(from_logits=True)
-
-    # Metrics that will measure loss and accuracy of the model over the training process
-    train_loss = tf.keras.metrics.Mean(name='train_loss')
-    train_accuracy = tf.keras.metrics.BinaryAccuracy(name='train_accuracy')
-    train_precision = tf.keras.metrics.Precision(name='train_precision', dtype='float32')
-    train_recall = tf.keras.metrics.Recall(name='train_recall', dtype='float32')
-
-    # Metrics that will measure loss and accuracy of the model over the testing process
-    test_loss = tf.keras.metrics.Mean(name='test_loss')
-    test_accuracy = tf.keras.metrics.BinaryAccuracy(name='test_accuracy')
-    test_precision = tf.keras.metrics.Precision(name='test_precision', dtype='float32')
-    test_recall = tf.keras.metrics.Recall(name='test_recall', dtype='float32')
-
-    model = TfModel(example_dim,
-                loss_object, 
-                optimizer, 
-                train_loss, 
-                train_accuracy, 
-                train_precision, 
-                train_recall, 
-                test_loss, 
-                test_accuracy, 
-                test_precision, 
-                test_recall)
-
-bestModel = None
-confusion = None
-if retrain:
-    if (model_type == 'functional'):
-        template = '\n###### Test results ######\n\nTest Loss: {},\nTest Accuracy: {},\nTest Precision: {},\nTest Recall: {},\nTest AUC: {},\nTest F-Score: {}\n'
-        
-        earlyStopping = tf.keras.callbacks.EarlyStopping(monitor='val_loss', 
-                                                    patience=5,
-                                                    restore_best_weights=True)
-
-        if (use_kfold):
-            num_folds = int(config['GENERAL']['NUM_FOLDS'])
-            results = np.zeros((num_folds,6))
+        manifest = get_manifest(training_set_ratio, num_folds, dedup_mode)
+
+    if manifest is None:
+        print("No split manifest found, run with --resplit first, aborting...")
+        exit(0)
+
+    ########## Featurization ##########
+    def load_word_model():
+        try:
+            if compact_emb:
+                return compact.load_embeddings(compact.COMPACT_FILE)
+            return load_model(compact.FULL_MODEL)
+        except (ValueError, IOError) as err:
+            print(err)
+            print("Couldn't find a saved model, aborting...")
+            exit(0)
+
+    def word_embeddings(training_dataset_text, test_dataset_text, ft_model):
+        if ragged:
+            all_texts = [ex[0] for ex in training_dataset_text] + [ex[0] for ex in test_dataset_text]
+            max_words = corpus_max_words(all_texts, float(config['EMBEDDINGS']['MAX_WORDS_PERCENTILE']))
+            ragged_dataset = RaggedDataset(all_texts, ft_model, max_words)
+
+            # Word vectors live in ragged_dataset, examples are referenced by row id
+            return (np.arange(len(training_dataset_text)), np.arange(len(training_dataset_text), len(all_texts)),
+                    (max_words, ragged_dataset.dimension()), ragged_dataset)
+
+        training_dataset_embeddings = dataset_to_embeddings(training_dataset_text, ft_model)
+        test_dataset_embeddings = dataset_to_embeddings(test_dataset_text, ft_model)
+        return training_dataset_embeddings, test_dataset_embeddings, training_dataset_embeddings[0].shape, None
+
+    def bert_vectors(bert_training_texts, bert_test_texts):
+        if bert_tflite:
+            from models.bert_model.tflite_export import TfliteBertEncoder, TFLITE_FILE, tflite_model_id
+            if not os.path.exists(TFLITE_FILE):
+                print("No TFLite model found, run python -m models.bert_model.tflite_export --export, aborting...")
+                exit(0)
+            # Vectors of another export are stored apart
+            bert_store = BertVectorStore(tflite_model_id())
+        else:
+            bert_store = BertVectorStore(bert_model.model_id())
+        missing = bert_store.missing(bert_training_texts + bert_test_texts)
+
+        if missing:
+            if not retrain_bert_vectors:
+                print("{} tweets have no stored BERT vector, run with --retrain-bert to compute them, aborting...".format(len(missing)))
+                exit(0)
+
+            # Only tweets missing from the store are sent through BERT, padded to
+            # the longest tweet of the corpus
+            max_length = bert_model.corpus_max_length(bert_training_texts + bert_test_texts)
+            if bert_tflite:
+                # --bert-workers interpreters (one per core of the thread
+                # budget by default), each with --bert-threads threads
+                encoder = TfliteBertEncoder(num_threads=bert_threads,
+                                            num_interpreters=bert_workers or max(1, os.cpu_count() // bert_threads))
+                if encoder.max_length < max_length:
+                    print("The TFLite model was exported for {} tokens but the corpus needs {}, run python -m models.bert_model.tflite_export --export, aborting...".format(encoder.max_length, max_length))
+                    exit(0)
+                extract(bert_store, missing, encoder)
+            elif bert_workers:
+                # One BertModel per worker process, each with its own thread budget
+                from models.bert_model.sharded import ShardedBertEncoder
+                encoder = ShardedBertEncoder(bert_workers, bert_threads, max_length=max_length)
+                try:
+                    extract(bert_store, missing, encoder, encoder.extraction_batch())
+                finally:
+                    encoder.close()
+            else:
+                extract(bert_store, missing, bert_model.BertEncoder(max_length=max_length))
+
+        return bert_store.lookup(bert_training_texts), bert_store.lookup(bert_test_texts)
+
+    ragged = ragged and model_type == 'functional' and not multitask
+
+    # Loading fasttext, fitting TF-IDF/SVD and looking up BERT vectors don't
+    # depend on each other and run concurrently. The TF-IDF fit gets its own
+    # process so it doesn't compete with the word vector lookups for the GIL.
+    stages = StageGraph()
+    stages.add('dataset_text', get_dataset_text, ['manifest'], ['training_dataset_text', 'test_dataset_text'])
+    stages.add('all_tweets', lambda training, test: [ex[0] for ex in training + test],
+               ['training_dataset_text', 'test_dataset_text'], ['all_tweets'])
+    stages.add('sent_vectors', fit_additional_embeddings, ['all_tweets'], ['sent_vectors', 'sent_embedder'], pool='process')
+    stages.add('word_model', load_word_model, [], ['ft_model'])
+    # PCA-reduced word vectors when WORD_DIMENSION is set, ft_model otherwise
+    stages.add('word_projection', projection.project_embeddings, ['ft_model', 'all_tweets', 'word_dimension'],
+               ['word_model'])
+    stages.add('word_vectors', word_embeddings, ['training_dataset_text', 'test_dataset_text', 'word_model'],
+               ['training_dataset_embeddings', 'test_dataset_embeddings', 'example_dim', 'ragged_dataset'])
+    stages.add('bert_texts', get_bert_texts, ['manifest'], ['bert_training_texts', 'bert_test_texts'])
+    stages.add('bert_vectors', bert_vectors, ['bert_training_texts', 'bert_test_texts'],
+               ['bert_training_vectors', 'bert_test_vectors'])
+
+    targets = ['training_dataset_text', 'test_dataset_text', 'sent_vectors', 'sent_embedder', 'training_dataset_embeddings',
+               'test_dataset_embeddings', 'example_dim', 'ragged_dataset', 'word_model']
+    if (use_bert):
+        targets += ['bert_training_vectors', 'bert_test_vectors']
+
+    featurized = stages.run(targets, {'manifest': manifest, 'word_dimension': word_dimension})
+    stages.report()
+
+    training_dataset_text = featurized['training_dataset_text']
+    test_dataset_text = featurized['test_dataset_text']
+    training_ex_emb = featurized['sent_vectors'][:len(training_dataset_text)]
+    test_ex_emb = featurized['sent_vectors'][len(training_dataset_text):]
+
+    ########## Train and Test Process ########## 
+    training_dataset_embeddings = featurized['training_dataset_embeddings']
+    test_dataset_embeddings = featurized['test_dataset_embeddings']
+    ragged_dataset = featurized['ragged_dataset']
+
+    def save_model(model, model_file):
+        # Weights plus what score.py needs to featurize tweets the same way:
+        # the sentence embedder, the word PCA (when WORD_DIMENSION is set) and
+        # the word vector file. Functional weights only load into the encoder
+        # and head they were trained with.
+        model.save_weights(model_file)
+        save_sent_embedder(featurized['sent_embedder'], model_file)
+        projection.save_projection(featurized['word_model'], model_file)
+        settings = {'embeddings': compact.COMPACT_FILE if compact_emb else compact.FULL_MODEL}
+        if model_type == 'functional':
+            settings['architecture'] = list(get_architecture(config))
+        saved_model.save_settings(model_file, settings)
+
+    training_dataset_labels = np.asarray([int(ex[1]) for ex in training_dataset_text])
+    test_dataset_labels = np.asarray([int(ex[1]) for ex in test_dataset_text])
+
+    # YES label proportions
+    trainProportion, testProportion, allProportion = evaluation.label_proportion(training_dataset_labels, test_dataset_labels)
+
+    # Dimension of the word embeddings                                                
+    example_dim = featurized['example_dim']
+
+    # Dimension of the tweet embeddings
+    tweet_emb_dim = training_ex_emb[0].shape
+
+    # Dimension of bert vectors
+    bert_dim = 0
+    bert_training_vectors = None
+    bert_test_vectors = None
+
+    if (use_bert):
+        bert_training_vectors = featurized['bert_training_vectors']
+        bert_test_vectors = featurized['bert_test_vectors']
+
+        bert_dim = bert_training_vectors[0].shape
+
+    training_dataset = None
+    test_dataset = None
+
+    if (model_type == 'classed'):
+        tf.keras.backend.set_floatx('float64')
+
+        training_dataset = tf.data.Dataset.from_tensor_slices((training_dataset_embeddings, training_dataset_labels))
+        training_dataset = training_dataset.shuffle(400).batch(BATCH_SIZE, drop_remainder=True)
+
+        test_dataset = tf.data.Dataset.from_tensor_slices((test_dataset_embeddings, test_dataset_labels))
+        test_dataset = test_dataset.batch(BATCH_SIZE, drop_remainder=True)
+
+        # Optimizer algorithm for training
+        optimizer = tf.keras.optimizers.RMSprop()
+
+        # Loss function
+        loss_object = tf.keras.losses.BinaryCrossentropy(from_logits=True)
+
+        # Metrics that will measure loss and accuracy of the model over the training process
+        train_loss = tf.keras.metrics.Mean(name='train_loss')
+        train_accuracy = tf.keras.metrics.BinaryAccuracy(name='train_accuracy')
+        train_precision = tf.keras.metrics.Precision(name='train_precision', dtype='float32')
+        train_recall = tf.keras.metrics.Recall(name='train_recall', dtype='float32')
+
+        # Metrics that will measure loss and accuracy of the model over the testing process
+        test_loss = tf.keras.metrics.Mean(name='test_loss')
+        test_accuracy = tf.keras.metrics.BinaryAccuracy(name='test_accuracy')
+        test_precision = tf.keras.metrics.Precision(name='test_precision', dtype='float32')
+        test_recall = tf.keras.metrics.Recall(name='test_recall', dtype='float32')
+
+        model = TfModel(example_dim,
+                    loss_object, 
+                    optimizer, 
+                    train_loss, 
+                    train_accuracy, 
+                    train_precision, 
+                    train_recall, 
+                    test_loss, 
+                    test_accuracy, 
+                    test_precision, 
+                    test_recall)
+
+    bestModel = None
+    # Runs with the same settings and splits share a run directory, finished
+    # folds are not trained again. The dataset hash and the label overrides are
+    # part of the split, a relabel or a collapse starts a new run.
+    experiment_settings = {
+        'config': {section: dict(config[section]) for section in config.sections()},
+        'split': config_hash([manifest['training'], manifest['test'], manifest['folds'],
+                              manifest.get('content_hash'), manifest.get('labels')]),
+        'flags': {'use_bert': use_bert, 'bert_tflite': bert_tflite, 'compact_emb': compact_emb, 'ragged': ragged},
+    }
+
+    confusion = None
+    if retrain:
+        if multitask:
+            # One featurization and one training run per fold for HS, OF and HT
+            training_task_labels, test_task_labels = get_multitask_labels(manifest)
+            dataset_task_labels = {t: np.append(training_task_labels[t], test_task_labels[t], 0) for t in TASKS}
 
             dataset_embeddings = np.append(training_dataset_embeddings, test_dataset_embeddings, 0)
             dataset_ex_embeddings = np.append(training_ex_emb, test_ex_emb, 0)
-            dataset_labels = np.append(training_dataset_labels, test_dataset_labels, 0)
-            if(use_bert):
-                dataset_embeddings_bert = np.append(bert_training_vectors, bert_test_vectors, 0)
-
-            training_texts = [a[0] for a in training_dataset_text]
-            test_texts = [a[0] for a in test_dataset_text]
-
-            dataset_texts = list(training_texts)
-            dataset_texts.extend(test_texts)
-
-            splits = StratifiedKFold(num_folds).split(dataset_embeddings, dataset_labels)
-            test_step = 0
-            bestScore = 0
-            bestTestInput = None
-            bestTP = None
-            bestTN = None
-            bestFP = None
-            bestFN = None
-            bestTexts = None
-            proportions = []
+            if (use_bert):
+                dataset_bert_vectors = np.append(bert_training_vectors, bert_test_vectors, 0)
+            else:
+                dataset_bert_vectors = np.zeros((len(dataset_embeddings), 0))
+
+            earlyStopping = tf.keras.callbacks.EarlyStopping(monitor='val_loss', 
+                                                        patience=5,
+                                                        restore_best_weights=True)
+
+            task_results = {t: [] for t in TASKS}
+            # --save keeps the fold with the best HS F-score
+            bestModel = None
+            splits = fold_splits(manifest)
             for train_index, val_index in splits:
-                model = FunctionalModel(example_dim, tweet_emb_dim, bert_dim, use_bert)
-                
-                training_inputs = [
-                    np.asarray([dataset_embeddings[i] for i in train_index]),
-                    np.asarray([dataset_ex_embeddings[i] for i in train_index])
-                ]
-
-                if (use_bert):
-                    training_inputs.append(
-                        np.asarray([dataset_embeddings_bert[i] for i in train_index])
-                    )
-
-                test_inputs = [
-                    np.asarray([dataset_embeddings[i] for i in val_index]),
-                    np.asarray([dataset_ex_embeddings[i] for i in val_index])
-                ]
-
-                if (use_bert):
-                    test_inputs.append(
-                        np.asarray([dataset_embeddings_bert[i] for i in val_index])
-                    )
-
-                training_labels = np.asarray([dataset_labels[i] for i in train_index])
-                test_labels = np.asarray([dataset_labels[i] for i in val_index])
-                proportions.append(labelProportion(training_labels, test_labels))
-
-                history = model.fit(training_inputs, 
-                                training_labels,
-                                validation_split=0.2,
-                                batch_size=BATCH_SIZE,
-                                epochs=EPOCHS,
-                                callbacks=[earlyStopping])
-
-                loss, accuracy, precision, recall, auc, tp, tn, fp, fn = model.evaluate(test_inputs,
-                                                    test_labels, 
-                                                    batch_size=BATCH_SIZE, 
-                                                    verbose=2)
-                                                    
-                results[test_step][0] = loss
-                results[test_step][1] = accuracy
-                results[test_step][2] = precision
-                results[test_step][3] = recall
-                results[test_step][4] = auc
-                results[test_step][5] = 2 * (precision * recall) / (precision + recall)
-
-                if results[test_step][5] > bestScore:
-                    bestScore = results[test_step][5]
+                training_task_labels = {t: dataset_task_labels[t][train_index] for t in TASKS}
+                test_task_labels = {t: dataset_task_labels[t][val_index] for t in TASKS}
+
+                if (model_type == 'functional'):
+                    model = MultiTaskFunctionalModel(example_dim, tweet_emb_dim, bert_dim, use_bert, len(HATE_TYPES))
+
+                    training_inputs = [dataset_embeddings[train_index], dataset_ex_embeddings[train_index]]
+                    test_inputs = [dataset_embeddings[val_index], dataset_ex_embeddings[val_index]]
+                    if (use_bert):
+                        training_inputs.append(dataset_bert_vectors[train_index])
+                        test_inputs.append(dataset_bert_vectors[val_index])
+
+                    history = model.fit(training_inputs,
+                                    training_task_labels,
+                                    validation_split=0.2,
+                                    batch_size=BATCH_SIZE,
+                                    epochs=EPOCHS,
+                                    callbacks=[earlyStopping])
+
+                    outputs = model.predict(test_inputs, batch_size=BATCH_SIZE)
+                    task_scores = {'HS': outputs[0][:, 0], 'OF': outputs[1][:, 0], 'HT': outputs[2]}
+                    threshold = 0.5
+
+                    tf.keras.backend.clear_session()
+                else:
+                    model = MultiTaskSVM(TASKS, MASKED_LABEL, svm_blocks)
+                    model.fit(dataset_embeddings[train_index], dataset_ex_embeddings[train_index], dataset_bert_vectors[train_index], training_task_labels)
+                    task_scores = model.score(dataset_embeddings[val_index], dataset_ex_embeddings[val_index], dataset_bert_vectors[val_index])
+                    threshold = 0.0
+
+                for task in TASKS:
+                    rows = test_task_labels[task] != MASKED_LABEL
+                    if task == 'HT':
+                        if model_type == 'functional':
+                            predictions = np.argmax(task_scores[task][rows], axis=1)
+                        else:
+                            predictions = model.labels_from_scores(task, task_scores[task][rows])
+                        task_results[task].append(evaluation.multiclass_f1(test_task_labels[task][rows], predictions, len(HATE_TYPES))['macro_fscore'])
+                    else:
+                        task_results[task].append(evaluation.evaluate(test_task_labels[task][rows], task_scores[task][rows], threshold)['fscore'])
+
+                if bestModel is None or task_results['HS'][-1] > max(task_results['HS'][:-1]):
                     bestModel = model
-                    bestTestInput = test_inputs
-                    bestTestSet = test_labels
-                    bestTP = tp
-                    bestTN = tn
-                    bestFP = fp
-                    bestFN = fn
-                    bestTexts = [dataset_texts[i] for i in val_index]
-
-                test_step += 1
-
-                tf.keras.backend.clear_session()
-            
-            mean_results = np.mean(results, axis=0)
-            
-            print(template.format(mean_results[0], 
-                                mean_results[1], 
-                                mean_results[2], 
-                                mean_results[3], 
-                                mean_results[4], 
-                                mean_results[5]))
-            
-            loss = mean_results[0]
-            accuracy = mean_results[1]
-            precision = mean_results[2]
-            recall = mean_results[3]
-            auc = mean_results[4]
-            fscore = mean_results[5]
-            
-            predictions = bestModel.predict(bestTestInput)
-
-            predictionsFile = open(f'results/predictions{str(math.trunc(time.time()))}.txt', 'w')
 
-            with open('datasets/idorsPP.tsv') as tsvFile:
-                reader = csv.DictReader(tsvFile, dialect='excel-tab')
-                for r in reader:
-                    if r['pretext']:
-                        try:
-                            i = bestTexts.index(r['pretext'])
-                            predictionsFile.write(r['id'] + " || " + r['HS'] + " || " + r['OF'] + " || " + r['HT'] + " || " + str(predictions[i][0]) + " || " + r['text'] + "\n")
-                        except:
-                            pass
+            print('\n###### Multi-task test results ######\n')
+            for task in TASKS:
+                print('{} F-Score{}: {} (folds: {})'.format(task, ' (macro)' if task == 'HT' else '', np.mean(task_results[task]), task_results[task]))
 
-        else:
-            model = FunctionalModel(example_dim, tweet_emb_dim, bert_dim, use_bert)
-
-            training_inputs = [training_dataset_embeddings, training_ex_emb]
-
-            if (use_bert):
-                training_inputs.append(bert_training_vectors)
+            if save:
+                directory = "saved_models"
+                Path(directory).mkdir(parents=True, exist_ok=True)
+                model_file = directory + '/' + model_type + '_multitask' + str(math.trunc(time.time()))
+                save_model(bestModel, model_file)
+        elif (model_type == 'functional'):
+            template = '\n###### Test results ######\n\nTest Loss: {},\nTest Accuracy: {},\nTest Precision: {},\nTest Recall: {},\nTest AUC: {},\nTest F-Score: {}\n'
             
-            history = model.fit(training_inputs, 
-                                training_dataset_labels,
-                                batch_size=BATCH_SIZE,
-                                epochs=EPOCHS,
-                                validation_split=0.2,
-                                callbacks=[earlyStopping])
-
-            test_inputs = [test_dataset_embeddings, test_ex_emb]
-
-            if (use_bert):
-                test_inputs.append(bert_test_vectors)
-
-            #TODO (low priority): Make an evaluate method for the subclassed model
-            loss, accuracy, precision, recall, auc = model.evaluate(test_inputs,
-                                                                test_dataset_labels, 
-                                                                batch_size=BATCH_SIZE, 
-                                                                verbose=2)
-
-            fscore = 2 * (precision * recall) / (precision + recall)
-        
-            print(template.format(loss, accuracy, precision, recall, auc, fscore))
-
-        if not skipLogging:
-            logDir = config['GENERAL']['LOGDIR']
-            directory = logDir + '/' + date.today().strftime("%m-%d-%Y")
-            Path(directory).mkdir(parents=True, exist_ok=True)
-            with open(directory + '/' + dataset_tsv_file.split('.tsv')[0] + str(math.trunc(time.time())), 'w') as logfile:
-                logfile.write('Using dataset: ' + dataset_tsv_file + '\n\n')
-                logfile.write('Training dataset size: {}\n'.format(len(training_dataset_embeddings)))
-                logfile.write('Test dataset size: {}\n'.format(len(test_dataset_embeddings)))
-                logfile.write('\n###### Positive label proportion ######\n\n')
-                for i, p in enumerate(proportions):
-                    logfile.write('For training in fold {}: {}\n'.format(i, p[0]))
-                    logfile.write('For test in fold {}: {}\n'.format(i, p[1]))
-                logfile.write('For combined dataset: {}\n'.format(proportions[0][2]))   
-                logfile.write('\n###### Fold results ######\n\n')
-                for r in results:
-                    logfile.write('loss:{}\n'.format(r[0]))
-                    logfile.write('accuracy:{}\n'.format(r[1]))
-                    logfile.write('precision:{}\n'.format(r[2]))
-                    logfile.write('recall:{}\n'.format(r[3]))
-                    logfile.write('AUC:{}\n'.format(r[4]))
-                    logfile.write('fscore:{}\n\n'.format(r[5]))
-                logfile.write('\n###### Model Summary ######\n\n')
-                model.summary(print_fn=lambda x: logfile.write(x + '\n'))
-                logfile.write(template.format(loss, accuracy, precision, recall, auc, fscore))
-                logfile.write('TP:{}\n'.format(bestTP))
-                logfile.write('TN:{}\n'.format(bestTN))
-                logfile.write('FP:{}\n'.format(bestFP))
-                logfile.write('FN:{}\n'.format(bestFN))
-                logfile.write('\n###### Metrics history for {} epochs: ######\n\n'.format(len(history.epoch)))
-                for epoch in history.epoch:
-                    metricsHistory = history.history
-                    logfile.write('Epoch {}: '.format(epoch + 1))
-                    for key in metricsHistory.keys():
-                        logfile.write('{}: {},'.format(key, metricsHistory[key][epoch]))
-                        logfile.write(' ')
-                    logfile.write('\n')
-                logfile.write('\n##### Raw metrics history #####\n\n')
-                pprint(metricsHistory, logfile)
-
-        if save:
-            directory = "saved_models"
-            Path(directory).mkdir(parents=True, exist_ok=True)
-            bestModel.save_weights(directory + '/' + model_type + str(math.trunc(time.time())))
-    elif (model_type == 'svm'):
-        template = '\n###### Test results ######\n\nTest Accuracy: {},\nTest Precision: {},\nTest Recall: {},\nTest F-Score: {}\n'
-        if (use_kfold):
-            num_folds = int(config['GENERAL']['NUM_FOLDS'])
-            results = np.zeros((num_folds,4))
-
-            dataset_embeddings = np.append(training_dataset_embeddings, test_dataset_embeddings, 0)
-            dataset_ex_embeddings = np.append(training_ex_emb, test_ex_emb, 0)
-            dataset_bert_vectors = np.append(bert_training_vectors, bert_test_vectors, 0)
-            dataset_labels = np.append(training_dataset_labels, test_dataset_labels, 0)
-
-            training_texts = [a[0] for a in training_dataset_text]
-            test_texts = [a[0] for a in test_dataset_text]
-
-            dataset_texts = list(training_texts)
-            dataset_texts.extend(test_texts)
-
-            splits = StratifiedKFold(num_folds).split(dataset_embeddings, dataset_labels)
-            test_step = 0
-            bestScore = 0
-            bestTestSet = None
-            bestTestInput = None
-            bestTP = None
-            bestTN = None
-            bestFP = None
-            bestFN = None
-            bestTexts = None
-            proportions = []
-            for train_index, val_index in splits:
-                model = SVM()
-
-                training_dataset_embeddings = np.asarray([dataset_embeddings[i] for i in train_index])
-                training_ex_emb = np.asarray([dataset_ex_embeddings[i] for i in train_index])
-
-                training_embeddings_bert = []
-                if (use_bert):
-                    training_embeddings_bert = np.asarray([dataset_bert_vectors[i] for i in train_index])
-
-                test_dataset_embeddings = np.asarray([dataset_embeddings[i] for i in val_index])
-                test_ex_emb = np.asarray([dataset_ex_embeddings[i] for i in val_index])
-
-                test_embeddings_bert = []
-                if (use_bert):
-                    test_embeddings_bert = np.asarray([dataset_bert_vectors[i] for i in val_index])
-
-                training_labels = np.asarray([dataset_labels[i] for i in train_index])
-                test_labels = np.asarray([dataset_labels[i] for i in val_index])
-                proportions.append(labelProportion(training_labels, test_labels))
-
-                model.fit(training_dataset_embeddings, training_ex_emb, training_embeddings_bert, training_labels)
-                accuracy, precision, recall, fscore, tp, tn, fp, fn = model.evaluate(test_dataset_embeddings, test_ex_emb, test_embeddings_bert, test_labels)
-                                                    
-                results[test_step][0] = accuracy
-                results[test_step][1] = precision
-                results[test_step][2] = recall
-                results[test_step][3] = fscore
-
-                if results[test_step][3] > bestScore:
-                    bestScore = results[test_step][3]
-                    bestModel = model
-                    bestTestSet = test_labels
-                    bestTestInput = [test_dataset_embeddings, test_ex_emb, test_embeddings_bert]
-                    bestTP = tp
-                    bestTN = tn
-                    bestFP = fp
-                    bestFN = fn
-                    bestTexts = [dataset_texts[i] for i in val_index]
+            earlyStopping = tf.keras.callbacks.EarlyStopping(monitor='val_loss', 
+                                                        patience=5,
+                                                        restore_best_weights=True)
+
+            if (use_kfold):
+                results = np.zeros((num_folds,6))
+
+                dataset_embeddings = np.append(training_dataset_embeddings, test_dataset_embeddings, 0)
+                dataset_ex_embeddings = np.append(training_ex_emb, test_ex_emb, 0)
+                dataset_labels = np.append(training_dataset_labels, test_dataset_labels, 0)
+                if(use_bert):
+                    dataset_embeddings_bert = np.append(bert_training_vectors, bert_test_vectors, 0)
+
+                training_texts = [a[0] for a in training_dataset_text]
+                test_texts = [a[0] for a in test_dataset_text]
+
+                dataset_texts = list(training_texts)
+                dataset_texts.extend(test_texts)
+
+                splits = fold_splits(manifest)
+                test_step = 0
+                bestScore = 0
+                bestTestInput = None
+                bestTP = None
+                bestTN = None
+                bestFP = None
+                bestFN = None
+                bestTexts = None
+                bestScores = None
+                proportions = []
+                oof_labels = []
+                oof_scores = []
+                fold_times = []
+
+                run = ExperimentRun(model_type, experiment_settings, fresh=fresh_run)
+                print('Run directory: {} ({} folds already done)'.format(run.directory, len(run.completed_folds())))
+                bestFold = None
+                model = None
+                # Measured once per run, on scratch models
+                epoch_times = None
+
+                if reuse_graph:
+                    # The graph is built and compiled once, every fold starts from
+                    # the same initial weights
+                    build_start = time.perf_counter()
+                    model = FunctionalModel(example_dim, tweet_emb_dim, bert_dim, use_bert, ragged)
+                    initial_weights = model.get_weights()
+                    print('Model built in {:.2f}s'.format(time.perf_counter() - build_start))
+
+                for train_index, val_index in splits:
+                    training_labels = np.asarray([dataset_labels[i] for i in train_index])
+                    test_labels = np.asarray([dataset_labels[i] for i in val_index])
+                    proportions.append(evaluation.label_proportion(training_labels, test_labels))
+
+                    if run.is_done(test_step):
+                        saved = run.load_fold(test_step)
+                        metrics = saved['metrics']
+                        loss = metrics['loss']
+                        fold_scores = saved['scores']
+                        setup_time, train_time = saved['timings']
+                        history = saved['history']
+                        print('Fold {}: loaded from {}'.format(test_step, run.fold_dir(test_step)))
+                    else:
+                        setup_start = time.perf_counter()
+                        if reuse_graph:
+                            reset_model(model, initial_weights)
+                        else:
+                            model = FunctionalModel(example_dim, tweet_emb_dim, bert_dim, use_bert, ragged)
+                        setup_time = time.perf_counter() - setup_start
+                    
+                        training_inputs = [
+                            np.asarray([dataset_embeddings[i] for i in train_index]),
+                            np.asarray([dataset_ex_embeddings[i] for i in train_index])
+                        ]
+
+                        if (use_bert):
+                            training_inputs.append(
+                                np.asarray([dataset_embeddings_bert[i] for i in train_index])
+                            )
+
+                        test_inputs = [
+                            np.asarray([dataset_embeddings[i] for i in val_index]),
+                            np.asarray([dataset_ex_embeddings[i] for i in val_index])
+                        ]
+
+                        if (use_bert):
+                            test_inputs.append(
+                                np.asarray([dataset_embeddings_bert[i] for i in val_index])
+                            )
+
+                        if ragged:
+                            extra_inputs = [dataset_ex_embeddings]
+                            if (use_bert):
+                                extra_inputs.append(dataset_embeddings_bert)
+
+                            # Same held-out tail keras takes with validation_split
+                            num_val = max(1, int(0.2 * len(train_index)))
+                            training_inputs = LengthBucketSequence(ragged_dataset, train_index[:-num_val], extra_inputs, dataset_labels, BATCH_SIZE)
+                            validation_inputs = LengthBucketSequence(ragged_dataset, train_index[-num_val:], extra_inputs, dataset_labels, BATCH_SIZE, shuffle=False)
+                            test_inputs = LengthBucketSequence(ragged_dataset, val_index, extra_inputs, dataset_labels, BATCH_SIZE, shuffle=False)
+                            print('Padded steps relative to MAX_WORDS padding: {:.2f}'.format(training_inputs.cost_ratio(MAX_WORDS)))
+                            if compare_padding and epoch_times is None:
+                                epoch_times = compare_epoch_times(
+                                    lambda: FunctionalModel(example_dim, tweet_emb_dim, bert_dim, use_bert, ragged),
+                                    ragged_dataset, train_index[:-num_val], extra_inputs, dataset_labels, BATCH_SIZE, MAX_WORDS)
+                                print('Epoch time: {:.2f}s padded to MAX_WORDS, {:.2f}s ragged ({:.2f}x)'.format(
+                                    epoch_times['padded'], epoch_times['ragged'], epoch_times['padded'] / max(epoch_times['ragged'], 1e-9)))
+
+                            train_start = time.perf_counter()
+                            history = model.fit(training_inputs,
+                                            validation_data=validation_inputs,
+                                            epochs=EPOCHS,
+                                            callbacks=[earlyStopping])
+                            train_time = time.perf_counter() - train_start
+
+                            loss = model.evaluate(test_inputs, verbose=2)[0]
+                            fold_scores = test_inputs.restore_order(model.predict(test_inputs)[:, 0])
+                        else:
+                            train_start = time.perf_counter()
+                            history = model.fit(training_inputs, 
+                                            training_labels,
+                                            validation_split=0.2,
+                                            batch_size=BATCH_SIZE,
+                                            epochs=EPOCHS,
+                                            callbacks=[earlyStopping])
+                            train_time = time.perf_counter() - train_start
+
+                            loss = model.evaluate(test_inputs,
+                                                test_labels, 
+                                                batch_size=BATCH_SIZE, 
+                                                verbose=2)[0]
+                            fold_scores = model.predict(test_inputs, batch_size=BATCH_SIZE)[:, 0]
+
+                        metrics = evaluation.evaluate(test_labels, fold_scores, 0.5)
+                        metrics['loss'] = loss
+                        run.save_fold(test_step, model, metrics, val_index, test_labels, fold_scores, history, (setup_time, train_time))
+
+                    oof_labels.append(test_labels)
+                    oof_scores.append(fold_scores)
+
+                    fold_times.append((setup_time, train_time))
+                    print('Fold {}: setup {:.2f}s, training {:.2f}s'.format(test_step, setup_time, train_time))
+                                                        
+                    results[test_step][0] = loss
+                    results[test_step][1] = metrics['accuracy']
+                    results[test_step][2] = metrics['precision']
+                    results[test_step][3] = metrics['recall']
+                    results[test_step][4] = metrics['auc']
+                    results[test_step][5] = metrics['fscore']
+
+                    if bestFold is None or results[test_step][5] > bestScore:
+                        bestScore = results[test_step][5]
+                        bestFold = test_step
+                        bestTestSet = test_labels
+                        bestScores = fold_scores
+                        bestTP = metrics['tp']
+                        bestTN = metrics['tn']
+                        bestFP = metrics['fp']
+                        bestFN = metrics['fn']
+                        bestTexts = [dataset_texts[i] for i in val_index]
+
+                    test_step += 1
+
+                    if not reuse_graph:
+                        tf.keras.backend.clear_session()
+
+                # The best fold's weights come from its checkpoint, whether it
+                # was trained now or in an earlier run
+                if not reuse_graph:
+                    model = FunctionalModel(example_dim, tweet_emb_dim, bert_dim, use_bert, ragged)
+                bestModel = run.load_weights(model, bestFold)
                 
-                test_step += 1
-            
-            mean_results = np.mean(results, axis=0)
+                mean_results = np.mean(results, axis=0)
+                
+                print(template.format(mean_results[0], 
+                                    mean_results[1], 
+                                    mean_results[2], 
+                                    mean_results[3], 
+                                    mean_results[4], 
+                                    mean_results[5]))
+                
+                loss = mean_results[0]
+                accuracy = mean_results[1]
+                precision = mean_results[2]
+                recall = mean_results[3]
+                auc = mean_results[4]
+                fscore = mean_results[5]
+
+                # Out-of-fold predictions cover the whole dataset exactly once
+                intervals = evaluation.bootstrap(np.concatenate(oof_labels), np.concatenate(oof_scores), 0.5)
+                print(evaluation.format_intervals(intervals))
+                
+                predictions = bestScores
+
+                predictionsFile = open(f'results/predictions{str(math.trunc(time.time()))}.txt', 'w')
+
+                with open('datasets/idorsPP.tsv') as tsvFile:
+                    reader = csv.DictReader(tsvFile, dialect='excel-tab')
+                    for r in reader:
+                        if r['pretext']:
+                            try:
+                                i = bestTexts.index(r['pretext'])
+                                predictionsFile.write(r['id'] + " || " + r['HS'] + " || " + r['OF'] + " || " + r['HT'] + " || " + str(predictions[i]) + " || " + r['text'] + "\n")
+                            except:
+                                pass
+
+            else:
+                model = FunctionalModel(example_dim, tweet_emb_dim, bert_dim, use_bert, ragged)
+
+                if ragged:
+                    extra_inputs = [np.append(training_ex_emb, test_ex_emb, 0)]
+                    if (use_bert):
+                        extra_inputs.append(np.append(bert_training_vectors, bert_test_vectors, 0))
+                    dataset_labels = np.append(training_dataset_labels, test_dataset_labels, 0)
+
+                    num_val = max(1, int(0.2 * len(training_dataset_embeddings)))
+                    training_inputs = LengthBucketSequence(ragged_dataset, training_dataset_embeddings[:-num_val], extra_inputs, dataset_labels, BATCH_SIZE)
+                    validation_inputs = LengthBucketSequence(ragged_dataset, training_dataset_embeddings[-num_val:], extra_inputs, dataset_labels, BATCH_SIZE, shuffle=False)
+                    test_inputs = LengthBucketSequence(ragged_dataset, test_dataset_embeddings, extra_inputs, dataset_labels, BATCH_SIZE, shuffle=False)
+
+                    history = model.fit(training_inputs,
+                                        validation_data=validation_inputs,
+                                        epochs=EPOCHS,
+                                        callbacks=[earlyStopping])
+
+                    loss = model.evaluate(test_inputs, verbose=2)[0]
+                    test_scores = test_inputs.restore_order(model.predict(test_inputs)[:, 0])
+                else:
+                    training_inputs = [training_dataset_embeddings, training_ex_emb]
+
+                    if (use_bert):
+                        training_inputs.append(bert_training_vectors)
+                    
+                    history = model.fit(training_inputs, 
+                                        training_dataset_labels,
+                                        batch_size=BATCH_SIZE,
+                                        epochs=EPOCHS,
+                                        validation_split=0.2,
+                                        callbacks=[earlyStopping])
+
+                    test_inputs = [test_dataset_embeddings, test_ex_emb]
+
+                    if (use_bert):
+                        test_inputs.append(bert_test_vectors)
+
+                    #TODO (low priority): Make an evaluate method for the subclassed model
+                    loss = model.evaluate(test_inputs,
+                                        test_dataset_labels, 
+                                        batch_size=BATCH_SIZE, 
+                                        verbose=2)[0]
+                    test_scores = model.predict(test_inputs, batch_size=BATCH_SIZE)[:, 0]
+
+                metrics = evaluation.evaluate(test_dataset_labels, test_scores, 0.5)
+                accuracy = metrics['accuracy']
+                precision = metrics['precision']
+                recall = metrics['recall']
+                auc = metrics['auc']
+                fscore = metrics['fscore']
             
-            accuracy = mean_results[0]
-            precision = mean_results[1]
-            recall = mean_results[2]
-            fscore = mean_results[3]
-
-            predictions = bestModel.predict(bestTestInput[0], bestTestInput[1], bestTestInput[2])
+                print(template.format(loss, accuracy, precision, recall, auc, fscore))
 
-            predictionsFile = open(f'results/predictions{str(math.trunc(time.time()))}.txt', 'w')
-
-            with open('datasets/idorsPP.tsv') as tsvFile:
-                reader = csv.DictReader(tsvFile, dialect='excel-tab')
-                for r in reader:
-                    if r['pretext']:
-                        try:
-                            i = bestTexts.index(r['pretext'])
-                            predictionsFile.write(r['id'] + " || " + r['HS'] + " || " + r['OF'] + " || " + r['HT'] + " || " + str(predictions[i]) + " || " + r['text'] + "\n")
-                        except:
-                            pass
+                intervals = evaluation.bootstrap(test_dataset_labels, test_scores, 0.5)
+                print(evaluation.format_intervals(intervals))
 
             if not skipLogging:
                 logDir = config['GENERAL']['LOGDIR']
@@ -464,35 +631,193 @@ if retrain:
                     for i, p in enumerate(proportions):
                         logfile.write('For training in fold {}: {}\n'.format(i, p[0]))
                         logfile.write('For test in fold {}: {}\n'.format(i, p[1]))
-                    logfile.write('For combined dataset: {}\n'.format(proportions[0][2]))
+                    logfile.write('For combined dataset: {}\n'.format(proportions[0][2]))   
+                    logfile.write('\n###### Fold timings ######\n\n')
+                    for i, (setup_time, train_time) in enumerate(fold_times):
+                        logfile.write('Fold {}: setup {:.2f}s, training {:.2f}s\n'.format(i, setup_time, train_time))
                     logfile.write('\n###### Fold results ######\n\n')
                     for r in results:
-                        logfile.write('accuracy:{}\n'.format(r[0]))
-                        logfile.write('precision:{}\n'.format(r[1]))
-                        logfile.write('recall:{}\n'.format(r[2]))
-                        logfile.write('fscore:{}\n\n'.format(r[3]))
-                    logfile.write(template.format(accuracy, precision, recall, fscore))
+                        logfile.write('loss:{}\n'.format(r[0]))
+                        logfile.write('accuracy:{}\n'.format(r[1]))
+                        logfile.write('precision:{}\n'.format(r[2]))
+                        logfile.write('recall:{}\n'.format(r[3]))
+                        logfile.write('AUC:{}\n'.format(r[4]))
+                        logfile.write('fscore:{}\n\n'.format(r[5]))
+                    logfile.write('\n###### Model Summary ######\n\n')
+                    model.summary(print_fn=lambda x: logfile.write(x + '\n'))
+                    logfile.write(template.format(loss, accuracy, precision, recall, auc, fscore))
+                    logfile.write(evaluation.format_intervals(intervals))
                     logfile.write('TP:{}\n'.format(bestTP))
                     logfile.write('TN:{}\n'.format(bestTN))
                     logfile.write('FP:{}\n'.format(bestFP))
                     logfile.write('FN:{}\n'.format(bestFN))
-            
+                    logfile.write('\n###### Metrics history for {} epochs: ######\n\n'.format(len(history.epoch)))
+                    for epoch in history.epoch:
+                        metricsHistory = history.history
+                        logfile.write('Epoch {}: '.format(epoch + 1))
+                        for key in metricsHistory.keys():
+                            logfile.write('{}: {},'.format(key, metricsHistory[key][epoch]))
+                            logfile.write(' ')
+                        logfile.write('\n')
+                    logfile.write('\n##### Raw metrics history #####\n\n')
+                    pprint(metricsHistory, logfile)
+
             if save:
                 directory = "saved_models"
                 Path(directory).mkdir(parents=True, exist_ok=True)
-                bestModel.save_weights(directory + '/' + model_type + str(math.trunc(time.time())))
-        else:
-            model.fit(training_dataset_embeddings, training_ex_emb, training_dataset_labels)
-            model.evaluate(test_dataset_embeddings, test_ex_emb, test_dataset_labels)
-    elif (model_type == 'classed'):
-        model.fit(training_dataset, test_dataset, EPOCHS)
-else:
-    try:
-        model.load_weights('tf_weights.h5')
-    except ImportError as h5_err:
-        print(h5_err)
-        print("You need to install h5py to load a TensorFlow model, aborting...")
-    except IOError as io_err:
-        print(io_err)
-        print("Couldn't find a saved TensorFlow model, aborting...")
-        
\ No newline at end of file
+                model_file = directory + '/' + model_type + str(math.trunc(time.time()))
+                save_model(bestModel, model_file)
+        elif (model_type == 'svm'):
+            template = '\n###### Test results ######\n\nTest Accuracy: {},\nTest Precision: {},\nTest Recall: {},\nTest F-Score: {}\n'
+            if (use_kfold):
+                results = np.zeros((num_folds,4))
+
+                dataset_labels = np.append(training_dataset_labels, test_dataset_labels, 0)
+
+                training_texts = [a[0] for a in training_dataset_text]
+                test_texts = [a[0] for a in test_dataset_text]
+
+                dataset_texts = list(training_texts)
+                dataset_texts.extend(test_texts)
+
+                # Blocks are featurized once for every fold, DMD is cached on disk
+                emb_file = compact.COMPACT_FILE if compact_emb else compact.FULL_MODEL
+                feature_blocks = features.dataset_blocks(svm_blocks, dataset_texts, features.embeddings_id(emb_file, word_dimension),
+                                                         np.append(training_dataset_embeddings, test_dataset_embeddings, 0),
+                                                         np.append(training_ex_emb, test_ex_emb, 0),
+                                                         np.append(bert_training_vectors, bert_test_vectors, 0) if use_bert else None,
+                                                         workers=os.cpu_count())
+                dataset_features = features.compose(feature_blocks, svm_blocks)
+
+                splits = fold_splits(manifest)
+                test_step = 0
+                bestScore = 0
+                bestTestSet = None
+                bestTestInput = None
+                bestTP = None
+                bestTN = None
+                bestFP = None
+                bestFN = None
+                bestTexts = None
+                bestScores = None
+                proportions = []
+                oof_labels = []
+                oof_scores = []
+
+                run = ExperimentRun(model_type, experiment_settings, fresh=fresh_run)
+                print('Run directory: {} ({} folds already done)'.format(run.directory, len(run.completed_folds())))
+                bestFold = None
+
+                for train_index, val_index in splits:
+                    training_labels = np.asarray([dataset_labels[i] for i in train_index])
+                    test_labels = np.asarray([dataset_labels[i] for i in val_index])
+                    proportions.append(evaluation.label_proportion(training_labels, test_labels))
+
+                    if run.is_done(test_step):
+                        saved = run.load_fold(test_step)
+                        metrics = saved['metrics']
+                        fold_scores = saved['scores']
+                        print('Fold {}: loaded from {}'.format(test_step, run.fold_dir(test_step)))
+                    else:
+                        model = SVM(svm_blocks)
+                        model.fit_features(dataset_features[train_index], training_labels)
+                        fold_scores = model.score_features(dataset_features[val_index])
+                        metrics = evaluation.evaluate(test_labels, fold_scores, 0.0)
+                        run.save_fold(test_step, model, metrics, val_index, test_labels, fold_scores)
+
+                    oof_labels.append(test_labels)
+                    oof_scores.append(fold_scores)
+                                                        
+                    results[test_step][0] = metrics['accuracy']
+                    results[test_step][1] = metrics['precision']
+                    results[test_step][2] = metrics['recall']
+                    results[test_step][3] = metrics['fscore']
+
+                    if bestFold is None or results[test_step][3] > bestScore:
+                        bestScore = results[test_step][3]
+                        bestFold = test_step
+                        bestTestSet = test_labels
+                        bestScores = fold_scores
+                        bestTP = metrics['tp']
+                        bestTN = metrics['tn']
+                        bestFP = metrics['fp']
+                        bestFN = metrics['fn']
+                        bestTexts = [dataset_texts[i] for i in val_index]
+                    
+                    test_step += 1
+
+                bestModel = run.load_weights(SVM(svm_blocks), bestFold)
+                
+                mean_results = np.mean(results, axis=0)
+                
+                accuracy = mean_results[0]
+                precision = mean_results[1]
+                recall = mean_results[2]
+                fscore = mean_results[3]
+
+                intervals = evaluation.bootstrap(np.concatenate(oof_labels), np.concatenate(oof_scores), 0.0)
+                print(template.format(accuracy, precision, recall, fscore))
+                print(evaluation.format_intervals(intervals))
+
+                # LinearSVC predicts the positive class for positive decision values
+                predictions = (bestScores > 0).astype(int)
+
+                predictionsFile = open(f'results/predictions{str(math.trunc(time.time()))}.txt', 'w')
+
+                with open('datasets/idorsPP.tsv') as tsvFile:
+                    reader = csv.DictReader(tsvFile, dialect='excel-tab')
+                    for r in reader:
+                        if r['pretext']:
+                            try:
+                                i = bestTexts.index(r['pretext'])
+                                predictionsFile.write(r['id'] + " || " + r['HS'] + " || " + r['OF'] + " || " + r['HT'] + " || " + str(predictions[i]) + " || " + r['text'] + "\n")
+                            except:
+                                pass
+
+                if not skipLogging:
+                    logDir = config['GENERAL']['LOGDIR']
+                    directory = logDir + '/' + date.today().strftime("%m-%d-%Y")
+                    Path(directory).mkdir(parents=True, exist_ok=True)
+                    with open(directory + '/' + dataset_tsv_file.split('.tsv')[0] + str(math.trunc(time.time())), 'w') as logfile:
+                        logfile.write('Using dataset: ' + dataset_tsv_file + '\n\n')
+                        logfile.write('Training dataset size: {}\n'.format(len(training_dataset_embeddings)))
+                        logfile.write('Test dataset size: {}\n'.format(len(test_dataset_embeddings)))
+                        logfile.write('\n###### Positive label proportion ######\n\n')
+                        for i, p in enumerate(proportions):
+                            logfile.write('For training in fold {}: {}\n'.format(i, p[0]))
+                            logfile.write('For test in fold {}: {}\n'.format(i, p[1]))
+                        logfile.write('For combined dataset: {}\n'.format(proportions[0][2]))
+                        logfile.write('\n###### Fold results ######\n\n')
+                        for r in results:
+                            logfile.write('accuracy:{}\n'.format(r[0]))
+                            logfile.write('precision:{}\n'.format(r[1]))
+                            logfile.write('recall:{}\n'.format(r[2]))
+                            logfile.write('fscore:{}\n\n'.format(r[3]))
+                        logfile.write(template.format(accuracy, precision, recall, fscore))
+                        logfile.write(evaluation.format_intervals(intervals))
+                        logfile.write('TP:{}\n'.format(bestTP))
+                        logfile.write('TN:{}\n'.format(bestTN))
+                        logfile.write('FP:{}\n'.format(bestFP))
+                        logfile.write('FN:{}\n'.format(bestFN))
+                
+                if save:
+                    directory = "saved_models"
+                    Path(directory).mkdir(parents=True, exist_ok=True)
+                    model_file = directory + '/' + model_type + str(math.trunc(time.time()))
+                    save_model(bestModel, model_file)
+            else:
+                model = SVM(svm_blocks)
+                model.fit(training_dataset_embeddings, training_ex_emb, bert_training_vectors, training_dataset_labels)
+                print(template.format(*model.evaluate(test_dataset_embeddings, test_ex_emb, bert_test_vectors, test_dataset_labels)[:4]))
+        elif (model_type == 'classed'):
+            model.fit(training_dataset, test_dataset, EPOCHS)
+    else:
+        try:
+            model.load_weights('tf_weights.h5')
+        except ImportError as h5_err:
+            print(h5_err)
+            print("You need to install h5py to load a TensorFlow model, aborting...")
+        except IOError as io_err:
+            print(io_err)
+            print("Couldn't find a saved TensorFlow model, aborting...")
+            
\ No newline at end of file
@@ -0,0 +1,149 @@
+import sys, os, time, json, itertools, configparser
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from fasttext import load_model
+
+from data_mgmt.data_mgmt import get_dataset, get_bert_texts, dataset_to_embeddings, fit_additional_embeddings, \
+    transform_additional_embeddings
+from data_mgmt.splits import fold_splits
+from models import evaluation, features
+from models.fasttext_model import compact, projection
+from models.svm import SVM
+from cli import get_option, require_manifest
+
+ABLATION_FILE = os.path.join(features.CACHE_DIR, 'ablation.json')
+# Tweets used to time the featurization of each block
+LATENCY_SAMPLE = 200
+
+def block_combinations(names):
+    # Every non-empty subset, in composition order
+    return [list(c) for r in range(1, len(names) + 1) for c in itertools.combinations(names, r)]
+
+def timed_ms(function, n):
+    start = time.perf_counter()
+    function()
+    return 1000 * (time.perf_counter() - start) / n
+
+def block_latencies(names, sample, ft_model, bert_sample=None, bert_encoder=None):
+    # Featurization cost in ms/tweet, from the raw pretext to the block
+    latencies = {}
+    if 'dmd' in names:
+        latencies['dmd'] = timed_ms(lambda: features.dmd_features(dataset_to_embeddings([(t, None) for t in sample], ft_model)),
+                                    len(sample))
+    if 'sent' in names:
+        _, embedder = fit_additional_embeddings(sample)
+        latencies['sent'] = timed_ms(lambda: transform_additional_embeddings(sample, embedder), len(sample))
+    if 'bert' in names and bert_encoder is not None:
+        latencies['bert'] = timed_ms(lambda: bert_encoder(bert_sample), len(bert_sample))
+    return latencies
+
+#### Parallel evaluation ####
+_blocks = None
+_labels = None
+_folds = None
+
+def _init_worker(blocks, labels, folds):
+    global _blocks, _labels, _folds
+    _blocks, _labels, _folds = blocks, labels, folds
+
+def evaluate_combination(names):
+    X = features.compose(_blocks, names)
+    fscores = []
+    scoring_time = 0.0
+    for train_index, val_index in _folds:
+        model = SVM(names)
+        model.fit_features(X[train_index], _labels[train_index])
+        start = time.perf_counter()
+        scores = model.score_features(X[val_index])
+        scoring_time += time.perf_counter() - start
+        fscores.append(evaluation.evaluate(_labels[val_index], scores, 0.0)['fscore'])
+
+    return {
+        'blocks': names,
+        'dimension': X.shape[1],
+        'fscore': float(np.mean(fscores)),
+        'fscore_std': float(np.std(fscores)),
+        'classifier_ms': 1000 * scoring_time / len(X),
+    }
+
+def run_ablation(blocks, labels, folds, latencies, workers=None):
+    # Blocks are composed inside the workers, only the cached arrays are shipped
+    combinations = block_combinations([b for b in features.BLOCKS if b in blocks and not features.is_empty(blocks[b])])
+    # fasttext (and TensorFlow with --use-bert) is loaded, which doesn't survive a fork
+    with ProcessPoolExecutor(max_workers=workers, mp_context=get_context('spawn'),
+                             initializer=_init_worker, initargs=(blocks, labels, folds)) as pool:
+        results = list(pool.map(evaluate_combination, combinations))
+
+    for r in results:
+        r['featurization_ms'] = sum(latencies.get(b, float('nan')) for b in r['blocks'])
+        r['latency_ms'] = r['featurization_ms'] + r['classifier_ms']
+
+    # A combination is dominated when another one is at least as good and cheaper
+    for r in results:
+        r['dominated'] = any(o is not r and o['fscore'] >= r['fscore'] and o['latency_ms'] < r['latency_ms']
+                             for o in results)
+
+    return sorted(results, key=lambda r: -r['fscore'])
+
+def format_table(results):
+    lines = ['{:<16} {:>6} {:>16} {:>12} {:>10}'.format('blocks', 'dim', 'F1', 'ms/tweet', '')]
+    for r in results:
+        lines.append('{:<16} {:>6} {:>8.4f} ±{:.4f} {:>12.3f} {:>10}'.format(
+            '+'.join(r['blocks']), r['dimension'], r['fscore'], r['fscore_std'], r['latency_ms'],
+            'dominated' if r['dominated'] else ''))
+    return '\n'.join(lines)
+
+if __name__ == "__main__":
+    # Usage: python -m models.ablation [--compact-emb] [--use-bert] [--workers N]
+    # Ignores the USE_*_EMB flags on purpose, every block that can be built is tried
+    config = configparser.ConfigParser()
+    config.read('conf.txt')
+    os.environ['LANGUAGE'] = config['GENERAL']['LANGUAGE']
+
+    manifest = require_manifest(config)
+
+    use_bert = '--use-bert' in sys.argv or config['EMBEDDINGS']['USE_BERT_EMB'] == 'true'
+    workers = int(get_option('--workers', os.cpu_count()))
+    emb_file = compact.COMPACT_FILE if '--compact-emb' in sys.argv else compact.FULL_MODEL
+    ft_model = compact.load_embeddings(emb_file) if '--compact-emb' in sys.argv else load_model(emb_file)
+    word_dimension = projection.word_dimension(config)
+
+    training_text, test_text, training_ex_emb, test_ex_emb = get_dataset(manifest=manifest)
+    dataset_text = training_text + test_text
+    texts = [ex[0] for ex in dataset_text]
+    labels = np.asarray([int(ex[1]) for ex in dataset_text])
+    ft_model = projection.project_embeddings(ft_model, texts, word_dimension)
+
+    bert_vectors = None
+    bert_texts = None
+    bert_encoder = None
+    if use_bert:
+        from models.bert_model import bert_model
+        from models.bert_model.vector_store import BertVectorStore
+
+        bert_texts = sum(get_bert_texts(manifest), [])
+        bert_store = BertVectorStore(bert_model.model_id())
+        if bert_store.missing(bert_texts):
+            print("Some tweets have no stored BERT vector, run main.py with --use-bert --retrain-bert first, aborting...")
+            exit(0)
+        bert_vectors = bert_store.lookup(bert_texts)
+        bert_encoder = bert_model.BertEncoder()
+
+    names = [b for b in features.BLOCKS if b != 'bert' or use_bert]
+    blocks = features.dataset_blocks(names, texts, features.embeddings_id(emb_file, word_dimension),
+                                     dataset_to_embeddings(dataset_text, ft_model),
+                                     np.append(training_ex_emb, test_ex_emb, 0),
+                                     bert_vectors,
+                                     workers=workers)
+
+    latencies = block_latencies(names, texts[:LATENCY_SAMPLE], ft_model,
+                                bert_texts[:LATENCY_SAMPLE] if use_bert else None, bert_encoder)
+    results = run_ablation(blocks, labels, list(fold_splits(manifest)), latencies, workers)
+
+    with open(ABLATION_FILE, 'w') as f:
+        json.dump({'featurization_ms': latencies, 'results': results}, f, indent=2)
+
+    print('Featurization ms/tweet: ' + ', '.join('{}: {:.3f}'.format(b, ms) for b, ms in latencies.items()))
+    print(format_table(results))
@@ -0,0 +1,215 @@
+import sys, os, json, time, zlib, hashlib, configparser
+import numpy as np
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import score
+from data_mgmt.sync_votes import read_dataset, read_ambiguous, write_atomic
+from cli import get_option
+
+CACHE_DIR = 'active_learning'
+QUEUE_FILE = 'db_data/annotation_queue.json'
+REPORT_FILE = os.path.join(CACHE_DIR, 'queue_report.json')
+CHUNK_SIZE = 5000
+QUEUE_SIZE = 500
+# The diversity pass only looks at the most uncertain QUEUE_SIZE * CANDIDATE_FACTOR tweets
+CANDIDATE_FACTOR = 10
+# Weight of uncertainty against distance to the tweets already queued
+UNCERTAINTY_WEIGHT = 0.5
+
+def file_id(filename):
+    # Path plus mtime, Keras checkpoints are tracked through their .index file
+    for candidate in [filename, filename + '.index'] if filename else []:
+        if os.path.exists(candidate):
+            return '{}:{}'.format(candidate, os.path.getmtime(candidate))
+    return str(filename)
+
+def model_id(*filenames):
+    h = hashlib.sha1()
+    for filename in filenames:
+        h.update(file_id(filename).encode('utf-8'))
+        h.update(b'\0')
+    return h.hexdigest()[:16]
+
+class ScoreCache:
+    # Score and sentence vector of every pool tweet already seen by a model,
+    # keyed by tweet id and text. A daily refresh only scores the new tweets.
+    def __init__(self, model_id, directory=CACHE_DIR):
+        os.makedirs(directory, exist_ok=True)
+        self.filename = os.path.join(directory, 'scores_{}.npz'.format(model_id))
+        self.entries = {}
+        if os.path.exists(self.filename):
+            data = np.load(self.filename)
+            self.entries = {k: (s, v) for k, s, v in zip(data['keys'], data['scores'], data['vectors'])}
+
+    @staticmethod
+    def key(tweet_id, text):
+        return '{}:{}'.format(tweet_id, zlib.crc32(text.encode('utf-8')))
+
+    def save(self, keys):
+        # Only the tweets still in the pool are kept
+        keys = [k for k in keys if k in self.entries]
+        tmp_file = self.filename + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            np.savez(f, keys=np.array(keys, dtype=str),
+                     scores=np.array([self.entries[k][0] for k in keys], dtype=np.float64),
+                     vectors=np.array([self.entries[k][1] for k in keys], dtype=np.float32))
+        os.replace(tmp_file, self.filename)
+
+def score_pool(tweets, cache, model_type, model_file, emb_file, sent_emb_file, language, projection_file=None,
+               chunk_size=CHUNK_SIZE, workers=os.cpu_count()):
+    # Scores and sentence vectors of every tweet in the pool, in input order.
+    # Tweets missing from the cache are scored in chunks by worker processes.
+    keys = [ScoreCache.key(tweet_id, text) for tweet_id, text in tweets]
+    missing = [t for t, k in zip(tweets, keys) if k not in cache.entries]
+    print('{} of {} tweets are cached, scoring {}'.format(len(tweets) - len(missing), len(tweets), len(missing)))
+
+    start = time.perf_counter()
+    if missing:
+        chunks = score.read_chunks(iter(missing), chunk_size)
+        with ProcessPoolExecutor(max_workers=workers,
+                                 mp_context=get_context('spawn'),
+                                 initializer=score.init_worker,
+                                 initargs=(model_type, model_file, emb_file, sent_emb_file, language, projection_file)) as pool:
+            # Two chunks per worker in flight at most, as in score.py
+            pending = deque()
+            done = 0
+            for chunk in chunks:
+                pending.append((chunk, pool.submit(score.featurize_chunk, chunk)))
+                if len(pending) >= 2 * workers:
+                    done += _add_chunk(cache, *pending.popleft())
+                    print('{} tweets scored, {:.1f} tweets/sec'.format(done, done / (time.perf_counter() - start)))
+            while pending:
+                done += _add_chunk(cache, *pending.popleft())
+        cache.save(keys)
+    seconds = time.perf_counter() - start
+
+    scores = np.array([cache.entries[k][0] for k in keys], dtype=np.float64)
+    vectors = np.array([cache.entries[k][1] for k in keys], dtype=np.float32)
+    return scores, vectors, {'scored': len(missing), 'cached': len(tweets) - len(missing), 'scoring_seconds': seconds,
+                             'tweets_per_second': len(missing) / max(seconds, 1e-9)}
+
+def _add_chunk(cache, chunk, future):
+    _, scores, vectors = future.result()
+    for (tweet_id, text), s, v in zip(chunk, scores, vectors):
+        cache.entries[ScoreCache.key(tweet_id, text)] = (s, v)
+    return len(chunk)
+
+#### Ranking ####
+def uncertainty(scores, threshold):
+    # 1 for the tweet closest to the decision threshold, 0 for the farthest.
+    # Ranks work the same for SVM margins and probabilities.
+    margins = np.abs(scores - threshold)
+    ranks = np.empty(len(margins))
+    ranks[np.argsort(margins, kind='stable')] = np.arange(len(margins))
+    return 1 - ranks / max(len(margins) - 1, 1)
+
+def rank_queue(vectors, uncertainties, size, candidates, weight=UNCERTAINTY_WEIGHT):
+    # Greedy maximal marginal relevance over the most uncertain tweets: each
+    # pick trades uncertainty against cosine distance to the tweets already in
+    # the queue, so near duplicates and copypasta aren't queued together.
+    # Nothing to rank (empty pool, or no tweet could be scored) gives an
+    # empty queue.
+    if not len(uncertainties) or not size:
+        return np.zeros(0, dtype=int)
+    candidates = np.argsort(-uncertainties, kind='stable')[:candidates]
+    norms = np.linalg.norm(vectors[candidates], axis=1, keepdims=True)
+    unit = vectors[candidates] / np.maximum(norms, 1e-12)
+
+    distance = np.ones(len(candidates))
+    available = np.ones(len(candidates), dtype=bool)
+    queue = []
+    for _ in range(min(size, len(candidates))):
+        gain = weight * uncertainties[candidates] + (1 - weight) * np.minimum(distance, 1)
+        gain[~available] = -np.inf
+        pick = int(np.argmax(gain))
+        queue.append(candidates[pick])
+        available[pick] = False
+        distance = np.minimum(distance, 1 - unit @ unit[pick])
+    return np.array(queue, dtype=int)
+
+def mean_similarity(vectors):
+    # Mean pairwise cosine similarity, lower is more diverse
+    if len(vectors) < 2:
+        return 0.0
+    unit = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    similarities = unit @ unit.T
+    return float((similarities.sum() - np.trace(similarities)) / (len(vectors) * (len(vectors) - 1)))
+
+#### Pool and queue files ####
+def read_pool(pool_file):
+    # Tweets without votes, e.g. `python db_data/query.py ... --commands unlabeled`.
+    # Tweets already in the dataset or in ambiguous.json are left out.
+    known = set(read_dataset()) | set(json.loads(line)['tweet_id'] for line in read_ambiguous())
+    tweets = [(str(tweet_id), text) for tweet_id, text in score.read_tweets(pool_file)]
+    return [t for t in tweets if t[0] not in known], len(tweets)
+
+def export_queue(tweets, queue_file=QUEUE_FILE):
+    # Same format as ambiguous.json
+    lines = [json.dumps({"tweet_id": tweet_id, "text": text.replace("\\n", "\n")}) + "\n" for tweet_id, text in tweets]
+    write_atomic(queue_file, lambda f: f.writelines(lines))
+
+def build_queue(pool_file, model_type, model_file, emb_file, sent_emb_file, language, projection_file=None,
+                size=QUEUE_SIZE, weight=UNCERTAINTY_WEIGHT, chunk_size=CHUNK_SIZE, workers=os.cpu_count(),
+                queue_file=QUEUE_FILE):
+    start = time.perf_counter()
+    tweets, pool_size = read_pool(pool_file)
+    cache = ScoreCache(model_id(model_file, emb_file, sent_emb_file, projection_file))
+    scores, vectors, report = score_pool(tweets, cache, model_type, model_file, emb_file, sent_emb_file, language,
+                                         projection_file, chunk_size, workers)
+
+    # Tweets that are empty after preprocessing have no score
+    valid = np.flatnonzero(~np.isnan(scores))
+    threshold = 0.0 if model_type == 'svm' else 0.5
+    uncertainties = uncertainty(scores[valid], threshold)
+    queue = valid[rank_queue(vectors[valid], uncertainties, size, size * CANDIDATE_FACTOR, weight)]
+    most_uncertain = valid[np.argsort(-uncertainties, kind='stable')[:size]]
+
+    export_queue([tweets[i] for i in queue], queue_file)
+
+    report.update({
+        'pool': pool_size,
+        'unlabeled': len(tweets),
+        'unscorable': len(tweets) - len(valid),
+        'queue': len(queue),
+        'queue_positive_rate': float(np.mean(scores[queue] > threshold)) if len(queue) else 0.0,
+        'queue_mean_margin': float(np.mean(np.abs(scores[queue] - threshold))) if len(queue) else 0.0,
+        # Diversity gained over taking the most uncertain tweets only
+        'queue_mean_similarity': mean_similarity(vectors[queue]),
+        'most_uncertain_mean_similarity': mean_similarity(vectors[most_uncertain]),
+        'seconds': time.perf_counter() - start,
+    })
+    write_atomic(REPORT_FILE, lambda f: json.dump(report, f, indent=2))
+    return report
+
+if __name__ == "__main__":
+    # Usage: python -m models.active_learning <pool.tsv|pool.jsonl> --model saved_models/<model>
+    #                                         [--model-type svm|functional] [--top-k 500] [--weight 0.5]
+    #                                         [--chunk-size N] [--workers N] [--compact-emb|--full-emb]
+    #                                         [--output file.json]
+    config = configparser.ConfigParser()
+    config.read('conf.txt')
+
+    model_file = get_option('--model', None)
+    if not model_file:
+        print("A saved model is needed (--model), aborting...")
+        exit(0)
+
+    # Same files, and the same defaults, as score.py
+    emb_file, sent_emb_file, projection_file = score.saved_model_files(model_file)
+
+    report = build_queue(sys.argv[1],
+                         get_option('--model-type', config['GENERAL']['MODEL_TYPE']),
+                         model_file,
+                         emb_file,
+                         sent_emb_file,
+                         config['GENERAL']['LANGUAGE'],
+                         projection_file,
+                         int(get_option('--top-k', QUEUE_SIZE)),
+                         float(get_option('--weight', UNCERTAINTY_WEIGHT)),
+                         int(get_option('--chunk-size', CHUNK_SIZE)),
+                         int(get_option('--workers', os.cpu_count())),
+                         get_option('--output', QUEUE_FILE))
+    print(json.dumps(report, indent=2))
@@ -0,0 +1,149 @@
+import sys, os, time, json, itertools, configparser
+import numpy as np
+
+# Latencies are for CPU inference, the serving target
+if '--gpu' not in sys.argv:
+    os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
+
+import tensorflow as tf
+
+from fasttext import load_model
+
+from data_mgmt.data_mgmt import get_dataset, dataset_to_embeddings
+from data_mgmt.splits import fold_splits
+from models import evaluation
+from models.fasttext_model.compact import FULL_MODEL
+from models.fasttext_model.projection import project_embeddings
+from models.functional_model import FunctionalModel, ENCODERS, HEADS
+from cli import get_option, require_manifest
+
+PROFILE_FILE = 'models/architectures.json'
+BATCH_SIZES = [1, 32, 256]
+REPEATS = 20
+PROFILE_FOLDS = 2
+PROFILE_EPOCHS = 3
+
+def batch_of(inputs, size):
+    # First rows of every input, repeated when the dataset is smaller than the batch
+    rows = np.resize(np.arange(len(inputs[0])), size)
+    return [x[rows] for x in inputs]
+
+def median_ms(function, repeats=REPEATS):
+    # Two untimed calls first, the first one traces the graph
+    function()
+    function()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return 1000 * float(np.median(times))
+
+def profile_speed(encoder, head, inputs, labels, batch_size, batch_sizes=BATCH_SIZES):
+    model = FunctionalModel(inputs[0][0].shape, inputs[1][0].shape, 0, False, encoder=encoder, head=head)
+
+    train_x = batch_of(inputs, batch_size)
+    train_y = labels[np.resize(np.arange(len(labels)), batch_size)]
+    result = {
+        'params': model.count_params(),
+        'train_step_ms': median_ms(lambda: model.train_on_batch(train_x, train_y)),
+        'latency_ms': {},
+    }
+
+    for size in batch_sizes:
+        x = batch_of(inputs, size)
+        result['latency_ms'][size] = median_ms(lambda: model.predict_on_batch(x))
+
+    tf.keras.backend.clear_session()
+    return result
+
+def kfold_fscore(encoder, head, inputs, labels, folds, epochs, batch_size):
+    fscores = []
+    for train_index, val_index in folds:
+        model = FunctionalModel(inputs[0][0].shape, inputs[1][0].shape, 0, False, encoder=encoder, head=head)
+        earlyStopping = tf.keras.callbacks.EarlyStopping(monitor='val_loss',
+                                                         patience=5,
+                                                         restore_best_weights=True)
+        model.fit([x[train_index] for x in inputs],
+                  labels[train_index],
+                  validation_split=0.2,
+                  shuffle=True,
+                  batch_size=batch_size,
+                  epochs=epochs,
+                  callbacks=[earlyStopping],
+                  verbose=0)
+        scores = model.predict([x[val_index] for x in inputs], batch_size=256)[:, 0]
+        fscores.append(evaluation.evaluate(labels[val_index], scores, 0.5)['fscore'])
+        tf.keras.backend.clear_session()
+
+    return float(np.mean(fscores)), float(np.std(fscores))
+
+def profile(architectures, inputs, labels, folds, epochs, batch_size, batch_sizes=BATCH_SIZES):
+    results = []
+    for encoder, head in architectures:
+        result = {'encoder': encoder, 'head': head}
+        result.update(profile_speed(encoder, head, inputs, labels, batch_size, batch_sizes))
+        result['fscore'], result['fscore_std'] = kfold_fscore(encoder, head, inputs, labels, folds, epochs, batch_size)
+        results.append(result)
+        print('{}+{} done'.format(encoder, head))
+    return results
+
+def best_within(results, slo_ms, slo_batch):
+    # Best F-score among the architectures that score a slo_batch batch within slo_ms
+    within = [r for r in results if r['latency_ms'][slo_batch] <= slo_ms]
+    return max(within, key=lambda r: r['fscore']) if within else None
+
+def format_table(results, batch_sizes=BATCH_SIZES):
+    header = '{:<18} {:>9} {:>9} {:>16}'.format('architecture', 'params', 'step ms', 'F1')
+    header += ''.join('{:>12}'.format('b{} ms'.format(size)) for size in batch_sizes)
+    lines = [header]
+    for r in results:
+        line = '{:<18} {:>9} {:>9.2f} {:>8.4f} ±{:.4f}'.format(r['encoder'] + '+' + r['head'], r['params'],
+                                                            r['train_step_ms'], r['fscore'], r['fscore_std'])
+        line += ''.join('{:>12.2f}'.format(r['latency_ms'][size]) for size in batch_sizes)
+        lines.append(line)
+    return '\n'.join(lines)
+
+if __name__ == "__main__":
+    # Usage: python -m models.arch_profile [--encoders lstm,conv] [--heads haternet,tass] [--folds 2] [--epochs 3]
+    #                                       [--batch-sizes 1,32,256] [--slo-ms 50 --slo-batch 1] [--gpu]
+    config = configparser.ConfigParser()
+    config.read('conf.txt')
+    os.environ['LANGUAGE'] = config['GENERAL']['LANGUAGE']
+
+    manifest = require_manifest(config)
+
+    encoders = get_option('--encoders', ','.join(ENCODERS)).split(',')
+    heads = get_option('--heads', ','.join(HEADS)).split(',')
+    num_folds = int(get_option('--folds', PROFILE_FOLDS))
+    epochs = int(get_option('--epochs', PROFILE_EPOCHS))
+    batch_sizes = [int(size) for size in get_option('--batch-sizes', ','.join(map(str, BATCH_SIZES))).split(',')]
+
+    training_text, test_text, training_ex_emb, test_ex_emb = get_dataset(manifest=manifest)
+    dataset_text = training_text + test_text
+    labels = np.asarray([int(ex[1]) for ex in dataset_text])
+    word_model = project_embeddings(load_model(FULL_MODEL), [ex[0] for ex in dataset_text])
+    inputs = [dataset_to_embeddings(dataset_text, word_model), np.append(training_ex_emb, test_ex_emb, 0)]
+
+    # A short run over the first folds, enough to rank architectures
+    folds = list(itertools.islice(fold_splits(manifest), num_folds))
+    results = profile(list(itertools.product(encoders, heads)), inputs, labels, folds, epochs,
+                      int(config['GENERAL']['BATCH_SIZE']), batch_sizes)
+
+    report = {'folds': num_folds, 'epochs': epochs, 'cpu': '--gpu' not in sys.argv, 'results': results}
+    print(format_table(results, batch_sizes))
+
+    slo_ms = get_option('--slo-ms', None)
+    if slo_ms:
+        slo_batch = int(get_option('--slo-batch', batch_sizes[0]))
+        best = best_within(results, float(slo_ms), slo_batch)
+        report['slo'] = {'ms': float(slo_ms), 'batch_size': slo_batch,
+                         'best': None if best is None else best['encoder'] + '+' + best['head']}
+        if best is None:
+            print('No architecture scores a batch of {} within {} ms'.format(slo_batch, slo_ms))
+        else:
+            print('Best within {} ms at batch {}: WORD_COMBINATION_STRATEGY = {}, HEAD = {}'.format(
+                slo_ms, slo_batch, best['encoder'], best['head']))
+
+    with open(PROFILE_FILE, 'w') as f:
+        json.dump(report, f, indent=2)
@@ -2,6 +2,12 @@ import bert, configparser, os
 
 from tensorflow import keras
 
+from data_mgmt.data_mgmt import create_bert_tokenizer, tokenize_for_bert, pad_token_ids, get_bert_texts
+
+BATCH_SIZE = 64
+# Rows of the position embeddings table
+MAX_SEQ_LENGTH = 512
+
 def get_bert_layer(bert_model_dir):
     bert_params = bert.params_from_pretrained_ckpt(bert_model_dir)
     l_bert = bert.BertModelLayer.from_params(bert_params, trainable=False, name="bert")
@@ -28,4 +34,33 @@ def BertModel(bertTokensShape):
     bert_ckpt_file = os.path.join(bert_model_dir, bert_ckpt)
     bert.load_stock_weights(bert_layer, bert_ckpt_file)
 
-    return model
\ No newline at end of file
+    return model
+
+def corpus_max_length(texts=None, tokenizer=None):
+    # Longest tokenized tweet ([CLS] and [SEP] included), capped at
+    # MAX_SEQ_LENGTH. Every tweet of the split manifest by default.
+    if texts is None:
+        training_texts, test_texts = get_bert_texts()
+        texts = training_texts + test_texts
+    token_ids = tokenize_for_bert(texts, tokenizer or create_bert_tokenizer())
+    return min(MAX_SEQ_LENGTH, max(map(len, token_ids), default=2))
+
+def model_id():
+    config = configparser.ConfigParser()
+    config.read('conf.txt')
+    return config['GENERAL']['BERT_MODEL_DIR'] + '/' + config['GENERAL']['BERT_CKPT']
+
+class BertEncoder:
+    # Text in, CLS vectors out. bert-for-tf2 slices its position embeddings
+    # with the static input length, so the model is built for max_length
+    # tokens (the corpus maximum by default) and every batch is padded to it.
+    def __init__(self, batch_size=BATCH_SIZE, max_length=None):
+        self.batch_size = batch_size
+        self.tokenizer = create_bert_tokenizer()
+        self.max_length = max_length or corpus_max_length(tokenizer=self.tokenizer)
+        self.model = BertModel((self.max_length,))
+        self.model_id = model_id()
+
+    def __call__(self, texts):
+        token_ids = pad_token_ids(tokenize_for_bert(texts, self.tokenizer), self.max_length)
+        return self.model.predict(token_ids, batch_size=self.batch_size)
@@ -0,0 +1,123 @@
+import sys, os, time, json, configparser
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from cli import get_option, require_manifest
+
+SCALING_FILE = 'models/bert_model/scaling.json'
+BENCHMARK_SAMPLE = 2048
+# Interop threads per worker, each worker runs one model at a time
+INTER_OP_THREADS = 1
+
+# Per-process state, filled by _init_worker
+worker = {}
+
+def _init_worker(threads, batch_size, max_length):
+    # The thread budget has to be set before TensorFlow creates its pools
+    os.environ['OMP_NUM_THREADS'] = str(threads)
+    os.environ['TF_NUM_INTRAOP_THREADS'] = str(threads)
+    os.environ['TF_NUM_INTEROP_THREADS'] = str(INTER_OP_THREADS)
+
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(INTER_OP_THREADS)
+
+    from models.bert_model.bert_model import BertEncoder
+    worker['encoder'] = BertEncoder(batch_size, max_length)
+
+def _encode_shard(texts):
+    return worker['encoder'](texts)
+
+class ShardedBertEncoder:
+    # Drop-in for BertEncoder: texts are split into contiguous shards encoded
+    # by workers processes, each with its own BertModel and threads TF threads.
+    # Shards are merged back in input order. Every worker builds its model for
+    # max_length tokens (the corpus maximum by default).
+    def __init__(self, workers=None, threads=1, batch_size=64, max_length=None):
+        if max_length is None:
+            from models.bert_model.bert_model import corpus_max_length
+            max_length = corpus_max_length()
+        self.threads = threads
+        self.workers = workers or max(1, os.cpu_count() // threads)
+        self.batch_size = batch_size
+        self.max_length = max_length
+        # TensorFlow doesn't survive a fork
+        self.pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=get_context('spawn'),
+                                        initializer=_init_worker, initargs=(threads, batch_size, max_length))
+
+    def __call__(self, texts):
+        if not texts:
+            return np.zeros((0, 0), dtype=np.float32)
+        shard_size = -(-len(texts) // self.workers)
+        shards = [texts[i:i + shard_size] for i in range(0, len(texts), shard_size)]
+        return np.concatenate(list(self.pool.map(_encode_shard, shards)), 0)
+
+    def warm_up(self):
+        # Loads the checkpoint in every worker
+        list(self.pool.map(_encode_shard, [['warm up'] for _ in range(self.workers)]))
+
+    def extraction_batch(self):
+        # Texts per store shard: a few batches for every worker
+        return self.workers * self.batch_size * 4
+
+    def close(self):
+        self.pool.shutdown()
+
+#### Scaling curve ####
+def default_layouts(cores=None):
+    # Every workers x threads split of the cores
+    cores = cores or os.cpu_count()
+    return [(w, cores // w) for w in range(1, cores + 1) if cores % w == 0]
+
+def throughput(layout, texts, batch_size=64, max_length=None):
+    encoder = ShardedBertEncoder(layout[0], layout[1], batch_size, max_length)
+    try:
+        encoder.warm_up()
+        start = time.perf_counter()
+        encoder(texts)
+        return len(texts) / (time.perf_counter() - start)
+    finally:
+        encoder.close()
+
+def scaling_curve(texts, layouts, batch_size=64, max_length=None):
+    results = []
+    for workers, threads in layouts:
+        tweets_per_second = throughput((workers, threads), texts, batch_size, max_length)
+        results.append({'workers': workers, 'threads': threads, 'tweets_per_second': tweets_per_second})
+        print('{} workers x {} threads: {:.1f} tweets/sec'.format(workers, threads, tweets_per_second))
+    return results
+
+if __name__ == "__main__":
+    # Usage: python -m models.bert_model.sharded [--workers N] [--threads N]
+    #        python -m models.bert_model.sharded --benchmark [--layouts 1x64,8x8,64x1] [--sample 2048]
+    from data_mgmt.data_mgmt import get_bert_texts
+    from models.bert_model import bert_model
+    from models.bert_model.vector_store import BertVectorStore, extract
+
+    config = configparser.ConfigParser()
+    config.read('conf.txt')
+    os.environ['LANGUAGE'] = config['GENERAL']['LANGUAGE']
+
+    manifest = require_manifest(config)
+    training_texts, test_texts = get_bert_texts(manifest)
+    texts = training_texts + test_texts
+
+    if '--benchmark' in sys.argv:
+        layouts = get_option('--layouts', None)
+        layouts = [tuple(int(n) for n in l.split('x')) for l in layouts.split(',')] if layouts else default_layouts()
+        sample = texts[:int(get_option('--sample', BENCHMARK_SAMPLE))]
+
+        results = scaling_curve(sample, layouts, max_length=bert_model.corpus_max_length(texts))
+        best = max(results, key=lambda r: r['tweets_per_second'])
+        with open(SCALING_FILE, 'w') as f:
+            json.dump({'cores': os.cpu_count(), 'sample': len(sample), 'results': results, 'best': best}, f, indent=2)
+        print('Best layout: --workers {} --threads {}'.format(best['workers'], best['threads']))
+    else:
+        threads = int(get_option('--threads', 1))
+        encoder = ShardedBertEncoder(int(get_option('--workers', 0)) or None, threads,
+                                     max_length=bert_model.corpus_max_length(texts))
+        try:
+            extract(BertVectorStore(bert_model.model_id()), texts, encoder, encoder.extraction_batch())
+        finally:
+            encoder.close()
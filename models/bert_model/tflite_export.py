@@ -0,0 +1,161 @@
+import sys, os, time, json, queue, hashlib
+import numpy as np
+import tensorflow as tf
+
+from concurrent.futures import ThreadPoolExecutor
+
+from data_mgmt.data_mgmt import create_bert_tokenizer, tokenize_for_bert, pad_token_ids
+from models.bert_model import bert_model
+from cli import get_option
+
+TFLITE_FILE = 'models/bert_model/bert_cls_int8.tflite'
+BATCH_SIZE = 32
+BENCHMARK_SAMPLE = 512
+
+def export(output_file=TFLITE_FILE, max_length=None):
+    # The sequence length is fixed at export time, the batch size stays dynamic
+    model = bert_model.BertModel((max_length or bert_model.corpus_max_length(),))
+
+    # Dynamic-range quantization: int8 weights, float activations
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    tflite_model = converter.convert()
+
+    with open(output_file, 'wb') as f:
+        f.write(tflite_model)
+
+    return output_file
+
+def exported_length(model_file=TFLITE_FILE):
+    # Sequence length the model was exported with
+    interpreter = tf.lite.Interpreter(model_path=model_file)
+    return int(interpreter.get_input_details()[0]['shape'][1])
+
+def tflite_model_id(model_file=TFLITE_FILE):
+    # Vector store id. The vectors depend on the exported file (quantized
+    # weights, sequence length), not only on the checkpoint it came from.
+    h = hashlib.sha1()
+    with open(model_file, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return '{}#tflite-int8-{}-{}'.format(bert_model.model_id(), exported_length(model_file), h.hexdigest()[:16])
+
+class TfliteBertEncoder:
+    # Same interface as bert_model.BertEncoder. Batches are spread over
+    # num_interpreters interpreters, each running with num_threads threads.
+    def __init__(self, model_file=TFLITE_FILE, num_threads=1, num_interpreters=os.cpu_count(), batch_size=BATCH_SIZE):
+        self.batch_size = batch_size
+        self.num_interpreters = num_interpreters
+        self.tokenizer = create_bert_tokenizer()
+        self.model_id = tflite_model_id(model_file)
+
+        self.interpreters = queue.Queue()
+        for _ in range(num_interpreters):
+            self.interpreters.put(tf.lite.Interpreter(model_path=model_file, num_threads=num_threads))
+
+        # Length the model was exported with, every batch is padded to it
+        self.max_length = exported_length(model_file)
+
+    def _run(self, token_ids):
+        interpreter = self.interpreters.get()
+        try:
+            input_details = interpreter.get_input_details()[0]
+            output_details = interpreter.get_output_details()[0]
+
+            interpreter.resize_tensor_input(input_details['index'], token_ids.shape)
+            interpreter.allocate_tensors()
+            interpreter.set_tensor(input_details['index'], token_ids.astype(input_details['dtype']))
+            interpreter.invoke()
+
+            return interpreter.get_tensor(output_details['index']).copy()
+        finally:
+            self.interpreters.put(interpreter)
+
+    def __call__(self, texts):
+        token_ids = tokenize_for_bert(texts, self.tokenizer)
+        batches = [pad_token_ids(token_ids[i:i + self.batch_size], self.max_length)
+                   for i in range(0, len(token_ids), self.batch_size)]
+
+        # invoke() releases the GIL, so threads are enough to keep every
+        # interpreter busy
+        with ThreadPoolExecutor(max_workers=self.num_interpreters) as pool:
+            outputs = list(pool.map(self._run, batches))
+
+        return np.concatenate(outputs, 0)
+
+#### Parity check and benchmark ####
+def cosine_similarity(a, b):
+    norms = np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1)
+    return np.sum(a * b, axis=1) / np.maximum(norms, 1e-8)
+
+def throughput(encoder, texts):
+    start = time.perf_counter()
+    encoder(texts)
+    elapsed = time.perf_counter() - start
+    return {'tweets_per_sec': len(texts) / elapsed, 'ms_per_tweet': 1000 * elapsed / len(texts)}
+
+def downstream_fscores(float_vectors, tflite_vectors):
+    # SVM trained on float vectors, tested once with float and once with
+    # quantized test vectors
+    from fasttext import load_model
+    from data_mgmt.data_mgmt import get_dataset, dataset_to_embeddings
+    from models.fasttext_model.compact import FULL_MODEL
+    from models.fasttext_model.projection import project_embeddings
+    from models.svm import SVM
+    from models import evaluation
+
+    training_text, test_text, training_ex_emb, test_ex_emb = get_dataset()
+    ft_model = project_embeddings(load_model(FULL_MODEL), [ex[0] for ex in training_text + test_text])
+    training_emb = dataset_to_embeddings(training_text, ft_model)
+    test_emb = dataset_to_embeddings(test_text, ft_model)
+    training_labels = np.asarray([int(ex[1]) for ex in training_text])
+    test_labels = np.asarray([int(ex[1]) for ex in test_text])
+
+    num_train = len(training_text)
+    model = SVM()
+    model.fit(training_emb, training_ex_emb, float_vectors[:num_train], training_labels)
+
+    float_fscore = evaluation.evaluate(test_labels, model.score(test_emb, test_ex_emb, float_vectors[num_train:]), 0.0)['fscore']
+    tflite_fscore = evaluation.evaluate(test_labels, model.score(test_emb, test_ex_emb, tflite_vectors[num_train:]), 0.0)['fscore']
+
+    return float_fscore, tflite_fscore
+
+if __name__ == "__main__":
+    # Usage: python -m models.bert_model.tflite_export [--export] [--parity] [--benchmark]
+    #                                                   [--threads N] [--interpreters N]
+    threads = int(get_option('--threads', 1))
+    interpreters = int(get_option('--interpreters', os.cpu_count()))
+
+    if '--export' in sys.argv or not os.path.exists(TFLITE_FILE):
+        export()
+        print('Exported', TFLITE_FILE, '({:.1f} MB)'.format(os.path.getsize(TFLITE_FILE) / 2**20))
+
+    from data_mgmt.data_mgmt import get_bert_texts
+    training_texts, test_texts = get_bert_texts()
+    texts = training_texts + test_texts
+
+    tflite_encoder = TfliteBertEncoder(num_threads=threads, num_interpreters=interpreters)
+    # Both models see the same padding
+    float_encoder = bert_model.BertEncoder(max_length=tflite_encoder.max_length)
+    report = {}
+
+    if '--parity' in sys.argv:
+        float_vectors = float_encoder(texts)
+        tflite_vectors = tflite_encoder(texts)
+        cosine = cosine_similarity(float_vectors, tflite_vectors)
+        float_fscore, tflite_fscore = downstream_fscores(float_vectors, tflite_vectors)
+        report['parity'] = {
+            'mean_cosine': float(np.mean(cosine)),
+            'min_cosine': float(np.min(cosine)),
+            'float_fscore': float_fscore,
+            'tflite_fscore': tflite_fscore,
+        }
+
+    if '--benchmark' in sys.argv:
+        sample = texts[:BENCHMARK_SAMPLE]
+        report['float'] = throughput(float_encoder, sample)
+        for layout in [(1, 1), (1, interpreters), (threads, max(1, interpreters // threads))]:
+            encoder = TfliteBertEncoder(num_threads=layout[0], num_interpreters=layout[1])
+            report['tflite_{}threads_x{}'.format(*layout)] = throughput(encoder, sample)
+
+    print(json.dumps(report, indent=2))
@@ -0,0 +1,79 @@
+import os, glob, hashlib
+import numpy as np
+
+STORE_DIR = 'bert_vectors'
+EXTRACTION_BATCH = 512
+
+def vector_key(text, model_id):
+    return hashlib.sha1((model_id + '\0' + text).encode('utf-8')).hexdigest()
+
+class BertVectorStore:
+    # CLS vectors keyed by hash(checkpoint id, preprocessed text). Every
+    # extraction batch is written as its own shard, so an interrupted run
+    # keeps everything up to its last finished batch.
+    def __init__(self, model_id, directory=STORE_DIR):
+        self.model_id = model_id
+        self.directory = os.path.join(directory, hashlib.sha1(model_id.encode('utf-8')).hexdigest()[:12])
+        os.makedirs(self.directory, exist_ok=True)
+
+        with open(os.path.join(self.directory, 'model_id.txt'), 'w') as f:
+            f.write(model_id + '\n')
+
+        self.shards = []
+        self.index = {}
+        for shard_file in sorted(glob.glob(os.path.join(self.directory, 'shard_*.npz'))):
+            self._load_shard(shard_file)
+
+    def _load_shard(self, shard_file):
+        data = np.load(shard_file)
+        shard = len(self.shards)
+        self.shards.append(data['vectors'])
+        for row, key in enumerate(data['keys']):
+            self.index[key.decode('ascii')] = (shard, row)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, text):
+        return vector_key(text, self.model_id) in self.index
+
+    def missing(self, texts):
+        seen = set()
+        result = []
+        for text in texts:
+            key = vector_key(text, self.model_id)
+            if key not in self.index and key not in seen:
+                seen.add(key)
+                result.append(text)
+        return result
+
+    def add(self, texts, vectors):
+        keys = np.asarray([vector_key(t, self.model_id).encode('ascii') for t in texts])
+        shard_file = os.path.join(self.directory, 'shard_{:06d}.npz'.format(len(self.shards)))
+
+        # Written under a temporary name first so a crash never leaves a
+        # truncated shard behind
+        tmp_file = shard_file + '.tmp.npz'
+        np.savez(tmp_file, keys=keys, vectors=np.asarray(vectors, dtype=np.float32))
+        os.replace(tmp_file, shard_file)
+
+        self._load_shard(shard_file)
+
+    def lookup(self, texts):
+        vectors = []
+        for text in texts:
+            shard, row = self.index[vector_key(text, self.model_id)]
+            vectors.append(self.shards[shard][row])
+        return np.asarray(vectors)
+
+def extract(store, texts, encoder, batch_size=EXTRACTION_BATCH):
+    missing = store.missing(texts)
+    print('{} distinct tweets, {} already in the store, {} to compute'.format(
+        len(set(texts)), len(set(texts)) - len(missing), len(missing)))
+
+    for start in range(0, len(missing), batch_size):
+        batch = missing[start:start + batch_size]
+        store.add(batch, encoder(batch))
+        print('{}/{} BERT vectors computed'.format(min(start + batch_size, len(missing)), len(missing)))
+
+    return len(missing)
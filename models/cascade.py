@@ -0,0 +1,203 @@
+import os, time, json, tempfile, configparser
+import numpy as np
+import tensorflow as tf
+
+from fasttext import load_model
+
+from data_mgmt.data_mgmt import get_dataset, dataset_to_embeddings
+from data_mgmt.splits import fold_splits
+from models import evaluation, features
+from models.fasttext_model import baseline
+from models.fasttext_model.compact import FULL_MODEL
+from models.fasttext_model.projection import project_embeddings
+from models.functional_model import FunctionalModel
+from models.svm import SVM
+from cli import get_option, require_manifest
+
+CASCADE_FILE = 'models/fasttext_model/cascade.json'
+FASTTEXT_CLASSIFIER = 'models/fasttext_model/baseline.bin'
+MAX_ACCURACY_LOSS = 0.005
+GRID_SIZE = 50
+
+class CascadeScorer:
+    # fasttext decides alone when its probability is outside (low, high),
+    # everything else is escalated to the expensive model
+    def __init__(self, ft_classifier, expensive_predict, low, high):
+        self.ft_classifier = ft_classifier
+        self.expensive_predict = expensive_predict
+        self.low = low
+        self.high = high
+        self.scored = 0
+        self.escalated = 0
+        self.elapsed = 0.0
+
+    def predict(self, pretexts, return_probabilities=False):
+        start = time.perf_counter()
+
+        probabilities = np.asarray(baseline.positive_probabilities(self.ft_classifier, pretexts))
+        predictions = (probabilities > 0.5).astype(int)
+
+        uncertain = np.flatnonzero((probabilities > self.low) & (probabilities < self.high))
+        if len(uncertain):
+            predictions[uncertain] = self.expensive_predict([pretexts[i] for i in uncertain])
+
+        self.scored += len(pretexts)
+        self.escalated += len(uncertain)
+        self.elapsed += time.perf_counter() - start
+
+        if return_probabilities:
+            return predictions, probabilities
+        return predictions
+
+    def report(self):
+        return {
+            'tweets_per_sec': self.scored / max(self.elapsed, 1e-9),
+            'escalation_rate': self.escalated / max(self.scored, 1),
+        }
+
+def load_cascade(expensive_predict, cascade_file=CASCADE_FILE, classifier_file=FASTTEXT_CLASSIFIER):
+    # Scorer with the band calibrated by python -m models.cascade, and the
+    # expensive model type it was calibrated for
+    with open(cascade_file) as f:
+        calibration = json.load(f)
+    scorer = CascadeScorer(load_model(classifier_file), expensive_predict, calibration['low'], calibration['high'])
+    return scorer, calibration['model_type']
+
+def cascade_predictions(probabilities, expensive_predictions, low, high):
+    accepted = (probabilities <= low) | (probabilities >= high)
+    return np.where(accepted, probabilities > 0.5, expensive_predictions).astype(int), accepted
+
+def tune_band(labels, probabilities, expensive_predictions, max_accuracy_loss=MAX_ACCURACY_LOSS):
+    # Every (low, high) pair from a grid of probability quantiles is tried at
+    # once, the band with the fewest escalations inside the accuracy budget wins.
+    # -inf/+inf bounds let a side (or both) accept nothing.
+    quantiles = np.unique(np.quantile(probabilities, np.linspace(0, 1, GRID_SIZE)))
+    lows = np.unique(np.concatenate([[-np.inf], quantiles[quantiles <= 0.5], [0.5]]))
+    highs = np.unique(np.concatenate([[0.5], quantiles[quantiles >= 0.5], [np.inf]]))
+
+    p = probabilities[None, None, :]
+    accepted = (p <= lows[:, None, None]) | (p >= highs[None, :, None])
+    predictions = np.where(accepted, p > 0.5, expensive_predictions[None, None, :])
+
+    accuracy = np.mean(predictions == labels[None, None, :], axis=2)
+    escalation = 1 - np.mean(accepted, axis=2)
+
+    reference = np.mean(expensive_predictions == labels)
+    feasible = accuracy >= reference - max_accuracy_loss
+    # Escalating everything (-inf, +inf) always matches the reference, so
+    # this only happens with a negative budget
+    if not feasible.any():
+        raise ValueError('No band keeps the accuracy loss within {}'.format(max_accuracy_loss))
+    escalation[~feasible] = np.inf
+    i, j = np.unravel_index(np.argmin(escalation), escalation.shape)
+
+    return float(lows[i]), float(highs[j])
+
+def expensive_fold_predictions(model_type, train_inputs, train_labels, test_inputs, epochs, batch_size, blocks):
+    # Returns the test predictions and the time spent scoring them
+    if model_type == 'svm':
+        model = SVM(blocks)
+        model.fit(*train_inputs, train_labels)
+        start = time.perf_counter()
+        predictions = (model.score(*test_inputs) > 0).astype(int)
+        return predictions, time.perf_counter() - start
+
+    model = FunctionalModel(train_inputs[0][0].shape, train_inputs[1][0].shape, 0, False)
+    earlyStopping = tf.keras.callbacks.EarlyStopping(monitor='val_loss',
+                                                     patience=5,
+                                                     restore_best_weights=True)
+    model.fit(list(train_inputs[:2]),
+              train_labels,
+              validation_split=0.2,
+              shuffle=True,
+              batch_size=batch_size,
+              epochs=epochs,
+              callbacks=[earlyStopping])
+    start = time.perf_counter()
+    predictions = (model.predict(list(test_inputs[:2]))[:, 0] > 0.5).astype(int)
+    elapsed = time.perf_counter() - start
+    tf.keras.backend.clear_session()
+    return predictions, elapsed
+
+def kfold_outputs(model_type, manifest, language, epochs, batch_size, blocks):
+    training_text, test_text, training_ex_emb, test_ex_emb = get_dataset(manifest=manifest)
+    dataset_text = training_text + test_text
+    texts = [ex[0] for ex in dataset_text]
+    labels = np.asarray([int(ex[1]) for ex in dataset_text])
+
+    word_model = project_embeddings(load_model(FULL_MODEL), texts)
+    word_vectors = dataset_to_embeddings(dataset_text, word_model)
+    sent_vectors = np.append(training_ex_emb, test_ex_emb, 0)
+    no_bert = np.zeros((len(texts), 0))
+
+    probabilities = np.zeros(len(texts))
+    expensive_predictions = np.zeros(len(texts), dtype=int)
+    timings = {'fasttext': 0.0, 'expensive': 0.0}
+
+    for train_index, val_index in fold_splits(manifest):
+        with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as fold_file:
+            for i in train_index:
+                fold_file.write('__label__{} {}\n'.format(labels[i], texts[i]))
+        ft_classifier = baseline.train(False, language, fold_file.name)
+        os.remove(fold_file.name)
+
+        start = time.perf_counter()
+        probabilities[val_index] = baseline.positive_probabilities(ft_classifier, [texts[i] for i in val_index])
+        timings['fasttext'] += time.perf_counter() - start
+
+        train_inputs = (word_vectors[train_index], sent_vectors[train_index], no_bert[train_index])
+        test_inputs = (word_vectors[val_index], sent_vectors[val_index], no_bert[val_index])
+        expensive_predictions[val_index], elapsed = expensive_fold_predictions(model_type, train_inputs, labels[train_index],
+                                                                               test_inputs, epochs, batch_size, blocks)
+        timings['expensive'] += elapsed
+
+    # Per-tweet scoring times. Word/sentence features are shared by both
+    # models here, so the expensive model's cost is a lower bound.
+    timings = {k: v / len(texts) for k, v in timings.items()}
+    return labels, probabilities, expensive_predictions, timings
+
+if __name__ == "__main__":
+    # Usage: python -m models.cascade [--expensive svm|functional] [--max-loss 0.005]
+    config = configparser.ConfigParser()
+    config.read('conf.txt')
+    language = config['GENERAL']['LANGUAGE']
+    os.environ['LANGUAGE'] = language
+
+    model_type = get_option('--expensive', config['GENERAL']['MODEL_TYPE'])
+    max_loss = float(get_option('--max-loss', MAX_ACCURACY_LOSS))
+
+    manifest = require_manifest(config)
+    # SVM feature blocks from the USE_*_EMB flags, as in main.py. The cascade
+    # has no BERT vectors.
+    blocks = [b for b in features.enabled_blocks(config) if b != 'bert']
+    labels, probabilities, expensive_predictions, timings = kfold_outputs(model_type,
+                                                                          manifest,
+                                                                          language,
+                                                                          int(config['GENERAL']['EPOCHS']),
+                                                                          int(config['GENERAL']['BATCH_SIZE']),
+                                                                          blocks)
+
+    low, high = tune_band(labels, probabilities, expensive_predictions, max_loss)
+    predictions, accepted = cascade_predictions(probabilities, expensive_predictions, low, high)
+    escalation_rate = 1 - np.mean(accepted)
+
+    expensive_metrics = evaluation.evaluate(labels, expensive_predictions, 0.5)
+    cascade_metrics = evaluation.evaluate(labels, predictions, 0.5)
+
+    cost_cascade = timings['fasttext'] + escalation_rate * timings['expensive']
+    report = {
+        'model_type': model_type,
+        'low': low,
+        'high': high,
+        'escalation_rate': escalation_rate,
+        'expensive_accuracy': expensive_metrics['accuracy'],
+        'cascade_accuracy': cascade_metrics['accuracy'],
+        'expensive_fscore': expensive_metrics['fscore'],
+        'cascade_fscore': cascade_metrics['fscore'],
+        'expensive_tweets_per_sec': 1 / max(timings['expensive'], 1e-12),
+        'cascade_tweets_per_sec': 1 / max(cost_cascade, 1e-12),
+    }
+
+    with open(CASCADE_FILE, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
@@ -0,0 +1,229 @@
+import sys, os, time, math, glob, hashlib, configparser
+import numpy as np
+import tensorflow as tf
+
+from pathlib import Path
+
+from data_mgmt import data_mgmt, splits
+from data_mgmt.normalize import get_normalizer
+from models import evaluation, features
+from models.bert_model import bert_model
+from models.fasttext_model import compact, projection
+from models.functional_model import FunctionalModel, get_architecture
+from models.svm import SVM
+from models import saved_model
+from score import read_tweets, saved_model_files
+from cli import get_option
+
+CACHE_DIR = 'distill'
+BERT_BATCH_SIZE = 64
+LATENCY_SAMPLE = 256
+
+def sigmoid(x):
+    return 1 / (1 + np.exp(-x))
+
+def content_hash(*parts):
+    h = hashlib.sha1()
+    for part in parts:
+        for item in part:
+            h.update(str(item).encode('utf-8'))
+            h.update(b'\0')
+    return h.hexdigest()[:16]
+
+def file_digest(filename):
+    # Hash of the saved model itself, Keras checkpoints are spread over an
+    # .index file and .data shards
+    files = [filename] if os.path.isfile(filename) else sorted(glob.glob(filename + '.index') + glob.glob(filename + '.data-*'))
+    h = hashlib.sha1()
+    for name in files:
+        with open(name, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+    return h.hexdigest()[:16]
+
+class Featurizer:
+    def __init__(self, ft_model, sent_embedder, use_bert=False):
+        self.ft_model = ft_model
+        self.sent_embedder = sent_embedder
+        self.use_bert = use_bert
+        self.bert = None
+
+    def __call__(self, pretexts, bert_texts):
+        word_vectors = data_mgmt.dataset_to_embeddings([(t,) for t in pretexts], self.ft_model)
+        sent_vectors = data_mgmt.transform_additional_embeddings(pretexts, self.sent_embedder)
+
+        if not self.use_bert:
+            return word_vectors, sent_vectors, np.zeros((len(pretexts), 0))
+
+        return word_vectors, sent_vectors, self.bert_vectors(bert_texts)
+
+    def bert_vectors(self, bert_texts):
+        # Built on first use for the corpus max length, as the vectors the
+        # teacher was trained on
+        if self.bert is None:
+            self.bert = bert_model.BertEncoder(BERT_BATCH_SIZE)
+        return self.bert(bert_texts)
+
+def load_model(model_type, model_file, example_dim, tweet_emb_dim, bert_dim, use_bert):
+    if model_type == 'svm':
+        model = SVM()
+        model.load_weights(model_file)
+    else:
+        # Encoder and head the model was saved with, conf.txt for older models
+        encoder, head = saved_model.load_settings(model_file).get('architecture', (None, None))
+        model = FunctionalModel(example_dim, tweet_emb_dim, bert_dim, use_bert, encoder=encoder, head=head)
+        model.load_weights(model_file).expect_partial()
+    return model
+
+def model_scores(model, model_type, inputs):
+    # Probabilities for both model types, LinearSVC margins go through a sigmoid
+    if model_type == 'svm':
+        return sigmoid(model.score(*inputs))
+
+    word_vectors, sent_vectors, bert_vectors = inputs
+    model_inputs = [word_vectors, sent_vectors]
+    if bert_vectors.shape[1] > 0:
+        model_inputs.append(bert_vectors)
+    return model.predict(model_inputs)[:, 0]
+
+def cached_teacher_scores(name, pretexts, bert_texts, teacher, teacher_type, teacher_file, featurizer):
+    cache_file = os.path.join(CACHE_DIR, '{}_{}.npy'.format(name, content_hash([file_digest(teacher_file)], pretexts)))
+    if os.path.exists(cache_file):
+        print('Using cached teacher scores from', cache_file)
+        return np.load(cache_file)
+
+    scores = model_scores(teacher, teacher_type, featurizer(pretexts, bert_texts))
+
+    Path(CACHE_DIR).mkdir(parents=True, exist_ok=True)
+    np.save(cache_file, scores)
+    return scores
+
+def read_split(split):
+    rows = splits.load_split(split)
+    labels = np.asarray([int(r['HS']) for r in rows])
+    return [r['pretext'] for r in rows], [r['btext'] for r in rows], labels
+
+def per_tweet_latency(model, model_type, featurizer, tweets, normalizer):
+    # A warm-up batch first, the BERT encoder build and the first predict
+    # call are not part of the per-tweet cost
+    views = [normalizer.normalize(t) for t in tweets[:BERT_BATCH_SIZE]]
+    model_scores(model, model_type, featurizer([v[0] for v in views], [v[1] for v in views]))
+
+    start = time.perf_counter()
+    views = [normalizer.normalize(t) for t in tweets]
+    pretexts = [v[0] for v in views]
+    bert_texts = [v[1] for v in views]
+    model_scores(model, model_type, featurizer(pretexts, bert_texts))
+    return 1000 * (time.perf_counter() - start) / len(tweets)
+
+def distill(pool_file, teacher_type, teacher_file, student_type, epochs, batch_size, language, emb_file, sent_emb_file,
+            student_blocks):
+    os.environ['LANGUAGE'] = language
+    normalizer = get_normalizer(language)
+
+    ft_model = compact.load_embeddings(emb_file)
+    # The student reuses the teacher's sentence embedder
+    sent_embedder = data_mgmt.load_sent_embedder(sent_emb_file)
+    tweet_emb_dim = (sent_embedder[1].n_components,)
+
+    # The teacher gets the word vectors it was trained with (the PCA saved
+    # next to it, if any)
+    teacher_word_model = projection.model_embeddings(ft_model, teacher_file)
+    teacher_featurizer = Featurizer(teacher_word_model, sent_embedder, use_bert=True)
+
+    # BETO base, the CLS vector has the hidden size of the encoder
+    teacher = load_model(teacher_type, teacher_file, (data_mgmt.MAX_WORDS, teacher_word_model.get_dimension()),
+                         tweet_emb_dim, (768,), True)
+
+    pool = [t for _, t in read_tweets(pool_file)]
+    views = [normalizer.normalize(t) for t in pool]
+    views = [v for v in views if v[0].strip() != ""]
+    pool_pretexts = [v[0] for v in views]
+    pool_bert_texts = [v[1] for v in views]
+    print('Unlabeled pool: {} tweets'.format(len(pool_pretexts)))
+
+    pool_scores = cached_teacher_scores('pool', pool_pretexts, pool_bert_texts, teacher, teacher_type, teacher_file, teacher_featurizer)
+
+    train_pretexts, _, train_labels = read_split('training')
+    test_pretexts, test_bert_texts, test_labels = read_split('test')
+
+    # Gold labels for the annotated tweets, teacher probabilities for the pool
+    student_pretexts = train_pretexts + pool_pretexts
+    student_targets = np.append(train_labels.astype(np.float64), pool_scores, 0)
+
+    student_word_model = projection.project_embeddings(ft_model, student_pretexts)
+    student_featurizer = Featurizer(student_word_model, sent_embedder, use_bert=False)
+    example_dim = (data_mgmt.MAX_WORDS, student_word_model.get_dimension())
+    word_vectors, sent_vectors, no_bert = student_featurizer(student_pretexts, None)
+
+    if student_type == 'svm':
+        student = SVM(student_blocks)
+        student.fit(word_vectors, sent_vectors, no_bert, (student_targets > 0.5).astype(int))
+    else:
+        encoder, head = get_architecture()
+        student = FunctionalModel(example_dim, tweet_emb_dim, 0, False, encoder=encoder, head=head)
+        earlyStopping = tf.keras.callbacks.EarlyStopping(monitor='val_loss',
+                                                    patience=5,
+                                                    restore_best_weights=True)
+        student.fit([word_vectors, sent_vectors],
+                    student_targets,
+                    validation_split=0.1,
+                    shuffle=True,
+                    batch_size=batch_size,
+                    epochs=epochs,
+                    callbacks=[earlyStopping])
+
+    teacher_test_scores = cached_teacher_scores('test', test_pretexts, test_bert_texts, teacher, teacher_type, teacher_file, teacher_featurizer)
+    student_test_scores = model_scores(student, student_type, student_featurizer(test_pretexts, None))
+
+    teacher_metrics = evaluation.evaluate(test_labels, teacher_test_scores, 0.5)
+    student_metrics = evaluation.evaluate(test_labels, student_test_scores, 0.5)
+
+    sample = pool[:LATENCY_SAMPLE]
+    teacher_latency = per_tweet_latency(teacher, teacher_type, teacher_featurizer, sample, normalizer)
+    student_latency = per_tweet_latency(student, student_type, student_featurizer, sample, normalizer)
+
+    print('\n###### Distillation results ######\n')
+    print('Teacher F-Score: {:.4f}, AUC: {:.4f}, {:.2f} ms/tweet'.format(teacher_metrics['fscore'], teacher_metrics['auc'], teacher_latency))
+    print('Student F-Score: {:.4f}, AUC: {:.4f}, {:.2f} ms/tweet'.format(student_metrics['fscore'], student_metrics['auc'], student_latency))
+    print('F-Score retained: {:.1f}%'.format(100 * student_metrics['fscore'] / max(teacher_metrics['fscore'], 1e-9)))
+    print('Latency saved: {:.1f}%'.format(100 * (1 - student_latency / teacher_latency)))
+
+    directory = "saved_models"
+    Path(directory).mkdir(parents=True, exist_ok=True)
+    student_file = directory + '/student_' + student_type + str(math.trunc(time.time()))
+    student.save_weights(student_file)
+    data_mgmt.save_sent_embedder(sent_embedder, student_file)
+    projection.save_projection(student_word_model, student_file)
+    settings = {'embeddings': emb_file}
+    if student_type == 'functional':
+        settings['architecture'] = [encoder, head]
+    saved_model.save_settings(student_file, settings)
+
+if __name__ == "__main__":
+    # Usage: python -m models.distill <pool.tsv|pool.jsonl> --teacher saved_models/<model>
+    #                                 [--teacher-type svm|functional] [--student svm|functional]
+    #                                 [--compact-emb|--full-emb]
+    config = configparser.ConfigParser()
+    config.read('conf.txt')
+
+    teacher_file = get_option('--teacher', None)
+    if not teacher_file:
+        print("A saved teacher model trained with --use-bert is needed (--teacher), aborting...")
+        exit(0)
+
+    # Word vectors and sentence embedder the teacher was saved with
+    emb_file, sent_emb_file, _ = saved_model_files(teacher_file)
+
+    distill(sys.argv[1],
+            get_option('--teacher-type', config['GENERAL']['MODEL_TYPE']),
+            teacher_file,
+            get_option('--student', 'functional'),
+            int(config['GENERAL']['EPOCHS']),
+            int(config['GENERAL']['BATCH_SIZE']),
+            config['GENERAL']['LANGUAGE'],
+            emb_file,
+            sent_emb_file,
+            # SVM feature blocks from the USE_*_EMB flags, as in main.py. The
+            # student doesn't use BERT.
+            [b for b in features.enabled_blocks(config) if b != 'bert'])
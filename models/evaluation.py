@@ -0,0 +1,210 @@
+import os
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+NUM_RESAMPLES = 10000
+RESAMPLE_CHUNK = 500
+# Resamples x examples below which the bootstrap runs in-process. Spawning
+# the workers costs more than it saves on smaller test sets.
+POOL_MIN_WORK = 10 ** 8
+CONFIDENCE = 0.95
+
+METRICS = ['accuracy', 'precision', 'recall', 'fscore', 'auc', 'pr_auc']
+
+def _divide(a, b):
+    a = np.asarray(a, dtype=np.float64)
+    b = np.asarray(b, dtype=np.float64)
+    return np.divide(a, b, out=np.zeros(np.broadcast(a, b).shape), where=b != 0)
+
+def label_proportion(train_labels, test_labels):
+    train_labels = np.asarray(train_labels)
+    test_labels = np.asarray(test_labels)
+
+    train_proportion = np.mean(train_labels == 1)
+    test_proportion = np.mean(test_labels == 1)
+    all_proportion = (np.sum(train_labels == 1) + np.sum(test_labels == 1)) / (len(train_labels) + len(test_labels))
+
+    return (train_proportion, test_proportion, all_proportion)
+
+def confusion_counts(labels, predictions):
+    labels = np.asarray(labels) == 1
+    predictions = np.asarray(predictions) == 1
+
+    tp = int(np.sum(labels & predictions))
+    tn = int(np.sum(~labels & ~predictions))
+    fp = int(np.sum(~labels & predictions))
+    fn = int(np.sum(labels & ~predictions))
+
+    return tp, tn, fp, fn
+
+def precision_recall_f1(tp, fp, fn):
+    precision = _divide(tp, tp + fp)
+    recall = _divide(tp, tp + fn)
+    fscore = _divide(2 * precision * recall, precision + recall)
+
+    return precision, recall, fscore
+
+def _score_groups(scores, descending=False):
+    order = np.argsort(-scores if descending else scores, kind='mergesort')
+    sorted_scores = scores[order]
+    starts = np.flatnonzero(np.r_[True, sorted_scores[1:] != sorted_scores[:-1]])
+    return order, starts
+
+def _weighted_auc(weights, labels, order, starts):
+    # Mann-Whitney statistic with tied scores counted as half, for every row
+    # of weights at once. order/starts sort the scores ascending.
+    y = labels[order]
+    w = weights[:, order]
+    positives = np.add.reduceat(w * y, starts, axis=1)
+    negatives = np.add.reduceat(w * (1 - y), starts, axis=1)
+    negatives_below = np.cumsum(negatives, axis=1) - negatives
+
+    pairs = positives.sum(axis=1) * negatives.sum(axis=1)
+    return _divide(np.sum(positives * (negatives_below + 0.5 * negatives), axis=1), pairs)
+
+def _weighted_average_precision(weights, labels, order, starts):
+    # order/starts sort the scores descending
+    y = labels[order]
+    w = weights[:, order]
+    positives = np.add.reduceat(w * y, starts, axis=1)
+    negatives = np.add.reduceat(w * (1 - y), starts, axis=1)
+    tp = np.cumsum(positives, axis=1)
+    fp = np.cumsum(negatives, axis=1)
+
+    precision = _divide(tp, tp + fp)
+    return _divide(np.sum(precision * positives, axis=1), positives.sum(axis=1))
+
+def _weighted_metrics(weights, labels, scores, threshold):
+    labels = np.asarray(labels, dtype=np.float64)
+    scores = np.asarray(scores, dtype=np.float64)
+    predictions = (scores > threshold).astype(np.float64)
+
+    tp = weights @ (labels * predictions)
+    fp = weights @ ((1 - labels) * predictions)
+    fn = weights @ (labels * (1 - predictions))
+    tn = weights @ ((1 - labels) * (1 - predictions))
+
+    precision, recall, fscore = precision_recall_f1(tp, fp, fn)
+
+    order, starts = _score_groups(scores)
+    auc = _weighted_auc(weights, labels, order, starts)
+    order, starts = _score_groups(scores, descending=True)
+    pr_auc = _weighted_average_precision(weights, labels, order, starts)
+
+    return {
+        'accuracy': _divide(tp + tn, tp + tn + fp + fn),
+        'precision': precision,
+        'recall': recall,
+        'fscore': fscore,
+        'auc': auc,
+        'pr_auc': pr_auc,
+    }
+
+def roc_auc(labels, scores):
+    return float(_weighted_metrics(np.ones((1, len(labels))), labels, scores, 0)['auc'][0])
+
+def pr_auc(labels, scores):
+    return float(_weighted_metrics(np.ones((1, len(labels))), labels, scores, 0)['pr_auc'][0])
+
+def evaluate(labels, scores, threshold=0.5):
+    scores = np.asarray(scores, dtype=np.float64).reshape(-1)
+    result = {k: float(v[0]) for k, v in _weighted_metrics(np.ones((1, len(labels))), labels, scores, threshold).items()}
+
+    tp, tn, fp, fn = confusion_counts(labels, scores > threshold)
+    result.update({'tp': tp, 'tn': tn, 'fp': fp, 'fn': fn})
+
+    return result
+
+def multiclass_f1(labels, predictions, num_classes):
+    labels = np.asarray(labels, dtype=np.int64)
+    predictions = np.asarray(predictions, dtype=np.int64)
+
+    confusion = np.bincount(labels * num_classes + predictions, minlength=num_classes ** 2).reshape(num_classes, num_classes)
+    tp = np.diag(confusion)
+    fp = confusion.sum(axis=0) - tp
+    fn = confusion.sum(axis=1) - tp
+    _, _, fscores = precision_recall_f1(tp, fp, fn)
+
+    # Classes that never show up in the labels don't count towards the macro average
+    present = confusion.sum(axis=1) > 0
+    macro = float(np.mean(fscores[present])) if present.any() else 0.0
+
+    return {
+        'accuracy': float(_divide(tp.sum(), confusion.sum())),
+        'macro_fscore': macro,
+        'fscores': fscores,
+        'confusion': confusion,
+    }
+
+def threshold_sweep(labels, scores):
+    # Precision, recall and F1 when predicting positive for every score >= threshold
+    labels = np.asarray(labels, dtype=np.float64)
+    scores = np.asarray(scores, dtype=np.float64).reshape(-1)
+
+    order, starts = _score_groups(scores, descending=True)
+    ends = np.r_[starts[1:], len(scores)] - 1
+    tp = np.cumsum(labels[order])[ends]
+    fp = np.cumsum(1 - labels[order])[ends]
+    fn = labels.sum() - tp
+
+    precision, recall, fscore = precision_recall_f1(tp, fp, fn)
+
+    return {
+        'thresholds': scores[order][starts],
+        'precision': precision,
+        'recall': recall,
+        'fscore': fscore,
+    }
+
+def best_threshold(labels, scores):
+    sweep = threshold_sweep(labels, scores)
+    best = np.argmax(sweep['fscore'])
+    return sweep['thresholds'][best], sweep['fscore'][best]
+
+def _bootstrap_chunk(labels, scores, threshold, num_resamples, seed):
+    rng = np.random.default_rng(seed)
+    n = len(labels)
+    # Every row holds how many times each example was drawn in one resample
+    weights = rng.multinomial(n, np.full(n, 1.0 / n), size=num_resamples).astype(np.float64)
+    return _weighted_metrics(weights, labels, scores, threshold)
+
+def bootstrap(labels, scores, threshold=0.5, num_resamples=NUM_RESAMPLES, confidence=CONFIDENCE,
+              workers=None, seed=0):
+    labels = np.asarray(labels, dtype=np.float64)
+    scores = np.asarray(scores, dtype=np.float64).reshape(-1)
+
+    chunks = [RESAMPLE_CHUNK] * (num_resamples // RESAMPLE_CHUNK)
+    if num_resamples % RESAMPLE_CHUNK:
+        chunks.append(num_resamples % RESAMPLE_CHUNK)
+    seeds = np.random.SeedSequence(seed).spawn(len(chunks))
+
+    workers = workers or os.cpu_count()
+    if workers == 1 or num_resamples * len(labels) < POOL_MIN_WORK:
+        parts = [_bootstrap_chunk(labels, scores, threshold, size, s) for size, s in zip(chunks, seeds)]
+    else:
+        # Callers have TensorFlow loaded, which doesn't survive a fork. The
+        # spawned workers import the caller's main module again, which only
+        # pays off when it keeps its heavy imports under __main__ (main.py does).
+        with ProcessPoolExecutor(max_workers=workers, mp_context=get_context('spawn')) as pool:
+            futures = [pool.submit(_bootstrap_chunk, labels, scores, threshold, size, s) for size, s in zip(chunks, seeds)]
+            parts = [f.result() for f in futures]
+
+    alpha = (1 - confidence) / 2
+    intervals = {}
+    for metric in METRICS:
+        values = np.concatenate([p[metric] for p in parts])
+        intervals[metric] = {
+            'low': float(np.quantile(values, alpha)),
+            'high': float(np.quantile(values, 1 - alpha)),
+            'std': float(np.std(values)),
+        }
+
+    return intervals
+
+def format_intervals(intervals, confidence=CONFIDENCE):
+    lines = ['\n###### Bootstrap {:.0f}% confidence intervals ######\n'.format(100 * confidence)]
+    for metric, ci in intervals.items():
+        lines.append('{}: [{:.4f}, {:.4f}] (std {:.4f})'.format(metric, ci['low'], ci['high'], ci['std']))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,100 @@
+import os, json, shutil, hashlib
+import numpy as np
+
+from types import SimpleNamespace
+
+RUNS_DIR = 'experiments'
+
+def config_hash(settings):
+    return hashlib.sha1(json.dumps(settings, sort_keys=True, default=str).encode('utf-8')).hexdigest()[:16]
+
+def _to_json(value):
+    if isinstance(value, dict):
+        return {k: _to_json(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_to_json(v) for v in value]
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    return value
+
+class ExperimentRun:
+    # Every fold of a k-fold run is written to <runs_dir>/<model_type>_<hash>/fold_<k>
+    # as soon as it finishes. A fold directory only shows up once it is
+    # complete, so a crashed run resumes from the first missing fold.
+    def __init__(self, model_type, settings, runs_dir=RUNS_DIR, fresh=False):
+        self.model_type = model_type
+        self.hash = config_hash(settings)
+        self.directory = os.path.join(runs_dir, '{}_{}'.format(model_type, self.hash))
+
+        if fresh and os.path.exists(self.directory):
+            shutil.rmtree(self.directory)
+        os.makedirs(self.directory, exist_ok=True)
+
+        with open(os.path.join(self.directory, 'config.json'), 'w') as f:
+            json.dump(_to_json(settings), f, indent=2, sort_keys=True, default=str)
+
+    def fold_dir(self, fold):
+        return os.path.join(self.directory, 'fold_{}'.format(fold))
+
+    def is_done(self, fold):
+        return os.path.exists(os.path.join(self.fold_dir(fold), 'metrics.json'))
+
+    def completed_folds(self):
+        folds = []
+        for name in os.listdir(self.directory):
+            if name.startswith('fold_') and name[5:].isdigit() and self.is_done(int(name[5:])):
+                folds.append(int(name[5:]))
+        return sorted(folds)
+
+    def _weights_path(self, directory):
+        # joblib file for SVM, TensorFlow checkpoint prefix for Keras models
+        return os.path.join(directory, 'model.joblib' if self.model_type == 'svm' else 'weights')
+
+    def save_fold(self, fold, model, metrics, val_index, labels, scores, history=None, timings=None):
+        tmp_dir = self.fold_dir(fold) + '.tmp'
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+
+        model.save_weights(self._weights_path(tmp_dir))
+        np.savez(os.path.join(tmp_dir, 'predictions.npz'), val_index=val_index, labels=labels, scores=scores)
+
+        with open(os.path.join(tmp_dir, 'metrics.json'), 'w') as f:
+            json.dump(_to_json({
+                'metrics': metrics,
+                'history': history.history if history is not None else None,
+                'timings': timings,
+            }), f, indent=2)
+
+        # Checkpoint paths are relative, the directory can be renamed
+        if os.path.exists(self.fold_dir(fold)):
+            shutil.rmtree(self.fold_dir(fold))
+        os.replace(tmp_dir, self.fold_dir(fold))
+
+    def load_fold(self, fold):
+        with open(os.path.join(self.fold_dir(fold), 'metrics.json')) as f:
+            saved = json.load(f)
+        predictions = np.load(os.path.join(self.fold_dir(fold), 'predictions.npz'))
+
+        history = None
+        if saved['history'] is not None:
+            # Same attributes main.py logs from a keras History
+            epochs = len(next(iter(saved['history'].values()), []))
+            history = SimpleNamespace(epoch=list(range(epochs)), history=saved['history'])
+
+        return {
+            'metrics': saved['metrics'],
+            'timings': saved['timings'],
+            'history': history,
+            'val_index': predictions['val_index'],
+            'labels': predictions['labels'],
+            'scores': predictions['scores'],
+        }
+
+    def load_weights(self, model, fold):
+        status = model.load_weights(self._weights_path(self.fold_dir(fold)))
+        if self.model_type != 'svm':
+            status.expect_partial()
+        return model
@@ -16,7 +16,7 @@ def train_and_test(retrain, save, language):
     if model:
         test(model)
 
-def train(save, language):
+def train(save, language, training_file=TRAINING_FILE):
     model = None
 
     if language == 'english':
@@ -28,7 +28,7 @@ def train(save, language):
         exit(0)
     
     try:
-        model = fasttext.train_supervised(TRAINING_FILE, pretrainedVectors=vec_file, dim=300)
+        model = fasttext.train_supervised(training_file, pretrainedVectors=vec_file, dim=300)
         if save:
             model.save_model("models/fasttext_model/baseline.bin")
     except Exception as err:
@@ -36,6 +36,11 @@ def train(save, language):
 
     return model
 
+def positive_probabilities(model, texts):
+    labels, probabilities = model.predict(list(texts), k=2)
+    return [float(p[list(l).index('__label__1')]) if '__label__1' in l else 0.0
+            for l, p in zip(labels, probabilities)]
+
 def test(model):
     pprint.pprint(model.test(TEST_FILE))
     pprint.pprint(model.test_label(TEST_FILE))
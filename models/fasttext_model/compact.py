@@ -0,0 +1,260 @@
+import os, sys, re, time, json
+import numpy as np
+
+from multiprocessing import get_context
+from cli import get_option
+
+FULL_MODEL = 'models/fasttext_model/baseline.bin'
+COMPACT_FILE = 'models/fasttext_model/baseline.emb.npz'
+DATASET_FILES = ['training_set.txt', 'test_set.txt']
+
+# Same values fasttext uses for its product quantizer (see fasttext.quantize)
+PQ_DSUB = 2
+PQ_KSUB = 256
+
+def fasttext_hash(ngram):
+    # FNV-1a over the utf-8 bytes, with the signed char cast fasttext does
+    h = 2166136261
+    for b in ngram.encode('utf-8'):
+        if b > 127:
+            b = (b - 256) & 0xffffffff
+        h = ((h ^ b) * 16777619) & 0xffffffff
+    return h
+
+def word_ngrams(word, minn, maxn):
+    word = '<' + word + '>'
+    ngrams = []
+    for i in range(len(word)):
+        for n in range(1, maxn + 1):
+            j = i + n
+            if j > len(word):
+                break
+            if n >= minn and not (n == 1 and (i == 0 or j == len(word))):
+                ngrams.append(word[i:j])
+    return ngrams
+
+def read_vocabulary(files):
+    parsing_regex = re.compile(r'^__label__\S+\s')
+    words = set()
+    for filename in files:
+        with open(filename) as f:
+            for line in f:
+                words.update(parsing_regex.sub('', line).split())
+    return words
+
+def product_quantize(matrix, dsub=PQ_DSUB, ksub=PQ_KSUB, qnorm=True, seed=0):
+    from sklearn.cluster import KMeans
+
+    norms = None
+    if qnorm:
+        norms = np.linalg.norm(matrix, axis=1).astype(np.float32)
+        matrix = matrix / np.maximum(norms, 1e-8)[:, None]
+
+    dim = matrix.shape[1]
+    if dim % dsub != 0:
+        raise ValueError(f'Dimension {dim} is not a multiple of dsub={dsub}')
+
+    ksub = min(ksub, len(matrix))
+    nsub = dim // dsub
+    codebooks = np.zeros((nsub, ksub, dsub), dtype=np.float32)
+    codes = np.zeros((len(matrix), nsub), dtype=np.uint8)
+
+    for s in range(nsub):
+        sub = matrix[:, s * dsub:(s + 1) * dsub]
+        kmeans = KMeans(n_clusters=ksub, n_init=1, max_iter=25, random_state=seed).fit(sub)
+        codebooks[s] = kmeans.cluster_centers_
+        codes[:, s] = kmeans.labels_
+
+    return codes, codebooks, norms
+
+def export(ft_model, words, output_file=COMPACT_FILE, storage='float32', subwords=False):
+    words = sorted(words)
+    matrix = np.asarray([ft_model.get_word_vector(w) for w in words], dtype=np.float32)
+
+    arrays = {
+        'words': np.frombuffer('\n'.join(words).encode('utf-8'), dtype=np.uint8),
+        'dim': np.array(ft_model.get_dimension()),
+        'storage': np.array(storage),
+    }
+
+    if subwords:
+        if ft_model.maxn == 0:
+            print("The model was trained without subword information (maxn = 0), skipping n-gram buckets")
+        else:
+            nwords = len(ft_model.get_words())
+            bucket_ids = set()
+            for w in words:
+                _, ids = ft_model.get_subwords(w)
+                bucket_ids.update(int(i) - nwords for i in ids if i >= nwords)
+            bucket_ids = np.array(sorted(bucket_ids), dtype=np.int32)
+            ngram_rows = np.asarray([ft_model.get_input_vector(nwords + int(i)) for i in bucket_ids], dtype=np.float32)
+
+            arrays['ngram_ids'] = bucket_ids
+            arrays['ngram_rows'] = ngram_rows.astype(np.float16) if storage == 'float16' else ngram_rows
+            arrays['minn'] = np.array(ft_model.minn)
+            arrays['maxn'] = np.array(ft_model.maxn)
+            arrays['bucket'] = np.array(ft_model.bucket)
+
+    if storage == 'float32':
+        arrays['vectors'] = matrix
+    elif storage == 'float16':
+        arrays['vectors'] = matrix.astype(np.float16)
+    elif storage == 'pq':
+        codes, codebooks, norms = product_quantize(matrix)
+        arrays['codes'] = codes
+        arrays['codebooks'] = codebooks
+        if norms is not None:
+            arrays['norms'] = norms
+    else:
+        raise ValueError(f'Unknown storage type {storage}')
+
+    np.savez(output_file, **arrays)
+
+    return output_file
+
+class CompactEmbeddings:
+    def __init__(self, filename=COMPACT_FILE):
+        data = np.load(filename)
+
+        self.words = bytes(data['words']).decode('utf-8').split('\n') if len(data['words']) else []
+        self.word_ids = {w: i for i, w in enumerate(self.words)}
+        self.dim = int(data['dim'])
+        self.storage = str(data['storage'])
+
+        if self.storage == 'pq':
+            self.codes = data['codes']
+            self.codebooks = data['codebooks']
+            self.norms = data['norms'] if 'norms' in data else None
+            self.vectors = None
+        else:
+            self.vectors = data['vectors']
+
+        self.ngram_ids = {}
+        if 'ngram_ids' in data:
+            self.ngram_ids = {int(b): i for i, b in enumerate(data['ngram_ids'])}
+            self.ngram_rows = data['ngram_rows']
+            self.minn = int(data['minn'])
+            self.maxn = int(data['maxn'])
+            self.bucket = int(data['bucket'])
+
+    def get_dimension(self):
+        return self.dim
+
+    def get_words(self):
+        return self.words
+
+    def get_word_vector(self, word):
+        index = self.word_ids.get(word)
+        if index is not None:
+            return self._row(index)
+
+        return self._oov_vector(word)
+
+    def _row(self, index):
+        if self.vectors is not None:
+            return self.vectors[index].astype(np.float32)
+
+        nsub = self.codes.shape[1]
+        vec = self.codebooks[np.arange(nsub), self.codes[index]].reshape(-1)
+        if self.norms is not None:
+            vec = vec * self.norms[index]
+        return vec
+
+    def _oov_vector(self, word):
+        vec = np.zeros(self.dim, dtype=np.float32)
+        if not self.ngram_ids:
+            return vec
+
+        # Unknown n-grams have no row in the pruned table, fasttext would have
+        # averaged over them as well
+        ngrams = word_ngrams(word, self.minn, self.maxn)
+        for ngram in ngrams:
+            index = self.ngram_ids.get(fasttext_hash(ngram) % self.bucket)
+            if index is not None:
+                vec += self.ngram_rows[index]
+
+        if ngrams:
+            vec /= len(ngrams)
+        return vec
+
+def load_embeddings(filename):
+    if filename.endswith('.npz'):
+        return CompactEmbeddings(filename)
+
+    from fasttext import load_model
+    return load_model(filename)
+
+#### Memory and latency benchmark ####
+def _rss_mb():
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+
+def _measure(filename, words, queue):
+    rss_before = _rss_mb()
+    start = time.perf_counter()
+    model = load_embeddings(filename)
+    load_time = time.perf_counter() - start
+    rss_after = _rss_mb()
+
+    start = time.perf_counter()
+    vectors = np.asarray([model.get_word_vector(w) for w in words], dtype=np.float32)
+    lookup_time = time.perf_counter() - start
+
+    queue.put({
+        'load_seconds': load_time,
+        'rss_mb': rss_after - rss_before,
+        'lookup_us_per_word': 1e6 * lookup_time / max(len(words), 1),
+        'vectors': vectors,
+    })
+
+def benchmark(full_file, compact_file, words):
+    # Every model is loaded in a fresh process so RSS measurements don't overlap
+    ctx = get_context('spawn')
+    results = {}
+    for name, filename in [('full', full_file), ('compact', compact_file)]:
+        queue = ctx.Queue()
+        process = ctx.Process(target=_measure, args=(filename, words, queue))
+        process.start()
+        results[name] = queue.get()
+        process.join()
+
+    full_vecs = results['full'].pop('vectors')
+    compact_vecs = results['compact'].pop('vectors')
+    norms = np.linalg.norm(full_vecs, axis=1) * np.linalg.norm(compact_vecs, axis=1)
+    cosine = np.sum(full_vecs * compact_vecs, axis=1) / np.maximum(norms, 1e-8)
+    results['compact']['mean_cosine_to_full'] = float(np.mean(cosine))
+    results['compact']['min_cosine_to_full'] = float(np.min(cosine))
+    results['compact']['file_mb'] = os.path.getsize(compact_file) / 2**20
+    results['full']['file_mb'] = os.path.getsize(full_file) / 2**20
+
+    return results
+
+if __name__ == "__main__":
+    # Usage: python -m models.fasttext_model.compact [--storage float32|float16|pq] [--subwords]
+    #                                                [--vocab words.txt] [--output file.npz] [--benchmark]
+    storage = get_option('--storage', 'float32')
+    output_file = get_option('--output', COMPACT_FILE)
+    vocab_file = get_option('--vocab', None)
+    subwords = True if '--subwords' in sys.argv else False
+
+    words = read_vocabulary(DATASET_FILES)
+    if vocab_file:
+        with open(vocab_file) as f:
+            words.update(f.read().split())
+
+    if '--benchmark' not in sys.argv or not os.path.exists(output_file):
+        from fasttext import load_model
+        try:
+            ft_model = load_model(FULL_MODEL)
+        except ValueError as err:
+            print(err)
+            print("Couldn't find a saved model, aborting...")
+            exit(0)
+
+        export(ft_model, words, output_file, storage, subwords)
+        print(f'Exported {len(words)} words to {output_file}')
+        del ft_model
+
+    if '--benchmark' in sys.argv:
+        results = benchmark(FULL_MODEL, output_file, sorted(words))
+        print(json.dumps(results, indent=2))
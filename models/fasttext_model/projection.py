@@ -0,0 +1,204 @@
+import sys, os, time, json, itertools, configparser
+import numpy as np
+
+from joblib import dump, load
+from sklearn.decomposition import PCA
+from cli import get_option, require_manifest
+
+TRADEOFF_FILE = 'models/fasttext_model/projection.json'
+DIMENSIONS = [100, 64, 32]
+TRADEOFF_FOLDS = 2
+TRADEOFF_EPOCHS = 3
+# Tweets used to time featurization and scoring
+LATENCY_SAMPLE = 200
+
+def word_dimension(config=None):
+    # WORD_DIMENSION in conf.txt, 0 keeps the fasttext vectors
+    if config is None:
+        config = configparser.ConfigParser()
+        config.read('conf.txt')
+    section = config['EMBEDDINGS'] if config.has_section('EMBEDDINGS') else {}
+    return int(section.get('WORD_DIMENSION', 0))
+
+def projection_file(model_file):
+    # The PCA a model was trained with is saved next to it
+    return model_file + '.projection.joblib'
+
+def corpus_vocabulary(texts):
+    return sorted(set(word for text in texts for word in text.split()))
+
+class ProjectedEmbeddings:
+    # Same interface as the fasttext model, over PCA-reduced vectors. The
+    # vocabulary table is projected once, unknown words are projected (and
+    # kept) the first time they show up.
+    def __init__(self, ft_model, projection, words):
+        self.ft_model = ft_model
+        self.projection = projection
+        self.words = list(words)
+        self.word_ids = {w: i for i, w in enumerate(self.words)}
+        self.table = self._project([ft_model.get_word_vector(w) for w in self.words])
+        self.oov = {}
+
+    def _project(self, vectors):
+        if not len(vectors):
+            return np.zeros((0, self.projection.n_components_), dtype=np.float32)
+        return self.projection.transform(np.asarray(vectors, dtype=np.float32)).astype(np.float32)
+
+    def get_dimension(self):
+        return self.projection.n_components_
+
+    def get_words(self):
+        return self.words
+
+    def get_word_vector(self, word):
+        index = self.word_ids.get(word)
+        if index is not None:
+            return self.table[index]
+        if word not in self.oov:
+            self.oov[word] = self._project([self.ft_model.get_word_vector(word)])[0]
+        return self.oov[word]
+
+def fit_projection(ft_model, texts, dimension):
+    words = corpus_vocabulary(texts)
+    vectors = np.asarray([ft_model.get_word_vector(w) for w in words], dtype=np.float32)
+    return PCA(n_components=dimension, random_state=0).fit(vectors), words
+
+def project_embeddings(ft_model, texts, dimension=None):
+    # Word model for featurization: ft_model itself, or its vectors reduced to
+    # dimension (WORD_DIMENSION by default) with a PCA fitted on the vocabulary
+    # of texts
+    dimension = word_dimension() if dimension is None else dimension
+    if not dimension:
+        return ft_model
+
+    projection, words = fit_projection(ft_model, texts, dimension)
+    return ProjectedEmbeddings(ft_model, projection, words)
+
+def save_projection(word_model, model_file):
+    # Keeps the PCA of word_model next to a saved model, nothing to keep for
+    # plain fasttext vectors
+    if isinstance(word_model, ProjectedEmbeddings):
+        dump(word_model.projection, projection_file(model_file))
+
+def load_projected_embeddings(ft_model, filename, words=()):
+    # Projection saved next to a model, words are projected ahead of time
+    return ProjectedEmbeddings(ft_model, load(filename), words)
+
+def model_embeddings(ft_model, model_file, words=()):
+    # Word model a saved model was trained with: its saved PCA over ft_model,
+    # or ft_model itself when it was trained on the fasttext vectors
+    filename = projection_file(model_file)
+    if os.path.exists(filename):
+        return load_projected_embeddings(ft_model, filename, words)
+    return ft_model
+
+#### Trade-offs ####
+def svm_tradeoff(word_model, texts, dataset_text, sent_vectors, labels, folds, workers):
+    from data_mgmt.data_mgmt import dataset_to_embeddings
+    from models import evaluation, features
+    from models.svm import SVM
+
+    dmd = features.dmd_features(dataset_to_embeddings(dataset_text, word_model), workers)
+    X = features.compose({'dmd': dmd, 'sent': sent_vectors}, ['dmd', 'sent'])
+
+    fscores = []
+    for train_index, val_index in folds:
+        model = SVM(['dmd', 'sent'])
+        model.fit_features(X[train_index], labels[train_index])
+        fscores.append(evaluation.evaluate(labels[val_index], model.score_features(X[val_index]), 0.0)['fscore'])
+
+    # Raw pretext to score, without the sentence vectors (the same for every dimension)
+    sample = [(t, None) for t in texts[:LATENCY_SAMPLE]]
+    start = time.perf_counter()
+    sample_dmd = features.dmd_features(dataset_to_embeddings(sample, word_model))
+    model.score_features(np.hstack([sample_dmd, sent_vectors[:len(sample)]]))
+    latency = 1000 * (time.perf_counter() - start) / len(sample)
+
+    return {'dmd_dimension': dmd.shape[1], 'fscore': float(np.mean(fscores)),
+            'fscore_std': float(np.std(fscores)), 'latency_ms': latency}
+
+def functional_tradeoff(word_model, dataset_text, sent_vectors, labels, folds, epochs, batch_size):
+    from data_mgmt.data_mgmt import dataset_to_embeddings
+    from models import arch_profile
+    from models.functional_model import get_architecture
+
+    encoder, head = get_architecture()
+    inputs = [dataset_to_embeddings(dataset_text, word_model), sent_vectors]
+    result = arch_profile.profile_speed(encoder, head, inputs, labels, batch_size)
+    result['fscore'], result['fscore_std'] = arch_profile.kfold_fscore(encoder, head, inputs, labels, folds, epochs, batch_size)
+    result['input_kb_per_tweet'] = inputs[0][0].nbytes / 1024
+    return result
+
+def tradeoffs(ft_model, dataset_text, sent_vectors, labels, folds, dimensions, models, epochs, batch_size, workers):
+    # One row per word dimension (the fasttext one first): F-score, latency and
+    # memory of the vocabulary table for the svm and functional models
+    texts = [ex[0] for ex in dataset_text]
+    results = []
+    for dimension in [0] + list(dimensions):
+        start = time.perf_counter()
+        word_model = project_embeddings(ft_model, texts, dimension)
+        fit_seconds = time.perf_counter() - start
+
+        words = corpus_vocabulary(texts)
+        result = {
+            'dimension': dimension or ft_model.get_dimension(),
+            'fit_seconds': fit_seconds if dimension else 0.0,
+            'table_mb': len(words) * (dimension or ft_model.get_dimension()) * 4 / 2**20,
+        }
+        if dimension:
+            result['explained_variance'] = float(np.sum(word_model.projection.explained_variance_ratio_))
+        if 'svm' in models:
+            result['svm'] = svm_tradeoff(word_model, texts, dataset_text, sent_vectors, labels, folds, workers)
+        if 'functional' in models:
+            result['functional'] = functional_tradeoff(word_model, dataset_text, sent_vectors, labels, folds, epochs, batch_size)
+        results.append(result)
+        print('Dimension {} done'.format(result['dimension']))
+    return results
+
+def format_table(results):
+    lines = ['{:>5} {:>9} {:>9} {:>18} {:>10} {:>18} {:>10}'.format(
+        'dim', 'var', 'table MB', 'svm F1', 'svm ms', 'functional F1', 'b1 ms')]
+    for r in results:
+        svm = r.get('svm')
+        functional = r.get('functional')
+        lines.append('{:>5} {:>9} {:>9.2f} {:>18} {:>10} {:>18} {:>10}'.format(
+            r['dimension'],
+            '{:.3f}'.format(r['explained_variance']) if 'explained_variance' in r else '-',
+            r['table_mb'],
+            '{:.4f} ±{:.4f}'.format(svm['fscore'], svm['fscore_std']) if svm else '-',
+            '{:.3f}'.format(svm['latency_ms']) if svm else '-',
+            '{:.4f} ±{:.4f}'.format(functional['fscore'], functional['fscore_std']) if functional else '-',
+            '{:.2f}'.format(functional['latency_ms'][1]) if functional and 1 in functional['latency_ms'] else '-'))
+    return '\n'.join(lines)
+
+if __name__ == "__main__":
+    # Usage: python -m models.fasttext_model.projection [--dimensions 100,64,32] [--models svm,functional]
+    #                                                   [--folds 2] [--epochs 3] [--workers N] [--compact-emb]
+    from data_mgmt.data_mgmt import get_dataset
+    from data_mgmt.splits import fold_splits
+    from models.fasttext_model import compact
+
+    config = configparser.ConfigParser()
+    config.read('conf.txt')
+    os.environ['LANGUAGE'] = config['GENERAL']['LANGUAGE']
+
+    manifest = require_manifest(config)
+
+    dimensions = [int(d) for d in get_option('--dimensions', ','.join(map(str, DIMENSIONS))).split(',')]
+    models = get_option('--models', 'svm,functional').split(',')
+    num_folds = int(get_option('--folds', TRADEOFF_FOLDS))
+    epochs = int(get_option('--epochs', TRADEOFF_EPOCHS))
+    workers = int(get_option('--workers', os.cpu_count()))
+    ft_model = compact.load_embeddings(compact.COMPACT_FILE if '--compact-emb' in sys.argv else compact.FULL_MODEL)
+
+    training_text, test_text, training_ex_emb, test_ex_emb = get_dataset(manifest=manifest)
+    dataset_text = training_text + test_text
+    labels = np.asarray([int(ex[1]) for ex in dataset_text])
+    folds = list(itertools.islice(fold_splits(manifest), num_folds))
+
+    results = tradeoffs(ft_model, dataset_text, np.append(training_ex_emb, test_ex_emb, 0), labels, folds,
+                        dimensions, models, epochs, int(config['GENERAL']['BATCH_SIZE']), workers)
+
+    with open(TRADEOFF_FILE, 'w') as f:
+        json.dump({'folds': num_folds, 'epochs': epochs, 'results': results}, f, indent=2)
+    print(format_table(results))
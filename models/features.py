@@ -0,0 +1,117 @@
+import os, hashlib
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from pydmd import HODMD
+
+CACHE_DIR = 'features'
+DMD_CHUNK = 200
+
+# Feature blocks in composition order, with the conf.txt flag enabling each
+BLOCKS = ['dmd', 'sent', 'bert']
+BLOCK_FLAGS = {'dmd': 'USE_WORD_EMB', 'sent': 'USE_SENT_EMB', 'bert': 'USE_BERT_EMB'}
+
+def enabled_blocks(config):
+    return [b for b in BLOCKS if config['EMBEDDINGS'].get(BLOCK_FLAGS[b], 'true') == 'true']
+
+#### Word vector modes ####
+def p_mean_vector(powers, vectors):
+    embeddings = []
+    for p in powers:
+        embeddings.append(np.power(np.mean(np.power(np.array(vectors, dtype=complex), p), axis=0), 1 / p).real)
+    return np.hstack(embeddings)
+
+def modes_from_word_vecs(v, concat_avg=True):
+    list_of_modes = []
+    time_lags = [1, 2]
+    for d in time_lags:
+        dmd = HODMD(svd_rank=2, opt=True, exact=True, d=d)
+        dmd.fit(v.T)
+        fmode = dmd.modes.T
+        list_of_modes.append(np.hstack(np.absolute(fmode)))
+
+    if concat_avg:
+        mean_vec = p_mean_vector([1.0], v)
+        list_of_modes.append(mean_vec)
+
+    return list_of_modes
+
+def dmd_dimension(word_dimension):
+    # Two modes for each of the two time lags plus the mean vector
+    return word_dimension * 5
+
+def _dmd_chunk(word_vectors):
+    return np.array([np.hstack(modes_from_word_vecs(v)) for v in word_vectors]).reshape(len(word_vectors), -1)
+
+def dmd_features(word_vectors, workers=1):
+    # HODMD is fitted once per tweet, the slowest block by far, so big
+    # batches are spread over processes
+    if workers == 1 or len(word_vectors) <= DMD_CHUNK:
+        return _dmd_chunk(word_vectors)
+
+    chunks = [word_vectors[i:i + DMD_CHUNK] for i in range(0, len(word_vectors), DMD_CHUNK)]
+    # Callers have TensorFlow loaded, which doesn't survive a fork
+    with ProcessPoolExecutor(max_workers=workers, mp_context=get_context('spawn')) as pool:
+        return np.concatenate(list(pool.map(_dmd_chunk, chunks)), 0)
+
+#### Composition ####
+def is_empty(block):
+    return block is None or len(block) == 0 or np.asarray(block).ndim < 2 or np.asarray(block).shape[1] == 0
+
+def compose(blocks, names=BLOCKS):
+    # Blocks that are disabled or empty (e.g. no BERT vectors) are skipped
+    parts = [np.asarray(blocks[name]) for name in names if name in blocks and not is_empty(blocks[name])]
+    if not parts:
+        raise ValueError('No feature block selected')
+    return np.hstack(parts)
+
+#### Cache ####
+def content_key(*parts):
+    h = hashlib.sha1()
+    for part in parts:
+        for item in part:
+            h.update(str(item).encode('utf-8'))
+            h.update(b'\0')
+    return h.hexdigest()[:16]
+
+class FeatureCache:
+    # One .npy file per block and input, so blocks are computed once and any
+    # combination of them is a cheap hstack
+    def __init__(self, directory=CACHE_DIR):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, name, key):
+        return os.path.join(self.directory, '{}_{}.npy'.format(name, key))
+
+    def get(self, name, key, compute):
+        filename = self.path(name, key)
+        if os.path.exists(filename):
+            return np.load(filename)
+
+        block = np.asarray(compute())
+        tmp_file = filename + '.tmp.npy'
+        np.save(tmp_file, block)
+        os.replace(tmp_file, filename)
+        return block
+
+def embeddings_id(filename, dimension=0):
+    # Word vector file plus its mtime, a retrained model invalidates the DMD
+    # block. dimension is the WORD_DIMENSION the vectors were reduced to.
+    emb_id = '{}:{}'.format(filename, os.path.getmtime(filename))
+    return '{}:{}'.format(emb_id, dimension) if dimension else emb_id
+
+def dataset_blocks(names, texts, emb_id, word_vectors, sent_vectors, bert_vectors=None, cache=None, workers=1):
+    # Feature blocks for a whole dataset. DMD comes from the cache whenever the
+    # same tweets were featurized with the same word vectors before.
+    cache = cache or FeatureCache()
+    blocks = {}
+    if 'dmd' in names:
+        blocks['dmd'] = cache.get('dmd', content_key([emb_id, np.shape(word_vectors[0])], texts),
+                                  lambda: dmd_features(word_vectors, workers))
+    if 'sent' in names:
+        blocks['sent'] = np.asarray(sent_vectors)
+    if 'bert' in names and bert_vectors is not None:
+        blocks['bert'] = np.asarray(bert_vectors)
+    return blocks
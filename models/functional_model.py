@@ -1,4 +1,4 @@
-import os, tensorflow as tf
+import os, configparser, tensorflow as tf
 
 from tensorflow import keras
 from tensorflow.keras import layers
@@ -45,16 +45,55 @@ def custom(inputs):
 
     return layers.Dense(400, activation='relu')(concat)
 
-def FunctionalModel(inputShape, input2Shape, bertInputShape, use_bert):
+#### Architecture selection ####
+# WORD_COMBINATION_STRATEGY in [ARCHITECTURE] picks the word vector encoder,
+# HEAD the layers between the tweet vector and the outputs
+ENCODERS = {'lstm': lstm_haternet, 'conv': conv_tass}
+HEADS = {'haternet': haternet, 'tass': tass}
+DEFAULT_ENCODER = 'lstm'
+DEFAULT_HEAD = 'haternet'
+
+# Conv1D doesn't take a mask, padded rows are left as zero vectors
+MASKING_ENCODERS = ['lstm']
+
+def get_architecture(config=None):
+    if config is None:
+        config = configparser.ConfigParser()
+        config.read('conf.txt')
+    section = config['ARCHITECTURE'] if config.has_section('ARCHITECTURE') else {}
+
+    encoder = section.get('WORD_COMBINATION_STRATEGY', DEFAULT_ENCODER).strip('\'"')
+    head = section.get('HEAD', DEFAULT_HEAD).strip('\'"')
+    if encoder not in ENCODERS:
+        raise ValueError('Unknown WORD_COMBINATION_STRATEGY {}, use one of {}'.format(encoder, ', '.join(ENCODERS)))
+    if head not in HEADS:
+        raise ValueError('Unknown HEAD {}, use one of {}'.format(head, ', '.join(HEADS)))
+
+    return encoder, head
+
+def shared_encoder(inputShape, input2Shape, bertInputShape, use_bert, ragged=False, encoder=None, head=None):
+    # encoder and head default to the ones in conf.txt, so saved weights are
+    # loaded into the architecture they were trained with
+    if encoder is None or head is None:
+        config_encoder, config_head = get_architecture()
+        encoder = encoder or config_encoder
+        head = head or config_head
+
+    if ragged:
+        # Variable number of words per batch, padding rows are masked out
+        inputShape = (None, inputShape[-1])
+
     inputs = keras.Input(shape=inputShape, name='tweet_word_vectors')
 
     inputs2 = keras.Input(shape=input2Shape, name='tweet_vectors')
 
     input_array = [inputs, inputs2]
 
-    norm = layers.BatchNormalization()(inputs)
+    word_vectors = layers.Masking(mask_value=0.0)(inputs) if ragged and encoder in MASKING_ENCODERS else inputs
+
+    norm = layers.BatchNormalization()(word_vectors)
 
-    processed_inputs = lstm_haternet(norm)#conv_tass(norm)
+    processed_inputs = ENCODERS[encoder](norm)
 
     inputs2 = layers.BatchNormalization()(inputs2)
 
@@ -71,7 +110,12 @@ def FunctionalModel(inputShape, input2Shape, bertInputShape, use_bert):
 
     tweet_vector = layers.concatenate(tweet_vector_array, axis=1)
 
-    final = haternet(tweet_vector)#tass(tweet_vector)
+    final = HEADS[head](tweet_vector)
+
+    return input_array, final
+
+def FunctionalModel(inputShape, input2Shape, bertInputShape, use_bert, ragged=False, encoder=None, head=None):
+    input_array, final = shared_encoder(inputShape, input2Shape, bertInputShape, use_bert, ragged, encoder, head)
 
     output = layers.Dense(1, activation="sigmoid")(final)
 
@@ -90,4 +134,58 @@ def FunctionalModel(inputShape, input2Shape, bertInputShape, use_bert):
                     tf.keras.metrics.FalseNegatives()
                 ])
 
-    return model
\ No newline at end of file
+    return model
+
+#### Multi-task model ####
+MASKED_LABEL = -1
+
+def masked_binary_crossentropy(y_true, y_pred):
+    y_true = tf.reshape(tf.cast(y_true, y_pred.dtype), tf.shape(y_pred))
+    mask = tf.cast(tf.not_equal(y_true, MASKED_LABEL), y_pred.dtype)
+    losses = keras.backend.binary_crossentropy(y_true * mask, y_pred) * mask
+
+    return tf.reduce_sum(losses) / tf.maximum(tf.reduce_sum(mask), 1.0)
+
+def masked_sparse_categorical_crossentropy(y_true, y_pred):
+    y_true = tf.reshape(tf.cast(y_true, tf.int32), [-1])
+    mask = tf.cast(tf.not_equal(y_true, MASKED_LABEL), y_pred.dtype)
+    losses = keras.backend.sparse_categorical_crossentropy(tf.maximum(y_true, 0), y_pred) * mask
+
+    return tf.reduce_sum(losses) / tf.maximum(tf.reduce_sum(mask), 1.0)
+
+def MultiTaskFunctionalModel(inputShape, input2Shape, bertInputShape, use_bert, num_hate_types, ragged=False, encoder=None, head=None):
+    input_array, final = shared_encoder(inputShape, input2Shape, bertInputShape, use_bert, ragged, encoder, head)
+
+    outputs = [
+        layers.Dense(1, activation="sigmoid", name='HS')(final),
+        layers.Dense(1, activation="sigmoid", name='OF')(final),
+        layers.Dense(num_hate_types, activation="softmax", name='HT')(final),
+    ]
+
+    model = keras.Model(inputs=input_array, outputs=outputs, name="multitask_output")
+
+    model.compile(loss={
+                    'HS': tf.keras.losses.BinaryCrossentropy(),
+                    'OF': masked_binary_crossentropy,
+                    'HT': masked_sparse_categorical_crossentropy
+                },
+                optimizer=tf.keras.optimizers.Adam(0.001))
+
+    return model
+
+def reset_model(model, initial_weights):
+    # Puts a compiled model back to its initial state without rebuilding or
+    # re-tracing it: same weights, fresh optimizer slots and step counter
+    model.set_weights(initial_weights)
+
+    variables = model.optimizer.variables
+    if callable(variables):
+        variables = variables()
+    # Keras 3 lists the learning rate with the step counter and the slots
+    learning_rate = getattr(model.optimizer, '_learning_rate', None)
+    for var in variables:
+        if var is learning_rate or var.name.split('/')[-1].split(':')[0] == 'learning_rate':
+            continue
+        var.assign(tf.zeros_like(var))
+
+    model.reset_metrics()
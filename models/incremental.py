@@ -0,0 +1,305 @@
+import sys, os, json, time, shutil, configparser
+import numpy as np
+import tensorflow as tf
+
+from fasttext import load_model
+from joblib import dump, load
+
+from data_mgmt.data_mgmt import dataset_to_embeddings, fit_sent_embedder, transform_additional_embeddings, MAX_WORDS
+from data_mgmt.splits import load_split
+from models import evaluation, features
+from models.fasttext_model.compact import FULL_MODEL
+from models.fasttext_model.projection import project_embeddings, save_projection, model_embeddings
+from models.functional_model import FunctionalModel, get_architecture
+from models.svm import IncrementalSVM
+from cli import get_option, require_manifest
+
+INCREMENTAL_DIR = 'saved_models/incremental'
+# Old tweets replayed in every update, as a multiple of the new ones
+REPLAY_RATIO = 2
+UPDATE_EPOCHS = 3
+# Past any of these, the TF-IDF/SVD projection is refit and, since every
+# sentence vector changes with it, the model is retrained from scratch
+OOV_DRIFT = 0.05
+ENERGY_DRIFT = 0.05
+# Share of the training pool that plays the new tweets in --validate
+NEW_FRACTION = 0.1
+SEED = 1234
+
+template = 'Test Accuracy: {accuracy},\nTest Precision: {precision},\nTest Recall: {recall},\nTest F-Score: {fscore}'
+
+#### Projection drift ####
+def projection_stats(tweets, sent_embedder):
+    # OOV rate: tokens the TF-IDF vocabulary doesn't know (none for the
+    # hashed vectorizer). Energy: share of the TF-IDF norm kept by the projection.
+    tf_idf_vectorizer, svd = sent_embedder
+    oov_rate = 0.0
+    if hasattr(tf_idf_vectorizer, 'vocabulary_'):
+        analyzer = tf_idf_vectorizer.build_analyzer()
+        tokens = [token for tweet in tweets for token in analyzer(tweet)]
+        oov_rate = np.mean([token not in tf_idf_vectorizer.vocabulary_ for token in tokens]) if tokens else 0.0
+
+    tf_idf = tf_idf_vectorizer.transform(tweets)
+    energy = np.sum(svd.transform(tf_idf) ** 2) / max(tf_idf.power(2).sum(), 1e-12)
+
+    return {'oov_rate': float(oov_rate), 'energy': float(energy)}
+
+def reference_stats(tweets, seed=SEED):
+    # Measured on a tenth of the tweets left out of the fit. In-sample numbers
+    # (no OOV, SVD fitted to them) would flag every new batch as drift.
+    order = np.random.RandomState(seed).permutation(len(tweets))
+    held_out = max(1, len(tweets) // 10)
+    sent_embedder = fit_sent_embedder([tweets[i] for i in order[held_out:]])
+    return projection_stats([tweets[i] for i in order[:held_out]], sent_embedder)
+
+def has_drifted(reference, stats):
+    return (stats['oov_rate'] - reference['oov_rate'] > OOV_DRIFT or
+            reference['energy'] - stats['energy'] > ENERGY_DRIFT)
+
+#### Model inputs ####
+def model_inputs(model_type, texts, ft_model, sent_embedder, blocks):
+    word_vectors = dataset_to_embeddings([(text, None) for text in texts], ft_model)
+    sent_vectors = transform_additional_embeddings(texts, sent_embedder)
+    if model_type == 'svm':
+        return features.compose({'dmd': features.dmd_features(word_vectors, os.cpu_count()) if 'dmd' in blocks else None,
+                                 'sent': sent_vectors}, blocks)
+    return [word_vectors, sent_vectors]
+
+def model_scores(model_type, model, inputs):
+    if model_type == 'svm':
+        return model.score_features(inputs), 0.0
+    return model.predict(inputs, batch_size=256)[:, 0], 0.5
+
+#### Training ####
+class IncrementalModel:
+    # A model plus the artifacts its inputs depend on: the TF-IDF/SVD
+    # projection, its drift reference and the label of every tweet seen
+    def __init__(self, model_type, blocks, ft_model, epochs, batch_size):
+        self.model_type = model_type
+        self.blocks = [b for b in blocks if b != 'bert']
+        self.ft_model = ft_model
+        # ft_model, or its PCA reduction when WORD_DIMENSION is set
+        self.word_model = ft_model
+        self.epochs = epochs
+        self.batch_size = batch_size
+        self.model = None
+        # Encoder and head of the functional model, saved with its weights
+        self.architecture = get_architecture()
+        self.sent_embedder = None
+        self.reference = None
+        self.labels = {}
+        self.updates = 0
+
+    def _new_model(self, inputs):
+        if self.model_type == 'svm':
+            return IncrementalSVM(self.blocks)
+        tf.keras.backend.clear_session()
+        encoder, head = self.architecture
+        return FunctionalModel(inputs[0][0].shape, inputs[1][0].shape, 0, False, encoder=encoder, head=head)
+
+    def inputs(self, texts):
+        return model_inputs(self.model_type, texts, self.word_model, self.sent_embedder, self.blocks)
+
+    def fit(self, rows):
+        # Full retrain: new projection, new model
+        texts = [r['pretext'] for r in rows]
+        labels = np.asarray([int(r['HS']) for r in rows])
+
+        self.word_model = project_embeddings(self.ft_model, texts)
+        self.sent_embedder = fit_sent_embedder(texts)
+        self.reference = reference_stats(texts)
+        inputs = self.inputs(texts)
+
+        self.model = self._new_model(inputs)
+        if self.model_type == 'svm':
+            self.model.fit_features(inputs, labels)
+        else:
+            earlyStopping = tf.keras.callbacks.EarlyStopping(monitor='val_loss',
+                                                             patience=5,
+                                                             restore_best_weights=True)
+            self.model.fit(inputs, labels,
+                           validation_split=0.2,
+                           shuffle=True,
+                           batch_size=self.batch_size,
+                           epochs=self.epochs,
+                           callbacks=[earlyStopping],
+                           verbose=0)
+
+        self.labels = {r['id']: r['HS'] for r in rows}
+        self.updates = 0
+        return {'mode': 'full', 'examples': len(rows)}
+
+    def new_rows(self, rows):
+        # Unseen tweets plus tweets whose label changed since they were seen
+        return [r for r in rows if self.labels.get(r['id']) != r['HS']]
+
+    def update(self, rows, seed=SEED):
+        # rows is the whole current training set, only what is new is used
+        new = self.new_rows(rows)
+        if not new:
+            return {'mode': 'none', 'examples': 0}
+
+        stats = projection_stats([r['pretext'] for r in new], self.sent_embedder)
+        if has_drifted(self.reference, stats):
+            result = self.fit(rows)
+            result['drift'] = stats
+            return result
+
+        new_ids = set(r['id'] for r in new)
+        old = [r for r in rows if r['id'] not in new_ids]
+        rng = np.random.RandomState(seed + self.updates)
+        replay = [old[i] for i in rng.choice(len(old), min(len(old), REPLAY_RATIO * len(new)), replace=False)]
+
+        batch = new + replay
+        inputs = self.inputs([r['pretext'] for r in batch])
+        labels = np.asarray([int(r['HS']) for r in batch])
+
+        if self.model_type == 'svm':
+            new_mask = np.arange(len(batch)) < len(new)
+            # Changed labels were already counted by the scaler
+            new_mask[:len(new)] = [r['id'] not in self.labels for r in new]
+            self.model.partial_fit_features(inputs, labels, UPDATE_EPOCHS, new_mask)
+        else:
+            # Continued training from the current weights
+            self.model.fit(inputs, labels,
+                           shuffle=True,
+                           batch_size=self.batch_size,
+                           epochs=UPDATE_EPOCHS,
+                           verbose=0)
+
+        self.labels.update({r['id']: r['HS'] for r in new})
+        self.updates += 1
+        return {'mode': 'incremental', 'examples': len(new), 'replayed': len(replay), 'drift': stats}
+
+    def evaluate(self, rows):
+        scores, threshold = model_scores(self.model_type, self.model, self.inputs([r['pretext'] for r in rows]))
+        return evaluation.evaluate(np.asarray([int(r['HS']) for r in rows]), scores, threshold)
+
+    #### Artifacts ####
+    def _weights_path(self, directory):
+        return os.path.join(directory, 'model.joblib' if self.model_type == 'svm' else 'weights')
+
+    def save(self, directory=INCREMENTAL_DIR):
+        # Written next to the previous artifacts and swapped in at the end, an
+        # interrupted update leaves the previous ones untouched
+        tmp_dir = directory + '.tmp'
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+
+        self.model.save_weights(self._weights_path(tmp_dir))
+        save_projection(self.word_model, self._weights_path(tmp_dir))
+        dump(self.sent_embedder, os.path.join(tmp_dir, 'sent_emb.joblib'))
+        with open(os.path.join(tmp_dir, 'state.json'), 'w') as f:
+            json.dump({'model_type': self.model_type, 'blocks': self.blocks, 'reference': self.reference,
+                       'updates': self.updates, 'labels': self.labels,
+                       'architecture': list(self.architecture)}, f)
+
+        if os.path.exists(directory):
+            shutil.rmtree(directory)
+        os.replace(tmp_dir, directory)
+
+    def load(self, directory=INCREMENTAL_DIR):
+        with open(os.path.join(directory, 'state.json')) as f:
+            state = json.load(f)
+        if state['model_type'] != self.model_type:
+            raise ValueError('{} holds a {} model'.format(directory, state['model_type']))
+
+        self.blocks = state['blocks']
+        self.reference = state['reference']
+        self.updates = state['updates']
+        self.labels = state['labels']
+        # Artifacts saved before the architecture was recorded use conf.txt
+        self.architecture = tuple(state.get('architecture', self.architecture))
+        self.sent_embedder = load(os.path.join(directory, 'sent_emb.joblib'))
+        self.word_model = model_embeddings(self.ft_model, self._weights_path(directory))
+
+        if self.model_type == 'svm':
+            self.model = IncrementalSVM(self.blocks)
+            self.model.load_weights(self._weights_path(directory))
+        else:
+            encoder, head = self.architecture
+            self.model = FunctionalModel((MAX_WORDS, self.word_model.get_dimension()),
+                                         (self.sent_embedder[1].n_components,), 0, False, encoder=encoder, head=head)
+            self.model.load_weights(self._weights_path(directory)).expect_partial()
+        return self
+
+#### Validation ####
+def validate(make_model, manifest, holdout_fold=0, new_fraction=NEW_FRACTION, seed=SEED):
+    # Plays a refresh on the k-fold data: a model trained on most of the pool
+    # is updated with the rest, and compared on a held-out fold against a
+    # full retrain on the whole pool
+    rows = load_split('all', manifest)
+    folds = np.asarray(manifest['folds'])
+    holdout = [r for r, fold in zip(rows, folds) if fold == holdout_fold]
+    pool = [r for r, fold in zip(rows, folds) if fold != holdout_fold]
+
+    order = np.random.RandomState(seed).permutation(len(pool))
+    split = int(round(len(pool) * (1 - new_fraction)))
+    old = [pool[i] for i in order[:split]]
+
+    incremental = make_model()
+    incremental.fit(old)
+    start = time.perf_counter()
+    update = incremental.update(pool)
+    update_time = time.perf_counter() - start
+    incremental_metrics = incremental.evaluate(holdout)
+
+    full = make_model()
+    start = time.perf_counter()
+    full.fit(pool)
+    full_time = time.perf_counter() - start
+    full_metrics = full.evaluate(holdout)
+
+    return {
+        'holdout_fold': holdout_fold,
+        'old_examples': len(old),
+        'new_examples': len(pool) - len(old),
+        'update': update,
+        'incremental_fscore': incremental_metrics['fscore'],
+        'full_fscore': full_metrics['fscore'],
+        'fscore_delta': incremental_metrics['fscore'] - full_metrics['fscore'],
+        'update_seconds': update_time,
+        'full_seconds': full_time,
+        'speedup': full_time / max(update_time, 1e-12),
+    }
+
+if __name__ == "__main__":
+    # Usage: python -m models.incremental [--model svm|functional] [--full]
+    #        python -m models.incremental --validate [--fold 0] [--new-fraction 0.1]
+    # Run after fetch_data.py/sync_votes.py and main.py --resplit
+    config = configparser.ConfigParser()
+    config.read('conf.txt')
+    os.environ['LANGUAGE'] = config['GENERAL']['LANGUAGE']
+
+    manifest = require_manifest(config)
+
+    model_type = get_option('--model', config['GENERAL']['MODEL_TYPE'])
+    if model_type not in ('svm', 'functional'):
+        print("Incremental updates are only supported for svm and functional models, aborting...")
+        exit(0)
+
+    ft_model = load_model(FULL_MODEL)
+    make_model = lambda: IncrementalModel(model_type, features.enabled_blocks(config), ft_model,
+                                          int(config['GENERAL']['EPOCHS']), int(config['GENERAL']['BATCH_SIZE']))
+
+    if '--validate' in sys.argv:
+        report = validate(make_model, manifest, int(get_option('--fold', 0)),
+                          float(get_option('--new-fraction', NEW_FRACTION)))
+        print(json.dumps(report, indent=2))
+        exit(0)
+
+    model = make_model()
+    rows = load_split('training', manifest)
+    start = time.perf_counter()
+    if '--full' in sys.argv or not os.path.exists(os.path.join(INCREMENTAL_DIR, 'state.json')):
+        result = model.fit(rows)
+    else:
+        result = model.load().update(rows)
+
+    if result['mode'] == 'none':
+        print('No new or relabeled tweets, {} is up to date'.format(INCREMENTAL_DIR))
+    else:
+        model.save()
+        print('{} update with {} tweets in {:.1f}s'.format(result['mode'], result['examples'], time.perf_counter() - start))
+        print(template.format(**model.evaluate(load_split('test', manifest))))
@@ -0,0 +1,19 @@
+import os, json
+
+# Settings a model saved with --save has to be rebuilt and featurized with,
+# kept in <model>.json next to its weights
+
+def settings_file(model_file):
+    return model_file + '.json'
+
+def save_settings(model_file, settings):
+    with open(settings_file(model_file), 'w') as f:
+        json.dump(settings, f, indent=2)
+
+def load_settings(model_file):
+    # Models saved before the settings were recorded have none
+    filename = settings_file(model_file)
+    if not os.path.exists(filename):
+        return {}
+    with open(filename) as f:
+        return json.load(f)
@@ -1,90 +1,146 @@
 import numpy as np
 
 from sklearn.svm import LinearSVC
+from sklearn.linear_model import SGDClassifier
 from sklearn.pipeline import make_pipeline
 from sklearn.preprocessing import StandardScaler
 from joblib import dump, load
-from pydmd import HODMD
+
+from models import evaluation, features
 
 class SVM:
-    def __init__(self):
+    # blocks picks the feature blocks (see models.features.BLOCKS) to use
+    def __init__(self, blocks=features.BLOCKS):
+        self.blocks = list(blocks)
         self.clf = make_pipeline(StandardScaler(),
                                  LinearSVC(random_state=0, tol=1e-5, max_iter=50000))
 
     def fit(self, word_vectors, sent_vectors, bert_vectors, labels):
-        final_vectors = np.zeros((len(sent_vectors), word_vectors[0].shape[1]*5 + sent_vectors.shape[1] + bert_vectors.shape[1]))
-        for index, v in enumerate(word_vectors):
-            list_of_modes = self._get_modes_from_word_vecs(v)
-            list_of_modes.append(sent_vectors[index])
-            list_of_modes.append(bert_vectors[index])
-            final_vectors[index] = np.hstack(list_of_modes)
+        final_vectors = self._build_features(word_vectors, sent_vectors, bert_vectors)
 
-        self.clf.fit(final_vectors, labels)
+        self.fit_features(final_vectors, labels)
 
     def evaluate(self, word_vectors, sent_vectors, bert_vectors, labels):
-        final_vectors = np.zeros((len(sent_vectors), word_vectors[0].shape[1]*5 + sent_vectors.shape[1] + bert_vectors.shape[1]))
-        for index, v in enumerate(word_vectors):
-            list_of_modes = self._get_modes_from_word_vecs(v)
-            list_of_modes.append(sent_vectors[index])
-            list_of_modes.append(bert_vectors[index])
-            final_vectors[index] = np.hstack(list_of_modes)
+        final_vectors = self._build_features(word_vectors, sent_vectors, bert_vectors)
         
-        predictions = self.clf.predict(final_vectors)
-        tp, tn, fp, fn = 0, 0, 0, 0
-        for i, p in enumerate(predictions):
-            if labels[i] == 1:
-                if p == 1:
-                    tp += 1
-                if p == 0:
-                    fn += 1
-            else:
-                if p == 1:
-                    fp += 1
-                if p == 0:
-                    tn += 1
-        
-        accuracy = (tp + tn) / (tp + tn + fp + fn)       
-        precision = tp / (tp + fp)
-        recall = tp / (tp + fn)
-        fscore = 2 * (precision * recall) / (precision + recall)
+        metrics = evaluation.evaluate(labels, self.clf.decision_function(final_vectors), 0.0)
 
-        return accuracy, precision, recall, fscore, tp, tn, fp, fn
+        return (metrics['accuracy'], metrics['precision'], metrics['recall'], metrics['fscore'],
+                metrics['tp'], metrics['tn'], metrics['fp'], metrics['fn'])
 
     def predict(self, word_vectors, sent_vectors, bert_vectors):
-        final_vectors = np.zeros((len(sent_vectors), word_vectors[0].shape[1]*5 + sent_vectors.shape[1] + bert_vectors.shape[1]))
-        for index, v in enumerate(word_vectors):
-            list_of_modes = self._get_modes_from_word_vecs(v)
-            list_of_modes.append(sent_vectors[index])
-            list_of_modes.append(bert_vectors[index])
-            final_vectors[index] = np.hstack(list_of_modes)
+        final_vectors = self._build_features(word_vectors, sent_vectors, bert_vectors)
         
         return self.clf.predict(final_vectors)
+
+    def score(self, word_vectors, sent_vectors, bert_vectors):
+        final_vectors = self._build_features(word_vectors, sent_vectors, bert_vectors)
+
+        return self.score_features(final_vectors)
     
     def save_weights(self, filename):
-        dump(self.clf, filename)
+        # The blocks are saved with the classifier, a loaded model builds the
+        # features it was trained on whatever blocks it was constructed with
+        dump((self.blocks, self.clf), filename)
 
     def load_weights(self, filename):
-        return load(filename)
-
-    def _get_modes_from_word_vecs(self, v, concat_avg = True):
-        list_of_modes = []
-        time_lags = [1,2]
-        for d in time_lags:
-            dmd = HODMD(svd_rank=2, opt=True, exact=True, d=d)
-            dmd.fit(v.T)
-            fmode = dmd.modes.T
-            list_of_modes.append(np.hstack(np.absolute(fmode)))
-
-        if concat_avg:
-            mean_vec = self._p_mean_vector([1.0], v)
-            list_of_modes.append(mean_vec)
-
-        return list_of_modes
-        
-    
-    def _p_mean_vector(self, powers, vectors):
-        embeddings = []
-        for p in powers:
-            embeddings.append(np.power(np.mean(np.power(np.array(vectors, dtype=complex),p),axis=0),1 / p).real)
-        return np.hstack(embeddings)
+        saved = load(filename)
+        # Older files only hold the classifier
+        if isinstance(saved, tuple):
+            self.blocks, self.clf = list(saved[0]), saved[1]
+        else:
+            self.clf = saved
+        return self.clf
+
+    def fit_features(self, final_vectors, labels):
+        self.clf.fit(final_vectors, labels)
+
+    def score_features(self, final_vectors):
+        return self.clf.decision_function(final_vectors)
+
+    def _build_features(self, word_vectors, sent_vectors, bert_vectors):
+        blocks = {'sent': sent_vectors, 'bert': bert_vectors}
+        if 'dmd' in self.blocks:
+            blocks['dmd'] = features.dmd_features(word_vectors)
+
+        return features.compose(blocks, self.blocks)
+
+class IncrementalSVM(SVM):
+    # Hinge-loss linear model that can be updated with new examples without
+    # refitting on the whole dataset (LinearSVC can't be warm-started)
+    def __init__(self, blocks=features.BLOCKS, epochs=20, random_state=0):
+        super().__init__(blocks)
+        self.epochs = epochs
+        self.random_state = random_state
+        self.clf = self._new_pipeline()
+
+    def _new_pipeline(self):
+        return make_pipeline(StandardScaler(),
+                             SGDClassifier(loss='hinge', alpha=1e-3, average=True, random_state=self.random_state))
+
+    def fit_features(self, final_vectors, labels):
+        self.clf = self._new_pipeline()
+        self.clf[0].fit(final_vectors)
+        self.partial_fit_features(final_vectors, labels, new_rows=np.zeros(len(final_vectors), dtype=bool))
 
+    def partial_fit_features(self, final_vectors, labels, epochs=None, new_rows=None):
+        # new_rows masks the examples the scaler hasn't seen yet (all of them
+        # by default), replayed ones are not counted twice
+        scaler, sgd = self.clf[0], self.clf[-1]
+        unseen = final_vectors if new_rows is None else final_vectors[new_rows]
+        if len(unseen):
+            scaler.partial_fit(unseen)
+        scaled = scaler.transform(final_vectors)
+
+        rng = np.random.RandomState(self.random_state)
+        for _ in range(epochs or self.epochs):
+            order = rng.permutation(len(scaled))
+            sgd.partial_fit(scaled[order], np.asarray(labels)[order], classes=np.array([0, 1]))
+
+class MultiTaskSVM(SVM):
+    # One featurization shared by a linear classifier per task. Rows whose
+    # label for a task is masked are left out of that task only.
+    def __init__(self, tasks, masked_label=-1, blocks=features.BLOCKS):
+        super().__init__(blocks)
+        self.tasks = tasks
+        self.masked_label = masked_label
+        self.clfs = {task: make_pipeline(StandardScaler(),
+                                         LinearSVC(random_state=0, tol=1e-5, max_iter=50000))
+                     for task in tasks}
+
+    def fit(self, word_vectors, sent_vectors, bert_vectors, labels):
+        final_vectors = self._build_features(word_vectors, sent_vectors, bert_vectors)
+
+        for task in self.tasks:
+            rows = labels[task] != self.masked_label
+            self.clfs[task].fit(final_vectors[rows], labels[task][rows])
+
+    def predict(self, word_vectors, sent_vectors, bert_vectors):
+        final_vectors = self._build_features(word_vectors, sent_vectors, bert_vectors)
+
+        return {task: self.clfs[task].predict(final_vectors) for task in self.tasks}
+
+    def score(self, word_vectors, sent_vectors, bert_vectors):
+        final_vectors = self._build_features(word_vectors, sent_vectors, bert_vectors)
+
+        return {task: self.clfs[task].decision_function(final_vectors) for task in self.tasks}
+
+    def labels_from_scores(self, task, scores):
+        # Class labels for the output of score(), as predict() would return.
+        # Columns follow the classes seen in training, and two classes give
+        # a single column.
+        classes = self.clfs[task].classes_
+        if scores.ndim == 1:
+            return classes[(scores > 0).astype(int)]
+        return classes[np.argmax(scores, axis=1)]
+
+    def save_weights(self, filename):
+        dump((self.blocks, self.clfs), filename)
+
+    def load_weights(self, filename):
+        saved = load(filename)
+        if isinstance(saved, tuple):
+            self.blocks, self.clfs = list(saved[0]), saved[1]
+        else:
+            self.clfs = saved
+        return self.clfs
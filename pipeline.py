@@ -0,0 +1,153 @@
+import time
+
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from multiprocessing import get_context
+
+# Where a stage runs: 'thread' for I/O and code that releases the GIL (or
+# holds unpicklable objects such as the fasttext model), 'process' for pure
+# Python CPU work whose function, inputs and outputs can be pickled (process
+# workers are spawned, the function has to be importable), 'main' for code
+# that has to stay on the calling thread
+POOLS = ['thread', 'process', 'main']
+
+class Stage:
+    def __init__(self, name, function, inputs, outputs, pool):
+        self.name = name
+        self.function = function
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.pool = pool
+
+class StageGraph:
+    # Stages declare the values they consume and produce. run() only executes
+    # the stages needed for the requested values, and starts every stage as
+    # soon as its inputs are available, so independent stages overlap.
+    def __init__(self, threads=4, processes=2):
+        self.stages = {}
+        self.producers = {}
+        self.threads = threads
+        self.processes = processes
+        self.timings = {}
+
+    def add(self, name, function, inputs=(), outputs=(), pool='thread'):
+        # function gets the inputs as positional arguments and returns one
+        # value per output (a tuple when there are several)
+        if pool not in POOLS:
+            raise ValueError('Unknown pool {}, use one of {}'.format(pool, ', '.join(POOLS)))
+        if name in self.stages:
+            raise ValueError('Stage {} is already defined'.format(name))
+        for output in outputs:
+            if output in self.producers:
+                raise ValueError('{} is already produced by stage {}'.format(output, self.producers[output]))
+            self.producers[output] = name
+        self.stages[name] = Stage(name, function, inputs, outputs, pool)
+        return self
+
+    def required(self, targets, values):
+        # Stages whose outputs lead to targets, without the ones already given
+        needed = set()
+        pending = [t for t in targets if t not in values]
+        while pending:
+            value = pending.pop()
+            if value not in self.producers:
+                raise ValueError('No stage produces {}'.format(value))
+            stage = self.stages[self.producers[value]]
+            if stage.name not in needed:
+                needed.add(stage.name)
+                pending.extend(i for i in stage.inputs if i not in values)
+        return needed
+
+    def run(self, targets, values=None):
+        # Returns a dict with the values of targets. Stages that no target
+        # depends on are skipped.
+        values = dict(values or {})
+        needed = self.required(targets, values)
+        skipped = [name for name in self.stages if name not in needed]
+
+        self.timings = {}
+        start = time.perf_counter()
+        pools = {'thread': ThreadPoolExecutor(max_workers=self.threads)}
+        if any(self.stages[name].pool == 'process' for name in needed):
+            # TensorFlow doesn't survive a fork
+            pools['process'] = ProcessPoolExecutor(max_workers=self.processes, mp_context=get_context('spawn'))
+
+        running = {}
+        try:
+            while needed or running:
+                ready = [name for name in self.stages if name in needed
+                         and all(i in values for i in self.stages[name].inputs)]
+                for name in ready:
+                    stage = self.stages[name]
+                    if stage.pool != 'main':
+                        needed.remove(name)
+                        args = [values[i] for i in stage.inputs]
+                        # Timed from submission, so the time a spawned
+                        # worker takes to start is part of the stage
+                        future = pools[stage.pool].submit(stage.function, *args)
+                        running[future] = (stage, time.perf_counter() - start)
+
+                # Main thread stages run while the pools work, one at a time
+                main_ready = [name for name in ready if self.stages[name].pool == 'main']
+                if main_ready:
+                    stage = self.stages[main_ready[0]]
+                    needed.remove(stage.name)
+                    stage_start = time.perf_counter() - start
+                    result, seconds = _timed(stage.function, [values[i] for i in stage.inputs])
+                    self._store(stage, result, stage_start, seconds, values)
+                    continue
+
+                if not running:
+                    if needed:
+                        raise ValueError('Stages {} depend on each other'.format(', '.join(sorted(needed))))
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage, stage_start = running.pop(future)
+                    result = future.result()
+                    self._store(stage, result, stage_start, time.perf_counter() - start - stage_start, values)
+        finally:
+            for pool in pools.values():
+                pool.shutdown(wait=not running, cancel_futures=True)
+
+        self.wall_time = time.perf_counter() - start
+        self.skipped = skipped
+        return {t: values[t] for t in targets}
+
+    def _store(self, stage, result, stage_start, seconds, values):
+        if len(stage.outputs) == 1:
+            result = (result,)
+        elif not stage.outputs:
+            result = ()
+        values.update(zip(stage.outputs, result))
+        self.timings[stage.name] = {'start': stage_start, 'seconds': seconds}
+
+    def critical_path(self):
+        # Longest chain of dependent stages by run time, the lower bound for
+        # the wall time of the last run()
+        longest = {}
+        def path(name):
+            if name not in longest:
+                parents = [self.producers[i] for i in self.stages[name].inputs
+                           if i in self.producers and self.producers[i] in self.timings]
+                best = max((path(p) for p in parents), key=lambda p: p[0], default=(0.0, []))
+                longest[name] = (best[0] + self.timings[name]['seconds'], best[1] + [name])
+            return longest[name]
+        return max((path(name) for name in self.timings), key=lambda p: p[0], default=(0.0, []))
+
+    def report(self):
+        seconds, stages = self.critical_path()
+        print('\n###### Pipeline stages ######\n')
+        for name, timing in sorted(self.timings.items(), key=lambda t: t[1]['start']):
+            print('{:<20} {:>8} {:>8.2f}s -> {:>7.2f}s{}'.format(
+                name, self.stages[name].pool, timing['start'], timing['start'] + timing['seconds'],
+                ' *' if name in stages else ''))
+        if self.skipped:
+            print('Skipped (unused): {}'.format(', '.join(self.skipped)))
+        print('Stage time: {:.2f}s, critical path (*): {:.2f}s, wall time: {:.2f}s'.format(
+            sum(t['seconds'] for t in self.timings.values()), seconds, self.wall_time))
+
+def _timed(function, args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
@@ -0,0 +1,267 @@
+import sys, os, csv, json, time, configparser
+import numpy as np
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from cli import get_option
+
+CHUNK_SIZE = 10000
+
+# Per-process state, filled by init_worker
+worker = {}
+
+def init_worker(model_type, model_file, emb_file, sent_emb_file, language, projection_file=None, cascade_file=None):
+    os.environ['LANGUAGE'] = language
+
+    from models.fasttext_model import compact
+    from data_mgmt import data_mgmt
+
+    worker['ft_model'] = compact.load_embeddings(emb_file)
+    if projection_file:
+        # Word vectors reduced with the PCA saved along with the model
+        from models.fasttext_model.projection import load_projected_embeddings
+        worker['ft_model'] = load_projected_embeddings(worker['ft_model'], projection_file)
+    worker['sent_embedder'] = data_mgmt.load_sent_embedder(sent_emb_file)
+    worker['model_type'] = model_type
+
+    if model_type == 'svm':
+        from models.svm import SVM
+        model = SVM()
+        model.load_weights(model_file)
+    elif model_type == 'functional':
+        from models.functional_model import FunctionalModel
+        from models.saved_model import load_settings
+        example_dim = (data_mgmt.MAX_WORDS, worker['ft_model'].get_dimension())
+        tweet_emb_dim = (worker['sent_embedder'][1].n_components,)
+        # Encoder and head the model was saved with, conf.txt for older models
+        encoder, head = load_settings(model_file).get('architecture', (None, None))
+        model = FunctionalModel(example_dim, tweet_emb_dim, 0, False, encoder=encoder, head=head)
+        model.load_weights(model_file).expect_partial()
+    else:
+        raise ValueError(f'Model type {model_type} cannot be used for scoring')
+
+    worker['model'] = model
+    worker['threshold'] = 0.0 if model_type == 'svm' else 0.5
+
+    if cascade_file:
+        # fasttext decides alone outside the calibrated band, the model above
+        # only scores the tweets inside it
+        from models.cascade import load_cascade
+        expensive_predict = lambda pretexts: (model_scores(pretexts)[0] > worker['threshold']).astype(int)
+        worker['cascade'], _ = load_cascade(expensive_predict, cascade_file)
+
+def model_scores(pretexts):
+    # Scores and sentence vectors of non-empty preprocessed tweets
+    from data_mgmt import data_mgmt
+
+    word_vectors = data_mgmt.dataset_to_embeddings([(t,) for t in pretexts], worker['ft_model'])
+    sent_vectors = data_mgmt.transform_additional_embeddings(pretexts, worker['sent_embedder'])
+
+    if worker['model_type'] == 'svm':
+        no_bert = np.zeros((len(pretexts), 0))
+        return worker['model'].score(word_vectors, sent_vectors, no_bert), sent_vectors
+    return worker['model'].predict([word_vectors, sent_vectors])[:, 0], sent_vectors
+
+def preprocess_chunk(chunk):
+    from data_mgmt.normalize import get_normalizer
+
+    normalizer = get_normalizer(os.getenv('LANGUAGE'))
+
+    ids = [row[0] for row in chunk]
+    texts = [normalizer.preprocess(row[1]) for row in chunk]
+
+    # Tweets that end up empty after preprocessing are skipped by new_dataset
+    # too, they get an empty score
+    valid = [i for i, t in enumerate(texts) if t.strip() != ""]
+    return ids, texts, valid
+
+def score_chunk(chunk):
+    # ids, scores and labels (None when they come from the score threshold)
+    if 'cascade' not in worker:
+        ids, scores, _ = featurize_chunk(chunk)
+        return ids, scores, None
+
+    # The score is fasttext's probability, the label the cascade's decision
+    ids, texts, valid = preprocess_chunk(chunk)
+    scores = np.full(len(chunk), np.nan)
+    labels = np.zeros(len(chunk), dtype=int)
+    if valid:
+        labels[valid], scores[valid] = worker['cascade'].predict([texts[i] for i in valid], return_probabilities=True)
+    return ids, scores, labels
+
+def featurize_chunk(chunk):
+    # Scores and sentence vectors of a chunk of (id, raw text) rows
+    ids, texts, valid = preprocess_chunk(chunk)
+    scores = np.full(len(chunk), np.nan)
+    sent_vectors = np.zeros((len(chunk), worker['sent_embedder'][1].n_components), dtype=np.float32)
+
+    if valid:
+        scores[valid], sent_vectors[valid] = model_scores([texts[i] for i in valid])
+
+    return ids, scores, sent_vectors
+
+def read_tweets(input_file, skip=0):
+    with open(input_file) as f:
+        if input_file.endswith('.jsonl') or input_file.endswith('.json'):
+            rows = (json.loads(line) for line in f if line.strip())
+        else:
+            rows = csv.DictReader(f, dialect='excel-tab')
+
+        for index, row in enumerate(rows):
+            if index < skip:
+                continue
+            tweet_id = row.get('id', row.get('tweet_id', str(index)))
+            yield (tweet_id, row['text'])
+
+def read_chunks(tweets, chunk_size):
+    chunk = []
+    for tweet in tweets:
+        chunk.append(tweet)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def load_checkpoint(checkpoint_file):
+    if os.path.exists(checkpoint_file):
+        with open(checkpoint_file) as f:
+            return json.load(f)
+    return {'rows_done': 0, 'bytes_written': 0}
+
+def save_checkpoint(checkpoint_file, checkpoint):
+    tmp_file = checkpoint_file + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_file, checkpoint_file)
+
+def score_file(input_file, output_file, model_type, model_file, emb_file, sent_emb_file, language,
+               chunk_size=CHUNK_SIZE, workers=os.cpu_count(), threshold=None, projection_file=None, cascade_file=None):
+    if threshold is None:
+        threshold = 0.0 if model_type == 'svm' else 0.5
+
+    checkpoint_file = output_file + '.ckpt'
+    checkpoint = load_checkpoint(checkpoint_file)
+
+    # Anything written after the last checkpoint belongs to an unfinished chunk
+    mode = 'r+' if checkpoint['rows_done'] > 0 and os.path.exists(output_file) else 'w'
+    out = open(output_file, mode)
+    if mode == 'r+':
+        out.seek(checkpoint['bytes_written'])
+        out.truncate()
+        print(f"Resuming after {checkpoint['rows_done']} tweets")
+    else:
+        out.write('id\tscore\tlabel\n')
+        checkpoint = {'rows_done': 0, 'bytes_written': out.tell()}
+
+    chunks = read_chunks(read_tweets(input_file, checkpoint['rows_done']), chunk_size)
+
+    start = time.perf_counter()
+    scored = 0
+    with ProcessPoolExecutor(max_workers=workers,
+                             mp_context=get_context('spawn'),
+                             initializer=init_worker,
+                             initargs=(model_type, model_file, emb_file, sent_emb_file, language, projection_file,
+                                       cascade_file)) as pool:
+        # At most two chunks per worker are in flight, which bounds memory and
+        # lets results be written back in input order
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.submit(score_chunk, chunk))
+            if len(pending) >= 2 * workers:
+                scored += write_scores(out, pending.popleft().result(), threshold, checkpoint, checkpoint_file)
+                print(f'{checkpoint["rows_done"]} tweets scored, {scored / (time.perf_counter() - start):.1f} tweets/sec')
+
+        while pending:
+            scored += write_scores(out, pending.popleft().result(), threshold, checkpoint, checkpoint_file)
+
+    out.close()
+    elapsed = time.perf_counter() - start
+    print(f'Scored {scored} tweets in {elapsed:.1f}s ({scored / max(elapsed, 1e-9):.1f} tweets/sec)')
+
+    os.remove(checkpoint_file)
+
+def write_scores(out, result, threshold, checkpoint, checkpoint_file):
+    ids, scores, labels = result
+    if labels is None:
+        labels = scores > threshold
+    for tweet_id, score, label in zip(ids, scores, labels):
+        if np.isnan(score):
+            out.write(f'{tweet_id}\t\t\n')
+        else:
+            out.write(f'{tweet_id}\t{score}\t{int(label)}\n')
+    out.flush()
+    os.fsync(out.fileno())
+
+    checkpoint['rows_done'] += len(ids)
+    checkpoint['bytes_written'] = out.tell()
+    save_checkpoint(checkpoint_file, checkpoint)
+
+    return len(ids)
+
+def saved_model_files(model_file):
+    # Word vector file, sentence embedder and word PCA (None without
+    # WORD_DIMENSION) a model was saved with, so tweets are featurized as in
+    # training. --compact-emb and --full-emb override the word vector file.
+    from models import saved_model
+    from models.fasttext_model import compact, projection
+    from data_mgmt.data_mgmt import sent_emb_file
+
+    # Models saved before the word vector file was recorded used the full model
+    emb_file = saved_model.load_settings(model_file).get('embeddings', compact.FULL_MODEL)
+    if '--compact-emb' in sys.argv:
+        emb_file = compact.COMPACT_FILE
+    elif '--full-emb' in sys.argv:
+        emb_file = compact.FULL_MODEL
+
+    if not os.path.exists(emb_file):
+        print(f"{emb_file} not found, aborting...")
+        exit(0)
+    if not os.path.exists(sent_emb_file(model_file)):
+        print("No sentence embedder saved with the model, save it again with main.py --save, aborting...")
+        exit(0)
+
+    projection_file = projection.projection_file(model_file)
+    return emb_file, sent_emb_file(model_file), projection_file if os.path.exists(projection_file) else None
+
+if __name__ == "__main__":
+    # Usage: python score.py <tweets.tsv|tweets.jsonl> <scores.tsv> --model saved_models/<model>
+    #                        [--model-type svm|functional] [--chunk-size N] [--workers N]
+    #                        [--compact-emb|--full-emb] [--cascade]
+    # Every worker loads its own copy of the word vectors the model was
+    # trained with, --compact-emb trades the full model for the compact file.
+    # With --cascade the score column holds the fasttext probability and the
+    # label comes from the band calibrated by python -m models.cascade
+    config = configparser.ConfigParser()
+    config.read('conf.txt')
+
+    input_file = sys.argv[1]
+    output_file = sys.argv[2]
+    model_file = get_option('--model', None)
+    model_type = get_option('--model-type', config['GENERAL']['MODEL_TYPE'])
+    chunk_size = int(get_option('--chunk-size', CHUNK_SIZE))
+    workers = int(get_option('--workers', os.cpu_count()))
+
+    if not model_file:
+        print("A saved model is needed (--model), aborting...")
+        exit(0)
+
+    emb_file, sent_emb_file, projection_file = saved_model_files(model_file)
+
+    cascade_file = None
+    if '--cascade' in sys.argv:
+        from models.cascade import CASCADE_FILE
+        if not os.path.exists(CASCADE_FILE):
+            print("No cascade band found, run python -m models.cascade first, aborting...")
+            exit(0)
+        with open(CASCADE_FILE) as f:
+            calibrated_type = json.load(f)['model_type']
+        if calibrated_type != model_type:
+            print(f"The cascade band was calibrated for the {calibrated_type} model, aborting...")
+            exit(0)
+        cascade_file = CASCADE_FILE
+
+    score_file(input_file, output_file, model_type, model_file, emb_file, sent_emb_file,
+               config['GENERAL']['LANGUAGE'], chunk_size, workers, projection_file=projection_file,
+               cascade_file=cascade_file)